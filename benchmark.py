@@ -0,0 +1,481 @@
+#!/usr/bin/env python
+"""End-to-end training throughput benchmark of DQNAgent.fit.
+
+Runs fit for a fixed number of iterations on the deterministic
+synthetic environment for every create_model variant, with and
+without experience replay. Each configuration runs in its own process
+so the peak RSS and the TensorFlow graph belong to that configuration
+only. The results are written as JSON, to compare commits and
+hardware.
+"""
+import argparse
+import collections
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+NETWORKS = ['linear_q_network', 'deep_q_network', 'deep_q_network_double', 'deep_q_network_duel']
+
+
+def threshold_metrics(reward_threshold, num_episodes=10):
+    """Metrics that also remember when the reward threshold was first reached.
+
+    The threshold is compared with the mean reward of the last
+    num_episodes episodes.
+    """
+    from deeprl_hw2.metrics import Metrics
+
+    class ThresholdMetrics(Metrics):
+        def __init__(self):
+            Metrics.__init__(self)
+            self.rewards = collections.deque(maxlen=num_episodes)
+            self.start = time.time()
+            self.threshold_s = None
+
+        def scalar(self, name, value):
+            Metrics.scalar(self, name, value)
+            if name != 'episode_reward' or reward_threshold is None:
+                return
+            self.rewards.append(value)
+            if self.threshold_s is None and len(self.rewards) == num_episodes and \
+                    sum(self.rewards) / num_episodes >= reward_threshold:
+                self.threshold_s = time.time() - self.start
+
+    return ThresholdMetrics()
+
+
+def run_config(args):
+    """Train one configuration and return its measurements."""
+    import numpy as np
+    import tensorflow as tf
+    import gym
+
+    from deeprl_hw2 import synthetic
+    from deeprl_hw2.checkpoint import CheckpointWriter
+    from deeprl_hw2.core import ReplayMemory
+    from deeprl_hw2.dqn import DQNAgent
+    from deeprl_hw2.objectives import mean_huber_loss
+    from deeprl_hw2.policy import LinearDecayGreedyEpsilonPolicy
+    from deeprl_hw2.preprocessors import AtariPreprocessor
+    from deeprl_hw2.utils import jit_scope
+    from dqn_atari import create_model, scale_large_batch
+
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    tf.set_random_seed(args.seed)
+
+    env = gym.make(synthetic.ENV_NAME)
+    num_actions = env.action_space.n
+    preprocessor = AtariPreprocessor((84, 84))
+    memory = ReplayMemory(args.num_iterations + args.num_burn_in + 1000, args.window)
+    policy = LinearDecayGreedyEpsilonPolicy(0.05, 0, 1000000)
+    num_burn_in = args.num_burn_in if args.experience_replay else 0
+
+    batch_size, train_freq, alpha = scale_large_batch(args.batch_size, args.train_freq, 0.0001, args.large_batch,
+                                                      args.lr_scaling)
+    accumulate_steps = args.large_batch if args.accumulate else 1
+    if args.accumulate:
+        batch_size = args.batch_size
+
+    output_folder = tempfile.mkdtemp(prefix='dqn-benchmark-')
+    metrics = threshold_metrics(args.reward_threshold)
+
+    with tf.Session() as sess:
+        with jit_scope(args.xla_run):
+            q_network_online = create_model(args.window, (84, 84), num_actions, args.network_name, True,
+                                            args.layout)
+            q_network_target = create_model(args.window, (84, 84), num_actions, args.network_name, False,
+                                            args.layout)
+
+        dqn_agent = DQNAgent((q_network_online, q_network_target), preprocessor, memory, policy, num_actions,
+                             0.99, args.target_update_freq, num_burn_in, train_freq, batch_size,
+                             args.experience_replay, 3, args.network_name, 1.0, synthetic.ENV_NAME, sess,
+                             checkpoint_writer=CheckpointWriter(output_folder), metrics=metrics,
+                             accumulate_steps=accumulate_steps, xla=args.xla_run, seed=args.seed)
+        dqn_agent.compile(tf.train.AdamOptimizer(learning_rate=alpha), mean_huber_loss)
+
+        start = time.time()
+        dqn_agent.fit(env, args.num_iterations, output_folder, args.num_iterations + 1, args.num_iterations)
+        wall = time.time() - start
+
+    shutil.rmtree(output_folder)
+
+    # the evaluation that fit runs before its first iteration, the
+    # burn-in and the XLA warm-up are not part of the steady state
+    phases = dict(metrics.total_phase_time)
+    train_time = wall - phases.get('evaluate', 0.0) - phases.get('burn_in', 0.0) - phases.get('warm_up', 0.0)
+
+    return {'network_name': args.network_name,
+            'experience_replay': args.experience_replay,
+            'large_batch': args.large_batch,
+            'accumulate': args.accumulate,
+            'xla': args.xla_run,
+            'warm_up_s': phases.get('warm_up', 0.0),
+            'time_to_threshold_s': metrics.threshold_s,
+            'num_iterations': args.num_iterations,
+            'wall_s': wall,
+            'train_s': train_time,
+            'frames_per_sec': metrics.total_counts['steps'] / train_time,
+            'updates_per_sec': metrics.total_counts['updates'] / train_time,
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+            'phase_s': phases}
+
+
+def measure_layouts(networks, window, batch_size, num_actions=6, num_calls=50):
+    """Time every create_model layout and check it matches the default.
+
+    For every network and layout this measures the forward pass of a
+    single state (action selection) and a forward/backward training
+    step on a batch. The default network's weights are copied into
+    each layout with convert_weights, and the largest difference of
+    the q values is reported as max_abs_diff.
+
+    Returns
+    -------
+    list(dict)
+      One entry per network and layout.
+    """
+    import numpy as np
+    import tensorflow as tf
+    import keras.backend as K
+
+    from deeprl_hw2.dqn import build_td_loss
+    from deeprl_hw2.objectives import mean_huber_loss
+    from dqn_atari import LAYOUTS, convert_weights, create_model
+
+    rng = np.random.RandomState(0)
+    states = rng.rand(batch_size, 84, 84, window).astype(np.float32)
+    actions = rng.randint(0, num_actions, batch_size)
+    y_vals = rng.rand(batch_size).astype(np.float32)
+
+    def time_calls(func):
+        func()
+        start = time.time()
+        for _ in xrange(num_calls):
+            func()
+        return 1000 * (time.time() - start) / num_calls
+
+    results = []
+    for network_name in networks:
+        with tf.Graph().as_default(), tf.Session() as sess:
+            K.set_session(sess)
+            models = dict((layout, create_model(window, (84, 84), num_actions, network_name, True, layout))
+                          for layout in LAYOUTS)
+            train_ops = {}
+            for layout, model in models.items():
+                y_true, action, loss = build_td_loss(model.output, num_actions, mean_huber_loss, 1.0)
+                train_ops[layout] = (tf.train.AdamOptimizer(0.0001).minimize(loss), y_true, action)
+            sess.run(tf.global_variables_initializer())
+
+            # check every layout against the default before any train
+            # step, the timed Adam steps change the weights
+            reference = sess.run(models['default'].output, feed_dict={models['default'].input: states})
+            layout_results = []
+            for layout in LAYOUTS:
+                model = models[layout]
+                convert_weights(models['default'], model)
+                result = {'network_name': network_name, 'layout': layout}
+                try:
+                    q_values = sess.run(model.output, feed_dict={model.input: states})
+                    result['max_abs_diff'] = float(np.max(np.abs(q_values - reference)))
+                except tf.errors.OpError as e:
+                    # e.g. no NCHW conv kernels on this CPU build
+                    result['error'] = e.message
+                layout_results.append(result)
+
+            for result in layout_results:
+                if 'error' in result:
+                    continue
+                model = models[result['layout']]
+                result['forward_ms'] = time_calls(
+                    lambda: sess.run(model.output, feed_dict={model.input: states[:1]}))
+                train_op, y_true, action = train_ops[result['layout']]
+                result['train_step_ms'] = time_calls(
+                    lambda: sess.run(train_op, feed_dict={model.input: states, y_true: y_vals, action: actions}))
+            results.extend(layout_results)
+
+    return results
+
+
+STARTUP_IMPORTS = {
+    # what an actor / evaluation worker process needs
+    'worker': 'import deeprl_hw2.core, deeprl_hw2.policy, deeprl_hw2.preprocessors, deeprl_hw2.inference',
+    # dqn_atari.py --numpy_model, evaluation without TensorFlow
+    'numpy_evaluator': 'import deeprl_hw2.core, deeprl_hw2.policy, deeprl_hw2.preprocessors, '
+                       'deeprl_hw2.evaluation, deeprl_hw2.utils, deeprl_hw2.numpy_inference',
+    # dqn_atari.py --frozen_model, the same evaluation on a frozen graph
+    'frozen_evaluator': 'import deeprl_hw2.core, deeprl_hw2.policy, deeprl_hw2.preprocessors, '
+                        'deeprl_hw2.evaluation, deeprl_hw2.dqn, deeprl_hw2.export',
+    # everything the training script loads
+    'trainer': 'import deeprl_hw2.dqn, deeprl_hw2.parallel, deeprl_hw2.export, deeprl_hw2.profiling',
+}
+
+
+def measure_startup(repeats=5):
+    """Measure cold-start time of the CLI and RSS of fresh processes.
+
+    Returns
+    -------
+    dict
+      Median seconds of dqn_atari.py --help, and for every entry of
+      STARTUP_IMPORTS the median import seconds and peak RSS in MB.
+    """
+    import numpy as np
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    report = {}
+
+    times = []
+    for _ in xrange(repeats):
+        start = time.time()
+        subprocess.check_output([sys.executable, os.path.join(here, 'dqn_atari.py'), '--help'], cwd=here)
+        times.append(time.time() - start)
+    report['cli_help_s'] = float(np.median(times))
+
+    probe = ('import resource, time; start = time.time(); {}; '
+             'print time.time() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss')
+    for name, imports in sorted(STARTUP_IMPORTS.items()):
+        samples = [subprocess.check_output([sys.executable, '-c', probe.format(imports)], cwd=here).split()
+                   for _ in xrange(repeats)]
+        report[name + '_import_s'] = float(np.median([float(s) for s, _ in samples]))
+        report[name + '_rss_mb'] = float(np.median([int(rss) for _, rss in samples])) / 1024.0
+
+    return report
+
+
+def _owner(array):
+    """The array that owns the memory of array."""
+    while array.base is not None:
+        array = array.base
+    return array
+
+
+def measure_acting(num_steps, num_actions=6):
+    """Time the per-step state update of the acting loop, old and new.
+
+    Runs the synthetic env with random actions, the network being the
+    same in both variants, and builds the next state either with the
+    np.append stacking fit used to do ('append') or with StateStack
+    ('stack'). A second, untimed pass follows the memory owner of
+    every state returned: a state whose owner was not seen before is a
+    fresh allocation, its bytes are counted in alloc_kb_per_step.
+    The env and PIL allocations are not part of the state update and
+    are not counted.
+
+    Returns
+    -------
+    list(dict)
+      One entry per variant.
+    """
+    import weakref
+
+    import numpy as np
+    import gym
+
+    from deeprl_hw2 import synthetic
+    from deeprl_hw2.preprocessors import AtariPreprocessor
+    from deeprl_hw2.utils import StateStack, get_init_state
+
+    preprocessor = AtariPreprocessor((84, 84))
+    results = []
+    for variant in ('append', 'stack'):
+        env = gym.make(synthetic.ENV_NAME)
+        env.seed(0)
+        rng = np.random.RandomState(0)
+        init_state = get_init_state(env, preprocessor).astype(np.float32)
+        stack = StateStack(init_state)
+
+        def run(track):
+            env.reset()
+            state = stack.reset() if variant == 'stack' else init_state
+            # weak references, so owners that die are not kept alive
+            seen = [weakref.ref(_owner(state))]
+            alloc_bytes = 0
+            for _ in xrange(num_steps):
+                next_frame, _, is_terminal, _ = env.step(rng.randint(num_actions))
+                frame = preprocessor.process_state_for_memory(next_frame)
+                if variant == 'stack':
+                    state = stack.push(frame)
+                else:
+                    next_state = np.divide(frame, 255.0, dtype=np.float32)[:, :, np.newaxis]
+                    state = np.append(state[:, :, 1:], next_state, axis=2)
+
+                if track:
+                    owner = _owner(state)
+                    seen = [ref for ref in seen if ref() is not None]
+                    if not any(ref() is owner for ref in seen):
+                        alloc_bytes += owner.nbytes
+                        seen.append(weakref.ref(owner))
+
+                if is_terminal:
+                    env.reset()
+                    state = stack.reset() if variant == 'stack' else init_state
+            return alloc_bytes
+
+        start = time.time()
+        run(track=False)
+        seconds = time.time() - start
+        alloc_kb = run(track=True) / 1024.0 / num_steps
+
+        results.append({'variant': variant, 'steps_per_sec': num_steps / seconds, 'alloc_kb_per_step': alloc_kb})
+
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():  # noqa: D103
+    parser = argparse.ArgumentParser(description='Benchmark DQNAgent.fit on a synthetic Atari env')
+    parser.add_argument('--num_iterations', default=5000, type=int, help='Iterations of fit per configuration')
+    parser.add_argument('--num_burn_in', default=1000, type=int, help='Burn-in steps with experience replay')
+    parser.add_argument('--networks', default=','.join(NETWORKS), type=str, help='Comma separated network names')
+    parser.add_argument('--window', default=4, type=int, help='how many frames are used each time')
+    parser.add_argument('--batch_size', default=32, type=int, help='Batch size')
+    parser.add_argument('--train_freq', default=4, type=int, help='Frequency for training')
+    parser.add_argument('--target_update_freq', default=1000, type=int,
+                        help='Frequency for copying weights to target network')
+    parser.add_argument('--seed', default=0, type=int, help='Random seed')
+    parser.add_argument('-o', '--output', default='benchmark.json', type=str, help='JSON file to write')
+    parser.add_argument('--layout', default='default', type=str, help='Network layout, see create_model')
+    parser.add_argument('--layouts', action='store_true',
+                        help='Only measure forward/backward time of every network layout')
+    parser.add_argument('--burn_in', default='', type=str,
+                        help='Only measure the burn-in of num_burn_in steps for these comma separated worker counts')
+    parser.add_argument('--startup', action='store_true',
+                        help='Only measure CLI cold start and per-process import time / RSS')
+    parser.add_argument('--acting', action='store_true',
+                        help='Only measure the state update of the acting loop, old and new')
+    parser.add_argument('--max_alloc_kb_per_step', default=None, type=float,
+                        help='With --acting, exit non-zero if the new loop allocates more than this per step')
+    parser.add_argument('--large_batch', default='1', type=str,
+                        help='Comma separated batch scale factors, see dqn_atari.scale_large_batch')
+    parser.add_argument('--accumulate', action='store_true',
+                        help='Scale the batch with gradient accumulation instead of one large batch')
+    parser.add_argument('--lr_scaling', default='sqrt', type=str, help='Learning rate scaling of --large_batch')
+    parser.add_argument('--xla', action='store_true',
+                        help='Run every configuration without and with XLA JIT compilation')
+    parser.add_argument('--reward_threshold', default=None, type=float,
+                        help='Report the wall-clock time until the mean reward of 10 episodes reaches this')
+    # internal: run a single configuration and print its result
+    parser.add_argument('--network_name', default=None, type=str, help=argparse.SUPPRESS)
+    parser.add_argument('--experience_replay', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--xla_run', action='store_true', help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.network_name is not None:
+        args.large_batch = int(args.large_batch)
+        print json.dumps(run_config(args))
+        return
+
+    if args.layouts:
+        networks = [n for n in args.networks.split(',') if n != 'linear_q_network']
+        results = measure_layouts(networks, args.window, args.batch_size)
+        for result in results:
+            print json.dumps(result, sort_keys=True)
+        report = {'revision': git_revision(), 'host': platform.node(), 'layouts': results}
+        with open(args.output, 'w') as json_file:
+            json.dump(report, json_file, indent=2, sort_keys=True)
+        return
+
+    if args.burn_in:
+        from deeprl_hw2 import synthetic
+        from deeprl_hw2.burn_in import measure_burn_in
+        from deeprl_hw2.preprocessors import AtariPreprocessor
+
+        worker_counts = [int(n) for n in args.burn_in.split(',')]
+        results = measure_burn_in(synthetic.ENV_NAME, AtariPreprocessor((84, 84)), (84, 84), args.num_burn_in,
+                                  worker_counts, args.window)
+        for result in results:
+            print "{num_workers} worker(s): {seconds:.2f} s to first update, {steps_per_sec:.0f} steps/s".format(
+                **result)
+        report = {'revision': git_revision(), 'host': platform.node(), 'burn_in': results}
+        with open(args.output, 'w') as json_file:
+            json.dump(report, json_file, indent=2, sort_keys=True)
+        return
+
+    if args.startup:
+        results = measure_startup()
+        for name, value in sorted(results.items()):
+            print "{}: {:.3f}".format(name, value)
+        report = {'revision': git_revision(), 'host': platform.node(), 'startup': results}
+        with open(args.output, 'w') as json_file:
+            json.dump(report, json_file, indent=2, sort_keys=True)
+        return
+
+    if args.acting:
+        results = measure_acting(args.num_iterations)
+        for result in results:
+            print "{variant}: {steps_per_sec:.0f} steps/s, {alloc_kb_per_step:.2f} KB of states allocated per " \
+              "step".format(**result)
+        report = {'revision': git_revision(), 'host': platform.node(), 'acting': results}
+        with open(args.output, 'w') as json_file:
+            json.dump(report, json_file, indent=2, sort_keys=True)
+        alloc_kb = results[-1]['alloc_kb_per_step']
+        if args.max_alloc_kb_per_step is not None and alloc_kb > args.max_alloc_kb_per_step:
+            sys.exit("The acting loop allocates {:.1f} KB per step, more than {:.1f} KB".format(
+                alloc_kb, args.max_alloc_kb_per_step))
+        return
+
+    results = []
+    factors = [int(f) for f in args.large_batch.split(',')]
+    configs = [(network_name, experience_replay, factor, xla)
+               for network_name in args.networks.split(',')
+               for experience_replay in (False, True)
+               # larger batches only make sense with experience replay
+               for factor in (factors if experience_replay else [1])
+               for xla in ((False, True) if args.xla else (False, ))]
+    for network_name, experience_replay, factor, xla in configs:
+        command = [sys.executable, os.path.abspath(__file__), '--network_name', network_name,
+                   '--num_iterations', str(args.num_iterations), '--num_burn_in', str(args.num_burn_in),
+                   '--window', str(args.window), '--batch_size', str(args.batch_size),
+                   '--train_freq', str(args.train_freq), '--target_update_freq', str(args.target_update_freq),
+                   '--seed', str(args.seed), '--layout', args.layout, '--large_batch', str(factor),
+                   '--lr_scaling', args.lr_scaling]
+        if experience_replay:
+            command.append('--experience_replay')
+        if args.accumulate:
+            command.append('--accumulate')
+        if xla:
+            command.append('--xla_run')
+        if args.reward_threshold is not None:
+            command += ['--reward_threshold', str(args.reward_threshold)]
+
+        print "Running " + network_name + (" with" if experience_replay else " without") + \
+              " experience replay, batch x{}".format(factor) + (", XLA" if xla else "")
+        output = subprocess.check_output(command)
+        result = json.loads(output.strip().splitlines()[-1])
+        print "  {frames_per_sec:.1f} frames/s, {updates_per_sec:.1f} updates/s, " \
+              "peak RSS {peak_rss_mb:.0f} MB, reward threshold after {time_to_threshold_s} s, " \
+              "warm-up {warm_up_s:.1f} s".format(**result)
+        results.append(result)
+
+    report = {'revision': git_revision(),
+              'host': platform.node(),
+              'machine': platform.machine(),
+              'cpu_count': multiprocessing.cpu_count(),
+              'config': dict((k, v) for k, v in vars(args).items()
+                             if k not in ('network_name', 'experience_replay', 'xla_run')),
+              'results': results}
+
+    with open(args.output, 'w') as json_file:
+        json.dump(report, json_file, indent=2, sort_keys=True)
+    print "Wrote " + args.output
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,6 @@
-from . import core
-from . import dqn
-from . import objectives
-from . import policy
-from . import preprocessors
-from . import utils
\ No newline at end of file
+"""Library for 10-703 Homework 2.
+
+Submodules are not imported here, import the ones you need (e.g.
+deeprl_hw2.dqn) so that processes which only act or preprocess do not
+load TensorFlow, Keras or gym.
+"""
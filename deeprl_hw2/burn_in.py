@@ -0,0 +1,135 @@
+"""Fill the replay memory with random-policy transitions in parallel.
+
+The burn-in steps are split between worker processes, each with its
+own environment, env seed and action RNG. Every worker preprocesses
+its frames and writes its transitions into its own contiguous slice of
+shared arrays, so the parent merges the results with bulk copies and
+nothing but the exit code crosses a pipe.
+"""
+
+import multiprocessing
+import time
+
+import numpy as np
+
+
+def _shared_array(typecode, dtype, shape):
+    raw = multiprocessing.RawArray(typecode, int(np.prod(shape)))
+    return np.frombuffer(raw, dtype=dtype).reshape(shape)
+
+
+def _collect_loop(env_name, preprocessor, seed, frames, actions, rewards, terminals):
+    """Run random actions, store what fit would append to the memory."""
+    import gym
+
+    env = gym.make(env_name)
+    env.seed(seed)
+    rng = np.random.RandomState(seed)
+    num_actions = env.action_space.n
+
+    env.reset()
+    prev_lives = env.env.ale.lives()
+    for i in xrange(len(actions)):
+        action = rng.randint(num_actions)
+        next_frame, reward, is_terminal, _ = env.step(action)
+
+        # same reward shaping and life terminals as DQNAgent.fit
+        curr_lives = env.env.ale.lives()
+        life_terminal = curr_lives < prev_lives
+        if curr_lives < prev_lives:
+            reward = -5.0
+        elif curr_lives > prev_lives:
+            reward = 50.0
+        prev_lives = curr_lives
+
+        frames[i] = preprocessor.process_state_for_memory(next_frame)
+        actions[i] = action
+        rewards[i] = preprocessor.process_reward(reward)
+        terminals[i] = life_terminal or is_terminal
+
+        if is_terminal:
+            env.reset()
+            prev_lives = env.env.ale.lives()
+
+    # the next worker's slice starts a new episode
+    terminals[-1] = True
+
+
+def collect_random(env_name, preprocessor, frame_shape, num_steps, num_workers, seed=0):
+    """Collect num_steps random-policy transitions with num_workers processes.
+
+    The workers are forked from the calling process and only use gym,
+    numpy and the preprocessor, never the TensorFlow session.
+
+    Parameters
+    ----------
+    env_name: str
+      Passed to gym.make in every worker.
+    preprocessor: deeprl_hw2.preprocessors.AtariPreprocessor
+      Turns the raw frames into the frames stored in the memory.
+    frame_shape: tuple
+      Shape of a preprocessed frame, e.g. (84, 84).
+    seed: int
+      Worker i uses seed + i for its env and its actions.
+
+    Returns
+    -------
+    (np.ndarray, np.ndarray, np.ndarray, np.ndarray)
+      The frames, actions, rewards and terminals, in worker order. The
+      last transition of every worker is terminal.
+    """
+    frames = _shared_array('B', np.uint8, (num_steps, ) + tuple(frame_shape))
+    actions = _shared_array('i', np.int32, (num_steps, ))
+    rewards = _shared_array('f', np.float32, (num_steps, ))
+    terminals = _shared_array('B', np.bool_, (num_steps, ))
+
+    bounds = np.linspace(0, num_steps, num_workers + 1).astype(int)
+    workers = []
+    for i in xrange(num_workers):
+        part = slice(bounds[i], bounds[i + 1])
+        workers.append(multiprocessing.Process(target=_collect_loop,
+                                               args=(env_name, preprocessor, seed + i, frames[part],
+                                                     actions[part], rewards[part], terminals[part])))
+    for process in workers:
+        process.daemon = True
+        process.start()
+    for process in workers:
+        process.join()
+        if process.exitcode != 0:
+            raise RuntimeError('Burn-in worker failed with exit code ' + str(process.exitcode))
+
+    return frames, actions, rewards, terminals
+
+
+def measure_burn_in(env_name, preprocessor, frame_shape, num_steps, worker_counts, window=4):
+    """Measure the time until the memory is filled, serially and in parallel.
+
+    One worker runs the collection in the calling process, the way fit
+    does without burn_in_workers.
+
+    Returns
+    -------
+    list(dict)
+      One entry per worker count with the keys num_workers, seconds
+      and steps_per_sec.
+    """
+    from deeprl_hw2.core import ReplayMemory
+
+    report = []
+    for num_workers in worker_counts:
+        memory = ReplayMemory(num_steps, window)
+        start = time.time()
+        if num_workers == 1:
+            frames, actions, rewards, terminals = (np.empty((num_steps, ) + tuple(frame_shape), np.uint8),
+                                                   np.empty(num_steps, np.int32), np.empty(num_steps, np.float32),
+                                                   np.empty(num_steps, np.bool_))
+            _collect_loop(env_name, preprocessor, 0, frames, actions, rewards, terminals)
+        else:
+            frames, actions, rewards, terminals = collect_random(env_name, preprocessor, frame_shape, num_steps,
+                                                                 num_workers)
+        memory.extend(frames, actions, rewards, terminals)
+        elapsed = time.time() - start
+
+        report.append({'num_workers': num_workers, 'seconds': elapsed, 'steps_per_sec': num_steps / elapsed})
+
+    return report
@@ -0,0 +1,188 @@
+"""Asynchronous, atomic checkpoint writer with a retention policy.
+
+Saving only snapshots the model into memory on the training thread.
+A background thread writes the <name>.json / <name>.h5 pair to
+temporary files and renames them into place, so a reader never sees a
+half written checkpoint, and then deletes the checkpoints that fall
+out of the retention policy.
+"""
+
+import os
+import threading
+import time
+from Queue import Queue
+
+import numpy as np
+
+
+def snapshot_model(model):
+    """Copy the architecture and weights of model into memory.
+
+    Returns
+    -------
+    (str, list)
+      The model JSON and a (layer name, weight names, weight values)
+      entry for every layer, in the order keras saves them.
+    """
+    import keras.backend as K
+
+    layers = []
+    for layer in model.layers:
+        values = K.batch_get_value(layer.weights)
+        layers.append((layer.name, [w.name for w in layer.weights], values))
+
+    return model.to_json(), layers
+
+
+def write_weights(path, layers):
+    """Write snapshot_model layers in the format of Model.save_weights."""
+    import h5py
+    import keras
+
+    with h5py.File(path, 'w') as f:
+        f.attrs['layer_names'] = [name.encode('utf8') for name, _, _ in layers]
+        f.attrs['backend'] = keras.backend.backend().encode('utf8')
+        f.attrs['keras_version'] = str(keras.__version__).encode('utf8')
+
+        for layer_name, weight_names, values in layers:
+            group = f.create_group(layer_name)
+            group.attrs['weight_names'] = [name.encode('utf8') for name in weight_names]
+            for name, value in zip(weight_names, values):
+                dataset = group.create_dataset(name, value.shape, dtype=value.dtype)
+                if value.shape:
+                    dataset[:] = value
+                else:
+                    dataset[()] = value
+
+
+class CheckpointWriter:
+    """Writes checkpoints in a background thread.
+
+    Parameters
+    ----------
+    output_folder: str
+      Folder the <name>.json / <name>.h5 pairs are written to.
+    keep_last: int, optional
+      Keep only the keep_last most recent checkpoints (plus the best
+      ones). No recency limit if None.
+    keep_best: int
+      Always keep the keep_best checkpoints with the highest score.
+      Without keep_last only these and the unscored checkpoints,
+      which cannot be ranked, are kept.
+    max_pending: int
+      Snapshots waiting to be written before save blocks.
+    """
+
+    extensions = ('.json', '.h5')
+
+    def __init__(self, output_folder, keep_last=None, keep_best=0, max_pending=2):
+        self.output_folder = output_folder
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.stall_times = []
+
+        self._saved = []
+        self._error = None
+        self._queue = Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def save(self, name, model, score=None):
+        """Snapshot model and queue it to be written as name.
+
+        Parameters
+        ----------
+        name: str
+          Checkpoint name, usually the iteration.
+        model: keras.models.Model
+          The model to save.
+        score: float, optional
+          Used by keep_best, e.g. the average evaluation reward.
+
+        Returns
+        -------
+        float:
+          Seconds the calling thread was stalled.
+        """
+        self._raise_error()
+
+        start = time.time()
+        model_json, layers = snapshot_model(model)
+        self._queue.put((str(name), model_json, layers, score))
+        stall = time.time() - start
+
+        self.stall_times.append(stall)
+        return stall
+
+    def close(self):
+        """Wait until all queued checkpoints are written."""
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_error()
+
+    def stall_report(self):
+        """Return the mean and max stall in milliseconds."""
+        if not self.stall_times:
+            return 0.0, 0.0
+        return 1000 * np.mean(self.stall_times), 1000 * np.max(self.stall_times)
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def _path(self, name, ext):
+        return os.path.join(self.output_folder, name + ext)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if self._error is not None:
+                continue
+
+            name, model_json, layers, score = item
+            try:
+                self._write(name, model_json, layers)
+                self._saved.append((name, score))
+                self._apply_retention()
+            except Exception as e:
+                self._error = e
+
+    def _write(self, name, model_json, layers):
+        json_path = self._path(name, '.json')
+        with open(json_path + '.tmp', 'w') as json_file:
+            json_file.write(model_json)
+        os.rename(json_path + '.tmp', json_path)
+
+        weights_path = self._path(name, '.h5')
+        write_weights(weights_path + '.tmp', layers)
+        os.rename(weights_path + '.tmp', weights_path)
+
+    def _required(self, names):
+        """Return names plus the checkpoints they need to be loaded."""
+        return names
+
+    def _apply_retention(self):
+        if self.keep_last is None and self.keep_best <= 0:
+            return
+
+        if self.keep_last is None:
+            keep = set(name for name, score in self._saved if score is None)
+        elif self.keep_last > 0:
+            keep = set(name for name, _ in self._saved[-self.keep_last:])
+        else:
+            keep = set()
+        if self.keep_best > 0:
+            scored = [(score, name) for name, score in self._saved if score is not None]
+            keep.update(name for _, name in sorted(scored, reverse=True)[:self.keep_best])
+
+        keep = self._required(keep)
+        for name, _ in self._saved:
+            if name not in keep:
+                for ext in self.extensions:
+                    if os.path.exists(self._path(name, ext)):
+                        os.remove(self._path(name, ext))
+
+        self._saved = [(name, score) for name, score in self._saved if name in keep]
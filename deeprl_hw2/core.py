@@ -201,7 +201,7 @@ class ReplayMemory:
       Reset the memory. Deletes all references to the samples.
     """
 
-    def __init__(self, max_size, window_length):
+    def __init__(self, max_size, window_length, frame_shape=(84, 84), max_bytes=None, shrink=True):
         """Setup memory.
 
         You should specify the maximum size of the memory. Once the
@@ -209,45 +209,114 @@ class ReplayMemory:
         the collections.deque class as the underlying storage, but
         your sample method will be very slow.
 
-        We recommend using a list as a ring buffer. Just track the
-        index where the next sample should be inserted in the list.
+        The frames, actions, rewards and terminal flags are kept in
+        preallocated arrays used as a ring buffer, so the footprint is
+        max_size * slot_bytes(frame_shape) and known up front.
+
+        Parameters
+        ----------
+        frame_shape: tuple
+          Shape of the uint8 frames given to append.
+        max_bytes: int, optional
+          Budget of the arrays. If max_size transitions do not fit,
+          max_size is shrunk to what fits, or a ValueError is raised
+          when shrink is False.
         """
+        slot_bytes = self.slot_bytes(frame_shape)
+        if max_bytes is not None and max_size * slot_bytes > max_bytes:
+            fitting = int(max_bytes // slot_bytes)
+            message = 'A replay memory of {} transitions needs {:.1f} MB, the budget is {:.1f} MB'.format(
+                max_size, max_size * slot_bytes / 2.0 ** 20, max_bytes / 2.0 ** 20)
+            if not shrink or fitting <= window_length + 1:
+                raise ValueError(message)
+            print message + ", shrinking it to {} transitions".format(fitting)
+            max_size = fitting
+
         self.max_size = max_size
         self.window_length = window_length
         self.index = 0
-        self._samples = []
-        self._terminal = set()
+        self._size = 0
+        self._frames = np.zeros((max_size, ) + tuple(frame_shape), dtype=np.uint8)
+        self._actions = np.zeros(max_size, dtype=np.int32)
+        self._rewards = np.zeros(max_size, dtype=np.float32)
+        self._terminals = np.zeros(max_size, dtype=bool)
+        self.last_indexes = None
 
         # Helper variables for merging flickering frames
         self.prev_frame = None
         self.prev_terminal = True
 
+    @staticmethod
+    def slot_bytes(frame_shape):
+        """Bytes used per transition: frame, action, reward and terminal flag."""
+        return int(np.prod(frame_shape)) + 4 + 4 + 1
+
+    def memory_usage(self):
+        """Return the bytes used by the stored transitions.
+
+        Returns
+        -------
+        dict
+          frames, metadata (actions and rewards) and index (terminal
+          flags and sampled slots) of the filled slots, their total,
+          and reserved, the size of the preallocated arrays. The
+          untouched part of the arrays is normally not resident yet.
+        """
+        frame_bytes = self._frames[0].nbytes
+        usage = {'frames': self._size * frame_bytes,
+                 'metadata': self._size * (self._actions.itemsize + self._rewards.itemsize),
+                 'index': self._size * self._terminals.itemsize +
+                          (self.last_indexes.nbytes if self.last_indexes is not None else 0)}
+        usage['total'] = sum(usage.values())
+        usage['reserved'] = self._frames.nbytes + self._actions.nbytes + self._rewards.nbytes + \
+            self._terminals.nbytes
+        return usage
+
     def append(self, next_frame, action, reward, is_terminal):
         # Maximizing over the previous frame to remove flickering
-        if self.prev_terminal:
-            new_frame = np.maximum(next_frame, self.prev_frame)
-            sample = Sample(new_frame, action, reward)
+        if self.prev_terminal and self.prev_frame is not None:
+            self._frames[self.index] = np.maximum(next_frame, self.prev_frame)
         else:
-            sample = Sample(next_frame, action, reward)
+            self._frames[self.index] = next_frame
+        self._actions[self.index] = action
+        self._rewards[self.index] = reward
+        self._terminals[self.index] = is_terminal
 
         self.prev_terminal = is_terminal
         self.prev_frame = next_frame
 
         # use ring buffer to append data sample to memory
-        if is_terminal:
-            self._end_episode(self.index)
-        elif self.index in self._terminal:
-            self._terminal.remove(self.index)
-
-        if len(self._samples) == self.max_size:
-            self._samples[self.index] = sample
-        else:
-            self._samples.append(sample)
-
         self.index = (self.index + 1) % self.max_size
+        self._size = min(self._size + 1, self.max_size)
 
-    def _end_episode(self, final_index):
-        self._terminal.add(final_index)
+    def extend(self, frames, actions, rewards, is_terminals):
+        """Append a run of transitions, same as append for each of them.
+
+        The run is copied into the ring buffer with array copies.
+        """
+        frames = np.asarray(frames)
+        is_terminals = np.asarray(is_terminals, dtype=bool)
+        n = len(is_terminals)
+
+        # the flickering merge of append, for every first frame of an episode
+        stored = frames.astype(np.uint8)
+        first = np.flatnonzero(is_terminals[:-1]) + 1
+        stored[first] = np.maximum(frames[first], frames[first - 1])
+        if self.prev_terminal and self.prev_frame is not None:
+            stored[0] = np.maximum(frames[0], self.prev_frame)
+
+        # only the last max_size transitions survive a longer run
+        skip = max(n - self.max_size, 0)
+        slots = (self.index + np.arange(skip, n)) % self.max_size
+        self._frames[slots] = stored[skip:]
+        self._actions[slots] = np.asarray(actions)[skip:]
+        self._rewards[slots] = np.asarray(rewards)[skip:]
+        self._terminals[slots] = is_terminals[skip:]
+
+        self.prev_terminal = bool(is_terminals[-1])
+        self.prev_frame = frames[-1]
+        self.index = (self.index + n) % self.max_size
+        self._size = min(self._size + n, self.max_size)
 
     def is_valid_index(self, x):
         """
@@ -258,45 +327,95 @@ class ReplayMemory:
         """
         if self.index - 4 <= x <= self.index:
             return False
-            
-        return (x not in self._terminal) and \
-               (x + 1 % self.max_size not in self._terminal) and \
-               (x + 2 % self.max_size not in self._terminal) and \
-               (x + 3 % self.max_size not in self._terminal)
+
+        return not self._terminals[x:x + 4].any()
 
     def sample(self, batch_size, index=None):
         random_indexes = set()
         # Select batch size valid indexes
         while len(random_indexes) < batch_size:
-            new_random_indexes = random.sample(xrange(len(self._samples) - 4), batch_size - len(random_indexes))
+            new_random_indexes = random.sample(xrange(len(self) - 4), batch_size - len(random_indexes))
             new_random_indexes = filter(self.is_valid_index, new_random_indexes)
             random_indexes = random_indexes.union(new_random_indexes)
 
-        # construct current states, next states, actions, rewards by stacking
-        # different fields of the samples together
-        random_samples = []
-        not_terminal = []
-        for i in random_indexes:
-            random_samples.append(self._samples[i:i + 5])
-            not_terminal.append(False if i + 4 % self.max_size in self._terminal else True)
+        # slots of the batch rows, e.g. for the target q value cache
+        indexes = np.array(list(random_indexes))
+        self.last_indexes = indexes
 
-        states = np.stack([np.stack([s.frame / 255.0 for s in samples[:4]], axis=2) for samples in random_samples])
-        next_states = np.stack([np.stack([s.frame / 255.0 for s in samples[1:]], axis=2) for samples in random_samples])
-        actions = np.stack([s[-1].action for s in random_samples])
-        rewards = np.stack([s[-1].reward for s in random_samples])
+        # gather the 5 frames of every sample at once, (B, H, W, 5)
+        frames = self._frames[indexes[:, np.newaxis] + np.arange(5)].transpose(0, 2, 3, 1)
+        frames = frames.astype(np.float32) / 255.0
+        states = frames[..., :4]
+        next_states = frames[..., 1:]
+        actions = self._actions[indexes + 4]
+        rewards = self._rewards[indexes + 4]
+        not_terminal = ~self._terminals[indexes + 4]
 
         return (states, next_states, actions, rewards, not_terminal)
 
+    def is_valid_compact_index(self, x):
+        """Check whether x can start a shared-frame sample.
+
+        Unlike is_valid_index, the state window may cross an episode
+        boundary (the frames of the previous episode get masked in
+        sample_compact). Only the transition out of the last state
+        frame has to stay inside one episode, and the window must not
+        overlap the write head of the ring buffer.
+        """
+        if self.index - self.window_length <= x <= self.index:
+            return False
+
+        return not self._terminals[(x + self.window_length - 1) % self.max_size]
+
+    def sample_compact(self, batch_size):
+        """Sample a batch as one shared (B, H, W, window + 1) frame block.
+
+        The state is frames[..., :window] and the next state is
+        frames[..., 1:], so the window - 1 frames the two stacks have
+        in common are gathered and fed only once. Frames that belong
+        to a previous episode are zeroed. While acting, the first
+        states of an episode are instead filled with the real frames
+        of get_init_state, so these padded states differ from the
+        ones the network acted on.
+
+        Returns
+        -------
+        (frames, actions, rewards, not_terminal)
+        """
+        random_indexes = set()
+        while len(random_indexes) < batch_size:
+            new_random_indexes = random.sample(xrange(len(self) - self.window_length),
+                                               batch_size - len(random_indexes))
+            new_random_indexes = filter(self.is_valid_compact_index, new_random_indexes)
+            random_indexes = random_indexes.union(new_random_indexes)
+
+        window = self.window_length
+        indexes = np.array(list(random_indexes))
+        self.last_indexes = indexes
+
+        frames = self._frames[indexes[:, np.newaxis] + np.arange(window + 1)].astype(np.float32)
+
+        # everything up to the last terminal frame of the state window
+        # comes from a previous episode and is zeroed
+        terminals = self._terminals[indexes[:, np.newaxis] + np.arange(window - 1)]
+        previous_episode = np.cumsum(terminals[:, ::-1], axis=1)[:, ::-1] > 0
+        frames[:, :window - 1][previous_episode] = 0
+
+        last = indexes + window
+        frames = frames.transpose(0, 2, 3, 1) / 255.0
+
+        return (frames, self._actions[last], self._rewards[last], ~self._terminals[last])
+
     def clear(self):
-        self._samples = []
-        self._terminal = set()
+        self._terminals[:] = False
+        self._size = 0
         self.index = 0
 
     def __iter__(self):
-        return iter(self._samples)
+        return (self[i] for i in xrange(len(self)))
 
     def __getitem__(self, key):
-        return self._samples[key]
+        return Sample(self._frames[key], self._actions[key], self._rewards[key])
 
     def __len__(self):
-        return len(self._samples)
+        return self._size
@@ -0,0 +1,108 @@
+"""Recorded transition datasets on disk.
+
+A dataset is a directory of HDF5 shards named shard_<n>.h5. Each shard
+holds a contiguous run of the transitions the agent appended to its
+replay memory, in append order, continuing where the previous shard
+stopped:
+
+- frames: (N, height, width) uint8, the frame given to memory.append
+- actions: (N, ) int32
+- rewards: (N, ) float32, after process_reward
+- terminals: (N, ) bool
+
+The shard attributes record num_actions and env_name. The datasets are
+chunked and compressed, so a shard can be read chunk by chunk.
+"""
+
+import os
+import threading
+from Queue import Queue
+
+SHARD_PATTERN = 'shard_{:05d}.h5'
+FIELDS = ('frames', 'actions', 'rewards', 'terminals')
+
+
+def list_shards(directory):
+    """Return the shard paths of a dataset in recording order."""
+    names = sorted(name for name in os.listdir(directory) if name.startswith('shard_') and name.endswith('.h5'))
+    return [os.path.join(directory, name) for name in names]
+
+
+class ShardReader:
+    """Streams a recorded dataset chunk by chunk with bounded memory.
+
+    A background thread reads the next chunks while the learner
+    trains, at most prefetch chunks are held in memory at any time, so
+    datasets larger than RAM can be streamed. An error in the thread,
+    e.g. a truncated shard, is raised again by chunks.
+
+    Parameters
+    ----------
+    directory: str
+      The dataset directory.
+    chunk_size: int
+      Transitions per chunk.
+    prefetch: int
+      Chunks read ahead of the consumer.
+    loop: bool
+      Start over at the first shard after the last one. The last
+      transition of each pass is marked terminal so no sample crosses
+      from the end of the dataset to its start.
+    """
+
+    def __init__(self, directory, chunk_size=4096, prefetch=2, loop=False):
+        import h5py
+
+        self.shards = list_shards(directory)
+        if not self.shards:
+            raise ValueError('No shards found in ' + directory)
+
+        with h5py.File(self.shards[0], 'r') as f:
+            self.num_actions = int(f.attrs['num_actions'])
+            self.env_name = f.attrs.get('env_name')
+
+        self.chunk_size = chunk_size
+        self.loop = loop
+        self._queue = Queue(maxsize=prefetch)
+        self._thread = threading.Thread(target=self._read)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _read_pass(self):
+        import h5py
+
+        for shard_index, path in enumerate(self.shards):
+            with h5py.File(path, 'r') as f:
+                size = len(f['actions'])
+                for start in xrange(0, size, self.chunk_size):
+                    chunk = tuple(f[field][start:start + self.chunk_size] for field in FIELDS)
+                    if shard_index == len(self.shards) - 1 and start + self.chunk_size >= size:
+                        chunk[3][-1] = True
+                    self._queue.put(chunk)
+
+    def _read(self):
+        try:
+            self._read_pass()
+            while self.loop:
+                self._read_pass()
+        except Exception as e:
+            # hand it to the consumer, which would wait forever otherwise
+            self._queue.put(e)
+            return
+        self._queue.put(None)
+
+    def chunks(self):
+        """Yield (frames, actions, rewards, terminals) chunks."""
+        while True:
+            chunk = self._queue.get()
+            if chunk is None:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+
+    def transitions(self):
+        """Yield single (frame, action, reward, is_terminal) transitions."""
+        for frames, actions, rewards, terminals in self.chunks():
+            for i in xrange(len(actions)):
+                yield frames[i], actions[i], rewards[i], bool(terminals[i])
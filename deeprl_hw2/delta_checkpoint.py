@@ -0,0 +1,185 @@
+"""Delta-compressed checkpoint store.
+
+The save_freq checkpoints of a run differ only a little from each
+other, so instead of a .json / .h5 pair per checkpoint the store
+writes:
+
+- model.json, the architecture, once per folder
+- <name>.ckpt.h5 per checkpoint. Every keyframe_every-th checkpoint is
+  a keyframe holding the weights themselves. The others hold the XOR of
+  their weight bits with the bits of the previous keyframe, which is
+  lossless and mostly zeros for weights that moved little. The datasets
+  are shuffled and gzip compressed, which is where the zeros pay off.
+
+A checkpoint loads into an already built model by assigning the weights
+in place. No JSON parsing and no model construction is needed, so many
+checkpoints can be evaluated one after the other in one graph.
+"""
+
+import os
+import time
+
+import numpy as np
+
+from deeprl_hw2.checkpoint import CheckpointWriter
+
+MODEL_JSON = 'model.json'
+EXTENSION = '.ckpt.h5'
+
+
+def _bits(value):
+    """View value as unsigned integers of the same width."""
+    return value.view(np.dtype('u{}'.format(value.dtype.itemsize)))
+
+
+class DeltaCheckpointWriter(CheckpointWriter):
+    """CheckpointWriter writing the delta-compressed format.
+
+    Parameters
+    ----------
+    keyframe_every: int
+      Every keyframe_every-th checkpoint stores the full weights.
+
+    The other parameters are those of CheckpointWriter. The retention
+    policy never removes a keyframe that a kept checkpoint needs.
+    """
+
+    extensions = (EXTENSION, )
+
+    def __init__(self, output_folder, keyframe_every=10, keep_last=None, keep_best=0, max_pending=2):
+        self.keyframe_every = keyframe_every
+        self._num_written = 0
+        self._keyframe = None
+        self._keyframe_of = {}
+        CheckpointWriter.__init__(self, output_folder, keep_last, keep_best, max_pending)
+
+    def _write(self, name, model_json, layers):
+        import h5py
+
+        json_path = os.path.join(self.output_folder, MODEL_JSON)
+        if not os.path.exists(json_path):
+            with open(json_path + '.tmp', 'w') as json_file:
+                json_file.write(model_json)
+            os.rename(json_path + '.tmp', json_path)
+
+        is_keyframe = self._num_written % self.keyframe_every == 0
+        if is_keyframe:
+            self._keyframe = (name, dict((layer_name, values) for layer_name, _, values in layers))
+        keyframe_name, keyframe_values = self._keyframe
+
+        path = self._path(name, EXTENSION)
+        with h5py.File(path + '.tmp', 'w') as f:
+            f.attrs['keyframe'] = keyframe_name
+            for layer_name, weight_names, values in layers:
+                group = f.create_group(layer_name)
+                group.attrs['weight_names'] = [w.encode('utf8') for w in weight_names]
+                for i, value in enumerate(values):
+                    if not is_keyframe:
+                        value = _bits(value) ^ _bits(keyframe_values[layer_name][i])
+                    group.create_dataset(str(i), data=value, compression='gzip' if value.shape else None,
+                                         shuffle=bool(value.shape))
+        os.rename(path + '.tmp', path)
+
+        self._keyframe_of[name] = keyframe_name
+        self._num_written += 1
+
+    def _required(self, names):
+        return set(names) | set(self._keyframe_of[name] for name in names if name in self._keyframe_of)
+
+
+class CheckpointStore:
+    """Reads a folder written by DeltaCheckpointWriter.
+
+    The last keyframe read is cached, so loading the checkpoints that
+    share it only reads their own (small) files.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self._keyframe = (None, None)
+
+    def model_json(self):
+        with open(os.path.join(self.folder, MODEL_JSON), 'r') as json_file:
+            return json_file.read()
+
+    def names(self):
+        """Checkpoint names in the folder, in saving order if they are iterations."""
+        names = [f[:-len(EXTENSION)] for f in os.listdir(self.folder) if f.endswith(EXTENSION)]
+        return sorted(names, key=lambda n: (len(n), n))
+
+    def _read(self, name):
+        import h5py
+
+        with h5py.File(os.path.join(self.folder, name + EXTENSION), 'r') as f:
+            keyframe = f.attrs['keyframe']
+            values = dict((layer_name, [group[str(i)][()] for i in xrange(len(group.attrs['weight_names']))])
+                          for layer_name, group in f.items())
+        return keyframe, values
+
+    def weights(self, name):
+        """Return {layer name: [weight values]} of checkpoint name."""
+        keyframe, values = self._read(name)
+        if keyframe == name:
+            self._keyframe = (name, values)
+            return values
+
+        if self._keyframe[0] != keyframe:
+            self._keyframe = (keyframe, self._read(keyframe)[1])
+        keyframe_values = self._keyframe[1]
+
+        return dict((layer_name, [(_bits(k) ^ d).view(k.dtype) for k, d in zip(keyframe_values[layer_name], deltas)])
+                    for layer_name, deltas in values.items())
+
+    def load(self, name, *models):
+        """Assign the weights of checkpoint name to models, in place."""
+        import keras.backend as K
+
+        values = self.weights(name)
+        assignments = []
+        for model in models:
+            for layer in model.layers:
+                if layer.weights:
+                    assignments.extend(zip(layer.weights, values[layer.name]))
+        K.batch_set_value(assignments)
+
+    def disk_usage(self):
+        """Return the bytes of the store and of the raw weights it holds.
+
+        Returns
+        -------
+        dict
+          store_mb, the files in the folder, and raw_mb, what one .h5
+          per checkpoint would take at least.
+        """
+        files = [MODEL_JSON] + [name + EXTENSION for name in self.names()]
+        store = sum(os.path.getsize(os.path.join(self.folder, f)) for f in files)
+
+        names = self.names()
+        raw = 0
+        if names:
+            raw = len(names) * sum(v.nbytes for values in self.weights(names[0]).values() for v in values)
+
+        return {'checkpoints': len(names), 'store_mb': store / 2.0 ** 20, 'raw_mb': raw / 2.0 ** 20}
+
+
+def measure_store(folder, model):
+    """Disk usage of a store and the time to load each checkpoint into model.
+
+    Returns
+    -------
+    dict
+      disk_usage() plus load_ms, the mean milliseconds to load one
+      checkpoint in saving order, and max_load_ms.
+    """
+    store = CheckpointStore(folder)
+    report = store.disk_usage()
+
+    load_times = []
+    for name in store.names():
+        start = time.time()
+        store.load(name, model)
+        load_times.append(time.time() - start)
+    report['load_ms'] = 1000 * np.mean(load_times) if load_times else 0.0
+    report['max_load_ms'] = 1000 * np.max(load_times) if load_times else 0.0
+
+    return report
@@ -1,15 +1,48 @@
+import time
+
 import tensorflow as tf
 import numpy as np
-import os
-import gym
-from gym import wrappers
-import matplotlib.pyplot as plt
-from pylab import *
 from utils import *
+from burn_in import collect_random
+from checkpoint import CheckpointWriter
+from evaluation import RunningStats, StoppingRule
+from metrics import NullMetrics
 
 """Main DQN agent."""
 
 
+def build_td_loss(q_values, num_actions, loss_func, max_grad):
+    """Build the loss of the q values of the taken actions.
+
+    Parameters
+    ----------
+    q_values: tf.Tensor
+      (batch, num_actions) output of the online network.
+    num_actions: int
+      Number of possible actions.
+    loss_func: callable
+      Loss of (y_true, y_pred, max_grad), e.g. mean_huber_loss.
+    max_grad: float
+      Parameter for the huber loss.
+
+    Returns
+    -------
+    (y_true, action, loss)
+      The target and action placeholders and the loss tensor.
+    """
+    # Placeholder that we want to feed the updat in, just one value
+    y_true = tf.placeholder(tf.float32, [None, ])
+    # Placeholder that specify which action
+    action = tf.placeholder(tf.int32, [None, ])
+    # Transform it to one hot representation
+    action_one_hot = tf.cast(tf.one_hot(action, depth=num_actions, on_value=1, off_value=0), tf.float32)
+
+    # the output of the q_network is y_pred
+    y_pred = tf.reduce_sum(tf.multiply(q_values, action_one_hot), axis=1)
+
+    return y_true, action, loss_func(y_true, y_pred, max_grad)
+
+
 class DQNAgent:
     """Class implementing DQN.
 
@@ -47,6 +80,64 @@ class DQNAgent:
       replay memory, for every Q-network update that you run.
     batch_size: int
       How many samples in each minibatch.
+    parallel_learner: deeprl_hw2.parallel.DataParallelLearner, optional
+      If set, each update samples batch_size samples per worker and
+      the gradients are computed by the learner's worker processes.
+    inference_client: optional
+      Anything with a calc_q_values(state) for a single state, e.g. a
+      deeprl_hw2.inference.InferenceClient or a
+      deeprl_hw2.export.FrozenQNetwork. If set, select_action uses it
+      instead of running the session itself, and q_networks may be
+      None when the agent is only evaluated.
+    checkpoint_writer: deeprl_hw2.checkpoint.CheckpointWriter, optional
+      Writes the save_freq checkpoints of fit in the background. If
+      not set, fit writes every checkpoint into its output folder.
+    metrics: deeprl_hw2.metrics.Metrics, optional
+      Receives the time of every phase of fit and the step / update
+      counts. Instrumentation is disabled if not set.
+    profiler: deeprl_hw2.profiling.Profiler, optional
+      Traces the session runs of update_policy / select_action and
+      profiles fit iterations when requested.
+    recorder: deeprl_hw2.recorder.TransitionRecorder, optional
+      Records every transition fit appends, as a dataset that
+      fit_offline can train from later.
+    burn_in_workers: int
+      Processes that collect the num_burn_in random-policy steps of
+      fit. With more than one, each worker runs its own env_name env
+      and the results are merged into the memory in one go.
+    target_cache: deeprl_hw2.target_cache.TargetQCache, optional
+      Caches the target q values of every sampled replay slot until
+      the next target sync or until the slot is overwritten, so a
+      slot sampled again only costs a lookup. Only used with
+      experience replay.
+    accumulate_steps: int
+      Micro-batches of batch_size whose gradients are summed before
+      one optimizer step, i.e. an update on accumulate_steps *
+      batch_size samples at the memory cost of batch_size. Only used
+      with experience replay and without a parallel learner.
+    eval_stopping: deeprl_hw2.evaluation.StoppingRule, optional
+      Decides how many episodes the evaluations of fit run, early
+      stopping against the best evaluation so far. Fixed 20 episodes
+      if not set.
+    replay_ratio_controller: deeprl_hw2.replay_ratio.ReplayRatioController, optional
+      Decides the number of updates after every env step of fit from
+      the measured step and update times, instead of one update every
+      train_freq steps. Only used with experience replay.
+    xla: bool
+      Build the action selection, loss and optimizer ops in a
+      jit_scope, so XLA compiles them. Build the networks with
+      jit_scope as well to compile the forward passes. fit runs
+      warm_up first, so the compilation stays out of the measured
+      phases. The varying miss batches of a target_cache are padded
+      to powers of two, which warm_up compiles as well.
+    seed: int
+      Seed of the parallel burn-in, worker i seeds its env and its
+      random actions with seed + i.
+    compact_batch: bool
+      Sample replay batches as one shared (B, H, W, window + 1) frame
+      block and slice the state / next state out of it in-graph,
+      instead of feeding two separate stacks. Only used together with
+      experience replay.
     """
 
     def __init__(self,
@@ -65,17 +156,36 @@ class DQNAgent:
                  network_name,
                  max_grad,
                  env_name,
-                 sess):
-
-        self.q_network_online, self.q_network_target = q_networks
-        self.target_vars = self.q_network_target.weights
-
-        self.q_values_online = self.q_network_online.output
-        self.q_values_target = self.q_network_target.output
-
-        # Input placeholders for both online and target network
-        self.state_online = self.q_network_online.input
-        self.state_target = self.q_network_target.input
+                 sess,
+                 compact_batch=False,
+                 parallel_learner=None,
+                 inference_client=None,
+                 checkpoint_writer=None,
+                 metrics=None,
+                 profiler=None,
+                 recorder=None,
+                 burn_in_workers=1,
+                 target_cache=None,
+                 accumulate_steps=1,
+                 eval_stopping=None,
+                 replay_ratio_controller=None,
+                 xla=False,
+                 seed=0):
+
+        self.q_network_online, self.q_network_target = q_networks or (None, None)
+        if self.q_network_online is not None:
+            self.target_vars = self.q_network_target.weights
+
+            self.q_values_online = self.q_network_online.output
+            self.q_values_target = self.q_network_target.output
+
+            # Input placeholders for both online and target network
+            self.state_online = self.q_network_online.input
+            self.state_target = self.q_network_target.input
+
+            # Greedy actions computed in-graph, so acting only fetches ints
+            with jit_scope(xla):
+                self.greedy_actions = tf.argmax(self.q_values_online, axis=1)
 
         self.preprocessor = preprocessor
         self.memory = memory
@@ -92,6 +202,22 @@ class DQNAgent:
         self.max_grad = max_grad
         self.env_name = env_name
         self.sess = sess
+        self.compact_batch = compact_batch and experience_replay and parallel_learner is None
+        self.parallel_learner = parallel_learner
+        self.inference_client = inference_client
+        self.checkpoint_writer = checkpoint_writer
+        self.metrics = metrics or NullMetrics()
+        self.profiler = profiler
+        self.recorder = recorder
+        self.burn_in_workers = burn_in_workers
+        self.target_cache = target_cache if experience_replay else None
+        self.accumulate_steps = accumulate_steps if experience_replay and parallel_learner is None else 1
+        self.eval_stopping = eval_stopping or StoppingRule(20, early_stop=False)
+        self.best_eval_reward = None
+        self.replay_ratio_controller = replay_ratio_controller if experience_replay else None
+        self.state_stack = None
+        self.xla = xla
+        self.seed = seed
 
     def compile(self, optimizer, loss_func):
         """Setup all of the TF graph variables/ops.
@@ -111,22 +237,89 @@ class DQNAgent:
         optimizer.
         """
 
-        with tf.variable_scope('optimizer'):
-            # print self.q_values_online.shape
-            # Placeholder that we want to feed the updat in, just one value
-            self.y_true = tf.placeholder(tf.float32, [None, ])
-            # Placeholder that specify which action
-            self.action = tf.placeholder(tf.int32, [None, ])
-            # Transform it to one hot representation
-            self.action_one_hot = tf.cast(tf.one_hot(self.action, depth=self.num_actions, \
-                                                     on_value=1, off_value=0), tf.float32)
+        with jit_scope(self.xla):
+            self._compile(optimizer, loss_func)
 
-            # the output of the q_network is y_pred
-            self.y_pred = tf.reduce_sum(tf.multiply(self.q_values_online, self.action_one_hot), axis=1)
+    def _compile(self, optimizer, loss_func):
+        # Predicted q values for the sampled states
+        q_values_batch = self.q_values_online
 
-            self.loss = loss_func(self.y_true, self.y_pred, self.max_grad)
+        if self.compact_batch:
+            # One frame block per sample, the networks slice out the
+            # state and the next state themselves
+            window = self.memory.window_length
+            frame_shape = self.state_online.get_shape().as_list()[1:-1]
+            self.frames = tf.placeholder(tf.float32, [None] + frame_shape + [window + 1])
 
-            self.optimizer = optimizer.minimize(self.loss)
+            q_values_batch = self.q_network_online(self.frames[..., :window])
+            self.q_values_online_next = self.q_network_online(self.frames[..., 1:])
+            self.q_values_target_next = self.q_network_target(self.frames[..., 1:])
+
+        with tf.variable_scope('optimizer'):
+            self.y_true, self.action, self.loss = build_td_loss(q_values_batch, self.num_actions,
+                                                                loss_func, self.max_grad)
+
+            if self.parallel_learner is not None:
+                # gradients come from the workers, only apply them here
+                self.parallel_learner.compile(self.sess, optimizer, self.q_network_online.trainable_weights)
+                self.optimizer = None
+            elif self.accumulate_steps > 1:
+                # sum the gradients of the micro-batches, apply their mean once
+                variables = self.q_network_online.trainable_weights
+                grads = tf.gradients(self.loss, variables)
+                accumulators = [tf.Variable(tf.zeros(v.get_shape(), dtype=v.dtype.base_dtype), trainable=False)
+                                for v in variables]
+                self.accumulate = [a.assign_add(g) for a, g in zip(accumulators, grads)]
+                self.optimizer = optimizer.apply_gradients([(a / self.accumulate_steps, v)
+                                                            for a, v in zip(accumulators, variables)])
+                with tf.control_dependencies([self.optimizer]):
+                    self.apply_and_reset = tf.group(*[a.assign(tf.zeros_like(a)) for a in accumulators])
+            else:
+                self.optimizer = optimizer.minimize(self.loss)
+
+    def warm_up(self, num_calls=2):
+        """Run the session graphs of fit on dummy batches, weights unchanged.
+
+        XLA compiles a cluster on its first run with a new input
+        shape, so every shape fit feeds is run here once: a single
+        state for acting, a batch for the target q values and the
+        update, and with a target_cache every padded size of the
+        missed rows. All variables, optimizer slots included, are restored
+        afterwards.
+        """
+        variables = tf.global_variables()
+        values = self.sess.run(variables)
+
+        # without experience replay an update is on the last train_freq steps
+        batch_size = self.batch_size if self.experience_replay else self.train_freq
+        window = self.state_online.get_shape().as_list()[-1]
+        shape = self.state_online.get_shape().as_list()[1:-1]
+        channels = window + 1 if self.compact_batch else window
+        states = np.zeros([batch_size] + shape + [channels], dtype=np.float32)
+        actions = np.zeros(batch_size, dtype=np.int32)
+        y_vals = np.zeros(batch_size, dtype=np.float32)
+        batch = self.frames if self.compact_batch else self.state_online
+
+        # the target cache computes only the missed rows, padded to these sizes
+        miss_sizes = []
+        if self.target_cache is not None:
+            miss_sizes = sorted(set(self._bucket_size(n) for n in xrange(1, batch_size + 1)))
+
+        for _ in xrange(num_calls):
+            self.sess.run(self.greedy_actions, feed_dict={self.state_online: states[:1, ..., :window]})
+            for size in miss_sizes:
+                self._calc_next_q_values(states[:size], online=False)
+            self._calc_next_q_values(states, online=False)
+            self._calc_next_q_values(states, online=True)
+            feed_dict = {batch: states, self.y_true: y_vals, self.action: actions}
+            if self.accumulate_steps > 1:
+                self.sess.run(self.accumulate, feed_dict=feed_dict)
+                self.sess.run(self.apply_and_reset)
+            elif self.parallel_learner is None:
+                self.sess.run([self.optimizer, self.loss], feed_dict=feed_dict)
+
+        for variable, value in zip(variables, values):
+            variable.load(value, self.sess)
 
     def calc_q_values(self, state):
         """Given a state (or batch of states) calculate the Q-values.
@@ -137,10 +330,17 @@ class DQNAgent:
         ------
         Q-values for the state(s)
         """
-        q_values_val = self.sess.run(self.q_values_online, feed_dict={self.state_online: state})
+        q_values_val = self._run('select_action', self.q_values_online, {self.state_online: state})
 
         return q_values_val
 
+    def _run(self, name, fetches, feed_dict):
+        """Run fetches, through the profiler if there is one."""
+        if self.profiler is None:
+            return self.sess.run(fetches, feed_dict=feed_dict)
+
+        return self.profiler.run(self.sess, name, fetches, feed_dict)
+
     def select_action(self, state, is_training):
         """Select the action based on the current state.
 
@@ -162,30 +362,90 @@ class DQNAgent:
         --------
         selected action
         """
-        state = np.expand_dims(state, axis=0)
-        q_values_val = self.calc_q_values(state)
+        if self.inference_client is not None:
+            q_values_val = self.inference_client.calc_q_values(state)
+            return self.policy.select_action(q_values_val, is_training)
+
+        return int(self.select_actions(np.expand_dims(state, axis=0), is_training)[0])
+
+    def select_actions(self, states, is_training):
+        """Select one action for each state of a batch, e.g. one per env.
+
+        The argmax runs in-graph and the policy only adds the
+        exploration, vectorized over the batch.
+
+        Returns
+        --------
+        np.ndarray of selected actions
+        """
+        greedy_actions = self._run('select_action', self.greedy_actions, {self.state_online: states})
+
+        return self.policy.select_greedy_actions(greedy_actions, self.num_actions, is_training)
+
+    def _calc_next_q_values(self, next_states, online):
+        """Run the online or target network on the next states.
+
+        In compact_batch mode next_states is the shared frame block
+        and the next states are sliced out of it in-graph.
+        """
+        if self.compact_batch:
+            q_values = self.q_values_online_next if online else self.q_values_target_next
+            return self.sess.run(q_values, feed_dict={self.frames: next_states})
+
+        if online:
+            return self.sess.run(self.q_values_online, feed_dict={self.state_online: next_states})
+
+        return self.sess.run(self.q_values_target, feed_dict={self.state_target: next_states})
+
+    def _calc_target_q_values(self, next_states):
+        """Target q values of the sampled batch, from the cache if possible."""
+        if self.target_cache is None:
+            return self._calc_next_q_values(next_states, online=False)
+
+        slots = self.memory.last_indexes
+        miss = ~self.target_cache.lookup(slots)
+        if miss.any():
+            rows = next_states[miss]
+            if self.xla:
+                # pad to a warmed-up size, XLA compiles every new batch shape
+                padding = np.zeros((self._bucket_size(len(rows)) - len(rows), ) + rows.shape[1:], dtype=rows.dtype)
+                rows = np.concatenate([rows, padding])
+            q_values = self._calc_next_q_values(rows, online=False)
+            self.target_cache.fill(slots[miss], q_values[:np.count_nonzero(miss)])
+        self.metrics.count('target_q_rows_computed', int(np.count_nonzero(miss)))
+        self.metrics.count('target_q_rows_cached', len(slots) - int(np.count_nonzero(miss)))
+
+        return self.target_cache.values[slots]
+
+    def _bucket_size(self, num_rows):
+        """Smallest power of two >= num_rows, capped at batch_size."""
+        return min(self.batch_size, 1 << int(np.ceil(np.log2(num_rows))))
+
+    def _report_memory_usage(self):
+        if self.experience_replay:
+            for part, num_bytes in self.memory.memory_usage().items():
+                self.metrics.scalar('replay_mb/' + part, num_bytes / 2.0 ** 20)
 
-        return self.policy.select_action(q_values_val, is_training)
+    def _sync_target(self):
+        get_hard_target_model_updates(self.q_network_target, self.q_network_online)
+        if self.target_cache is not None:
+            self.target_cache.invalidate_all()
 
     def _calc_y(self, next_states, rewards, not_terminal):
         y_vals = rewards
         # Calculating y values for deep q_network double
         if self.network_name is "deep_q_network_double" or self.network_name is "linear_q_network_double":
-            actions = np.argmax(self.sess.run(self.q_values_online, \
-                                              feed_dict={self.state_online: next_states}), axis=1)
+            actions = np.argmax(self._calc_next_q_values(next_states, online=True), axis=1)
 
-            q_vals = self.gamma * self.sess.run(self.q_values_target, \
-                                                feed_dict={self.state_target: next_states})
+            q_vals = self.gamma * self._calc_target_q_values(next_states)
 
-            added_vals = q_vals[np.arange(self.batch_size), actions]
+            added_vals = q_vals[np.arange(len(actions)), actions]
         elif not self.experience_replay:
             # Calculating y values for no experience linear model
-            added_vals = self.gamma * np.max(self.sess.run(self.q_values_online, \
-                                                           feed_dict={self.state_online: next_states}), axis=1)
+            added_vals = self.gamma * np.max(self._calc_next_q_values(next_states, online=True), axis=1)
         else:
             # Calculating y values for other models
-            added_vals = self.gamma * np.max(self.sess.run(self.q_values_target, \
-                                                           feed_dict={self.state_target: next_states}), axis=1)
+            added_vals = self.gamma * np.max(self._calc_target_q_values(next_states), axis=1)
 
         y_vals[not_terminal] += added_vals[not_terminal]
 
@@ -207,6 +467,39 @@ class DQNAgent:
         output. They can help you monitor how training is going.
         """
 
+        metrics = self.metrics
+        metrics.count('updates')
+        start = metrics.time()
+
+        if self.accumulate_steps > 1:
+            return self._accumulated_update()
+
+        if self.compact_batch:
+            frames, actions, rewards, not_terminal = self.memory.sample_compact(self.batch_size)
+            start = metrics.add('sample', start)
+
+            y_vals = self._calc_y(frames, rewards, not_terminal)
+            start = metrics.add('calc_y', start)
+
+            _, loss_val = self._run('update_policy', [self.optimizer, self.loss], \
+                                    {self.frames: frames, self.y_true: y_vals, self.action: actions})
+            metrics.add('train', start)
+
+            return loss_val
+
+        if self.parallel_learner is not None:
+            batch_size = self.batch_size * self.parallel_learner.num_workers
+            states, next_states, actions, rewards, not_terminal = self.memory.sample(batch_size)
+            start = metrics.add('sample', start)
+
+            y_vals = self._calc_y(next_states, rewards, not_terminal)
+            start = metrics.add('calc_y', start)
+
+            loss_val = self.parallel_learner.step(states, actions, y_vals)
+            metrics.add('train', start)
+
+            return loss_val
+
         if self.experience_replay:
             states, next_states, actions, rewards, not_terminal = self.memory.sample(self.batch_size, self.preprocessor)
         else:
@@ -216,27 +509,89 @@ class DQNAgent:
             rewards = np.stack(self.update_pool['rewards'])
             not_terminal = self.update_pool['not_terminal']
             self.update_pool = {'actions': [], 'rewards': [], 'states': [], 'next_states': [], 'not_terminal': []}
+        start = metrics.add('sample', start)
 
         y_vals = self._calc_y(next_states, rewards, not_terminal)
+        start = metrics.add('calc_y', start)
 
-        _, loss_val = self.sess.run([self.optimizer, self.loss], \
-                                    feed_dict={self.state_online: states, self.y_true: y_vals, self.action: actions})
+        _, loss_val = self._run('update_policy', [self.optimizer, self.loss], \
+                                {self.state_online: states, self.y_true: y_vals, self.action: actions})
+        metrics.add('train', start)
 
         return loss_val
 
-    def _append_to_memory(self, curr_state, action, next_frame, reward, is_terminal):
+    def _accumulated_update(self):
+        """One optimizer step on accumulate_steps micro-batches."""
+        metrics = self.metrics
+        loss_vals = []
+        for _ in xrange(self.accumulate_steps):
+            start = metrics.time()
+            if self.compact_batch:
+                frames, actions, rewards, not_terminal = self.memory.sample_compact(self.batch_size)
+                inputs, next_states = {self.frames: frames}, frames
+            else:
+                states, next_states, actions, rewards, not_terminal = self.memory.sample(self.batch_size)
+                inputs = {self.state_online: states}
+            start = metrics.add('sample', start)
+
+            y_vals = self._calc_y(next_states, rewards, not_terminal)
+            start = metrics.add('calc_y', start)
+
+            inputs.update({self.y_true: y_vals, self.action: actions})
+            _, loss_val = self._run('update_policy', [self.accumulate, self.loss], inputs)
+            loss_vals.append(loss_val)
+            metrics.add('train', start)
+
+        start = metrics.time()
+        self._run('update_policy', self.apply_and_reset, {})
+        metrics.add('train', start)
+
+        return np.mean(loss_vals)
+
+    def _controlled_updates(self, iter_t, step_seconds):
+        """Run the updates the replay ratio controller asks for after a step."""
+        controller = self.replay_ratio_controller
+        for _ in xrange(controller.step_done(step_seconds)):
+            start = time.time()
+            loss_val = self.update_policy()
+            controller.update_done(time.time() - start)
+            self.metrics.scalar('loss', loss_val)
+
+        decision = controller.adjust(iter_t)
+        if decision is not None:
+            self.metrics.scalar('replay_ratio', decision['replay_ratio'])
+            self.metrics.scalar('realized_replay_ratio', decision['realized_replay_ratio'])
+            print "Replay ratio controller: {steps_per_sec:.1f} steps/s, {updates_per_sec:.1f} updates/s -> " \
+                  "{updates_per_step:.3f} updates/step, replay ratio {replay_ratio:.2f} " \
+                  "(target {target_replay_ratio:.2f})".format(**decision)
+
+    def _initial_state(self):
+        if self.state_stack is not None:
+            return self.state_stack.reset()
+        return self.init_state
 
-        next_state = np.expand_dims(self.preprocessor.process_state_for_network(next_frame), axis=2)
-        # plt.imshow(self.preprocessor.process_state_for_network(next_frame))
-        # print self.preprocessor.process_state_for_network(next_frame)
-        # plt.show()
-        # append the next state to the last 3 frames in currstate to form the new state
-        next_state = np.append(curr_state[:, :, 1:], next_state, axis=2)
+    def _append_to_memory(self, curr_state, action, next_frame, reward, is_terminal):
+        start = self.metrics.time()
 
         # Set s_{t+1} = s_t, a_t, x_{t+1} and preprocess phi_{t+1} = phi(s_{t+1})
         next_frame = self.preprocessor.process_state_for_memory(next_frame)
 
+        # append the next frame to the last 3 frames in currstate to form the new state
+        if self.state_stack is not None:
+            next_state = self.state_stack.push(next_frame)
+        else:
+            # the update pool keeps the states, so they need their own arrays
+            next_state = np.divide(next_frame, 255.0, dtype=np.float32)[:, :, np.newaxis]
+            next_state = np.append(curr_state[:, :, 1:], next_state, axis=2)
+        start = self.metrics.add('preprocess', start)
+
+        if self.recorder is not None:
+            self.recorder.record(next_frame, action, self.preprocessor.process_reward(reward), is_terminal)
+            start = self.metrics.add('record', start)
+
         if self.experience_replay:
+            if self.target_cache is not None:
+                self.target_cache.invalidate_write(self.memory.index, self.memory.window_length)
             self.memory.append(next_frame, action, self.preprocessor.process_reward(reward), is_terminal)
         else:
             self.update_pool['states'].append(curr_state)
@@ -244,9 +599,21 @@ class DQNAgent:
             self.update_pool['rewards'].append(reward)
             self.update_pool['actions'].append(action)
             self.update_pool['not_terminal'].append(not is_terminal)
+        self.metrics.add('append', start)
 
         return next_state
 
+    def _parallel_burn_in(self):
+        """Collect the burn-in with burn_in_workers processes and merge it."""
+        frame_shape = self.init_state.shape[:-1]
+        frames, actions, rewards, terminals = collect_random(self.env_name, self.preprocessor, frame_shape,
+                                                             self.num_burn_in, self.burn_in_workers, self.seed)
+        self.memory.extend(frames, actions, rewards, terminals)
+
+        if self.recorder is not None:
+            for transition in zip(frames, actions, rewards, terminals):
+                self.recorder.record(*transition)
+
     def fit(self, env, num_iterations, output_folder, save_freq=10000, max_episode_length=100):
         """Fit your model to the provided environment.
 
@@ -275,62 +642,83 @@ class DQNAgent:
 
         init = tf.global_variables_initializer()
         self.init_state = get_init_state(env, self.preprocessor)
+        # with experience replay the acting loop reuses two state buffers
+        self.state_stack = StateStack(self.init_state) if self.experience_replay else None
         self.sess.run(init)
+        if self.parallel_learner is not None:
+            self.parallel_learner.publish_weights()
         env.reset()
 
+        metrics = self.metrics
+        if self.xla:
+            start = metrics.time()
+            self.warm_up()
+            metrics.add('warm_up', start)
+
         if not self.experience_replay:
             self.update_pool = {'actions': [], 'rewards': [], 'states': [], 'next_states': [], 'not_terminal': []}
 
+        if self.checkpoint_writer is None:
+            self.checkpoint_writer = CheckpointWriter(output_folder)
+
         iter_t = 0
         episode_count = 0
 
-        curr_state = self.init_state
+        curr_state = self._initial_state()
 
         # Get the initial lives
         prev_lives = env.env.ale.lives()
         if self.experience_replay:
             print "Start filling up the replay memory before update ..."
+            burn_in_start = time.time()
 
-            for j in xrange(self.num_burn_in):
+            if self.burn_in_workers > 1:
+                self._parallel_burn_in()
+            else:
+                for j in xrange(self.num_burn_in):
 
-                # action = self.select_action(curr_state, is_training=True)
-                action = env.action_space.sample()
+                    # action = self.select_action(curr_state, is_training=True)
+                    action = env.action_space.sample()
 
-                # Execute action a_t in emulator and observe reward r_t and image x_{t+1}
-                next_frame, reward, is_terminal, _ = env.step(action)
+                    # Execute action a_t in emulator and observe reward r_t and image x_{t+1}
+                    next_frame, reward, is_terminal, _ = env.step(action)
 
-                life_terminal = False
+                    life_terminal = False
 
-                # Get current lives
-                curr_lives = env.env.ale.lives()
+                    # Get current lives
+                    curr_lives = env.env.ale.lives()
 
-                # check lives of agent, modify the original reward
-                # if die, give -5 reward, if earn life, earn 50 reward
-                if curr_lives < prev_lives:
-                    life_terminal = True
-                    reward = -5.0
-                elif curr_lives > prev_lives:
-                    reward = 50.0
+                    # check lives of agent, modify the original reward
+                    # if die, give -5 reward, if earn life, earn 50 reward
+                    if curr_lives < prev_lives:
+                        life_terminal = True
+                        reward = -5.0
+                    elif curr_lives > prev_lives:
+                        reward = 50.0
 
-                prev_lives = curr_lives
+                    prev_lives = curr_lives
 
-                # get next state while appending current frame to the memory
-                next_state = self._append_to_memory(curr_state, action, next_frame, reward,
-                                                    life_terminal or is_terminal)
+                    # get next state while appending current frame to the memory
+                    next_state = self._append_to_memory(curr_state, action, next_frame, reward,
+                                                        life_terminal or is_terminal)
                 
-                # If terminal, reset and goes back to the initial state
-                if is_terminal:
-                    env.reset()
-                    curr_state = self.init_state
-                else:
-                    curr_state = next_state
-
-            print "Has Prefilled the replay memory"
+                    # If terminal, reset and goes back to the initial state
+                    if is_terminal:
+                        env.reset()
+                        curr_state = self._initial_state()
+                    else:
+                        curr_state = next_state
+
+            burn_in_time = time.time() - burn_in_start
+            metrics.add('burn_in', burn_in_start)
+            print "Has Prefilled the replay memory in {:.1f} s with {} worker(s)".format(burn_in_time,
+                                                                                      self.burn_in_workers)
+            self._report_memory_usage()
 
         while iter_t < num_iterations:
             # Get the initial state
             env.reset()
-            curr_state = self.init_state
+            curr_state = self._initial_state()
             action, total_reward, action_count = 0, 0, 0
             episode_count += 1
             prev_lives = env.env.ale.lives()
@@ -339,23 +727,27 @@ class DQNAgent:
             for j in xrange(max_episode_length):
                 # save model
                 if iter_t % save_freq == 0:
-                    self.evaluate_no_render()
-                    model_json = self.q_network_online.to_json()
-                    file_name = os.path.join(output_folder, str(iter_t) + ".json")
-                    with open(file_name, "w") as json_file:
-                        json_file.write(model_json)
-                        # serialize weights to HDF5
-                        self.q_network_online.save_weights(os.path.join(output_folder, str(iter_t) + ".h5"))
-                    print("Saved model to disk")
+                    start = metrics.time()
+                    reward_avg = self.evaluate_no_render()
+                    start = metrics.add('evaluate', start)
+                    # snapshot here, json and HDF5 get written in the background
+                    stall = self.checkpoint_writer.save(iter_t, self.q_network_online, reward_avg)
+                    metrics.add('checkpoint', start)
+                    print "Saved model to disk, stalled {:.1f} ms".format(1000 * stall)
 
                 iter_t += 1
+                metrics.count('steps')
+                step_start = time.time()
+                start = metrics.time()
                 if action_count == self.repetition_times:
                     action_count = 0
                     action = self.select_action(curr_state, is_training=True)
+                    start = metrics.add('select_action', start)
                 action_count += 1
 
                 # Execute action a_t in emulator and observe reward r_t and image x_{t+1}
                 next_frame, reward, is_terminal, _ = env.step(action)
+                metrics.add('env_step', start)
                 life_terminal = False
                 curr_lives = env.env.ale.lives()
 
@@ -376,35 +768,150 @@ class DQNAgent:
 
                 # Time for updating (copy...) the target network
                 if iter_t % self.target_update_freq == 0 and self.experience_replay:
-                    get_hard_target_model_updates(self.q_network_target, self.q_network_online)
+                    start = metrics.time()
+                    self._sync_target()
+                    metrics.add('target_update', start)
 
-                if iter_t % self.train_freq == 0:
+                if self.replay_ratio_controller is not None:
+                    self._controlled_updates(iter_t, time.time() - step_start)
+                elif iter_t % self.train_freq == 0:
                     loss_val = self.update_policy()
+                    metrics.scalar('loss', loss_val)
                     if iter_t % 5000 == 0:
                         print str(iter_t) + "th iteration \n Loss val : " + str(loss_val)
 
+                metrics.step(iter_t)
+                if self.profiler is not None:
+                    self.profiler.step(iter_t)
                 curr_state = next_state
 
             # update again after the episode ends...
             loss_val = self.update_policy()
+            metrics.scalar('episode_reward', total_reward)
+            self._report_memory_usage()
             print str(episode_count) + "th Episode:\n" + "Reward: " + str(total_reward) + "\n Loss:" + str(loss_val)
 
+        if self.recorder is not None:
+            self.recorder.close()
+            print "Recorded {num_recorded} transitions, {megabytes:.1f} MB at {write_mb_per_sec:.1f} MB/s, " \
+                  "{record_us_per_step:.1f} us/step, stalled {stall_s:.2f} s".format(**self.recorder.report())
+        if self.replay_ratio_controller is not None:
+            self.replay_ratio_controller.close()
+            print "Realized replay ratio: {:.2f}".format(self.replay_ratio_controller.realized_replay_ratio())
+        if self.target_cache is not None:
+            print "Target q cache: {hit_rate:.1%} hit rate, {hits} of {total} target rows not recomputed, " \
+                  "{syncs} syncs".format(total=self.target_cache.hits + self.target_cache.misses,
+                                         **self.target_cache.report())
+        self.checkpoint_writer.close()
+        if self.profiler is not None:
+            self.profiler.close()
+        print "Checkpoint stall: mean {:.1f} ms, max {:.1f} ms".format(*self.checkpoint_writer.stall_report())
+
+    def fit_offline(self, reader, num_iterations, output_folder, save_freq=10000):
+        """Fit the network to a recorded dataset, without an environment.
+
+        Transitions are streamed from the reader into the replay
+        memory at the same rate as in fit: one per iteration, an
+        update every train_freq iterations and a target sync every
+        target_update_freq iterations. Nothing is evaluated, since
+        there is no emulator, so checkpoints have no score.
+
+        Parameters
+        ----------
+        reader: deeprl_hw2.dataset.ShardReader
+          The recorded dataset.
+        num_iterations: int
+          How many recorded transitions to consume after the burn-in.
+          Training stops early when a reader that does not loop runs
+          out of transitions.
+        """
+        self.sess.run(tf.global_variables_initializer())
+        if self.parallel_learner is not None:
+            self.parallel_learner.publish_weights()
+
+        if self.checkpoint_writer is None:
+            self.checkpoint_writer = CheckpointWriter(output_folder)
+
+        metrics = self.metrics
+        if self.xla:
+            start = metrics.time()
+            self.warm_up()
+            metrics.add('warm_up', start)
+
+        transitions = reader.transitions()
+
+        print "Start filling up the replay memory from " + str(len(reader.shards)) + " shards ..."
+        start = metrics.time()
+        for j in xrange(self.num_burn_in):
+            try:
+                self.memory.append(*next(transitions))
+            except StopIteration:
+                raise ValueError('The dataset holds only {} transitions, fewer than the {} burn-in '
+                                 'steps'.format(j, self.num_burn_in))
+        metrics.add('burn_in', start)
+        self._report_memory_usage()
+
+        for iter_t in xrange(num_iterations):
+            if iter_t % save_freq == 0:
+                start = metrics.time()
+                stall = self.checkpoint_writer.save(iter_t, self.q_network_online)
+                metrics.add('checkpoint', start)
+                print "Saved model to disk, stalled {:.1f} ms".format(1000 * stall)
+
+            start = metrics.time()
+            if self.target_cache is not None:
+                self.target_cache.invalidate_write(self.memory.index, self.memory.window_length)
+            try:
+                self.memory.append(*next(transitions))
+            except StopIteration:
+                print "Dataset exhausted after " + str(iter_t) + " iterations"
+                break
+            metrics.add('append', start)
+            metrics.count('steps')
+
+            if (iter_t + 1) % self.target_update_freq == 0:
+                start = metrics.time()
+                self._sync_target()
+                metrics.add('target_update', start)
+
+            if (iter_t + 1) % self.train_freq == 0:
+                loss_val = self.update_policy()
+                metrics.scalar('loss', loss_val)
+                if (iter_t + 1) % 5000 == 0:
+                    print str(iter_t + 1) + "th iteration \n Loss val : " + str(loss_val)
+
+            metrics.step(iter_t + 1)
+            if self.profiler is not None:
+                self.profiler.step(iter_t + 1)
+
+        self.checkpoint_writer.close()
+        if self.profiler is not None:
+            self.profiler.close()
+        print "Checkpoint stall: mean {:.1f} ms, max {:.1f} ms".format(*self.checkpoint_writer.stall_report())
+
     #
     def evaluate_no_render(self):
         """Test your agent with a provided environment.
 
-        Evaluate the model 20 times every 100,000 interactions in training
+        Evaluate the model every save_freq interactions in training,
+        for as many episodes as eval_stopping asks for
         """
-        num_episodes = 0
-        env = gym.make(self.env_name)
+        import gym
 
-        reward_avg = 0
+        env = gym.make(self.env_name)
+        state_stack = StateStack(self.init_state)
+        stats = RunningStats()
+        num_frames = 0
 
         print "Start evaluating ... "
-        while num_episodes < 20:
+        while True:
+            stop_reason = self.eval_stopping.reason(stats, num_frames, self.best_eval_reward)
+            if stop_reason is not None:
+                break
+
             env.reset()
             # Get the initial state
-            curr_state = self.init_state
+            curr_state = state_stack.reset()
 
             is_terminal = False
             total_reward = 0
@@ -413,22 +920,32 @@ class DQNAgent:
                 next_frame, reward, is_terminal, _ = env.step(action)
 
                 # process and generate next state
-                next_frame = self.preprocessor.process_state_for_network(next_frame)
-                next_state = np.expand_dims(next_frame, axis=2)
-                next_state = np.append(curr_state[:, :, 1:], next_state, axis=2)
+                next_state = state_stack.push(self.preprocessor.process_state_for_memory(next_frame))
 
                 total_reward += reward
+                num_frames += 1
 
                 curr_state = next_state
-            
-            reward_avg += total_reward
-            num_episodes += 1
 
-        reward_avg /= 20
+            stats.add(total_reward)
 
+        reward_avg = stats.mean
+        if self.best_eval_reward is None or reward_avg > self.best_eval_reward:
+            self.best_eval_reward = reward_avg
+
+        self._report_evaluation(stats, num_frames, stop_reason, self.eval_stopping)
         print "Average reward: " + str(reward_avg)
 
-    def evaluate(self, env, log_file, num_episodes, render=False):
+        return reward_avg
+
+    def _report_evaluation(self, stats, num_frames, stop_reason, stopping):
+        saved = stopping.max_episodes - stats.count
+        self.metrics.count('eval_episodes', stats.count)
+        self.metrics.count('eval_episodes_saved', saved)
+        print "Evaluated {} episodes ({} frames), stopped on {}, {} of {} episodes saved".format(
+            stats.count, num_frames, stop_reason, saved, stopping.max_episodes)
+
+    def evaluate(self, env, log_file, num_episodes, render=False, stopping=None):
         """Test your agent with a provided environment.
         
         You shouldn't update your network parameters here. Also if you
@@ -440,17 +957,29 @@ class DQNAgent:
 
         You can also call the render function here if you want to
         visually inspect your policy.
+
+        With a stopping rule (deeprl_hw2.evaluation.StoppingRule) the
+        evaluation may end before num_episodes episodes.
         """
 
+        from gym import wrappers
+
         # initialize
         self.init_state = get_init_state(env, self.preprocessor)
         env = wrappers.Monitor(env, log_file)
-        rewards = []
+        state_stack = StateStack(self.init_state)
+        stopping = stopping or StoppingRule(num_episodes, early_stop=False)
+        stats = RunningStats()
+        num_frames = 0
+
+        while True:
+            stop_reason = stopping.reason(stats, num_frames)
+            if stop_reason is not None:
+                break
 
-        while num_episodes > 0:
             env.reset()
             # Get the initial state
-            curr_state = self.init_state
+            curr_state = state_stack.reset()
             action = self.select_action(curr_state, is_training=False)
             is_terminal = False
             i = 0
@@ -467,18 +996,18 @@ class DQNAgent:
                 curr_reward += reward
 
                 # process and generate next state
-                next_frame = self.preprocessor.process_state_for_network(next_frame)
-                next_state = np.expand_dims(next_frame, axis=2)
-                next_state = np.append(curr_state[:, :, 1:], next_state, axis=2)
+                next_state = state_stack.push(self.preprocessor.process_state_for_memory(next_frame))
 
                 curr_state = next_state
 
                 i += 1
-            rewards.append(curr_reward)
-            print "{}th Episode Finished".format(num_episodes)
-            num_episodes -= 1
+            num_frames += i
+            stats.add(curr_reward)
+            print "{}th Episode Finished".format(stats.count)
 
         print "\nStatistics:"
-        print "Mean: {}".format(np.mean(rewards))
-        print "Standard deviation: {}".format(np.std(rewards))
+        self._report_evaluation(stats, num_frames, stop_reason, stopping)
+        print "Mean: {}".format(stats.mean)
+        print "Standard deviation: {}".format(stats.std)
+        print "Confidence interval: +-{}".format(stats.half_width(stopping.confidence))
 
@@ -0,0 +1,174 @@
+"""Streaming evaluation statistics and a sequential stopping rule.
+
+The episode rewards of an evaluation are folded into running
+statistics one at a time, nothing is kept per episode. After every
+episode the stopping rule decides whether more episodes are needed:
+evaluation ends as soon as the confidence interval of the mean reward
+is narrow enough, or lies entirely above or below a reference score
+(e.g. the best checkpoint so far), or a budget of episodes or frames
+is used up.
+
+The interval is looked at after every episode from min_episodes on,
+and a fixed-level interval checked that often stops too early far
+more often than its level says. The rule uses the Bonferroni level
+over all possible looks instead, so the chance that any early stop
+happens on an interval missing the mean stays below 1 - confidence.
+
+evaluate_network runs the same evaluation for a bare network, e.g. a
+NumpyQNetwork, without a DQNAgent. This module and what that function
+imports never import TensorFlow.
+"""
+
+import math
+
+
+class RunningStats:
+    """Count, mean and variance of a stream (Welford's algorithm)."""
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+
+    def merge(self, other):
+        """Add the values of other, e.g. of another evaluation worker."""
+        count = self.count + other.count
+        if count == 0:
+            return
+        delta = other.mean - self.mean
+        self._m2 += other._m2 + delta * delta * self.count * other.count / count
+        self.mean += delta * other.count / count
+        self.count = count
+
+    @property
+    def std(self):
+        """Population standard deviation, like np.std."""
+        return math.sqrt(self._m2 / self.count) if self.count else 0.0
+
+    @property
+    def sample_std(self):
+        return math.sqrt(self._m2 / (self.count - 1)) if self.count > 1 else float('inf')
+
+    def half_width(self, confidence):
+        """Half width of the Student t confidence interval of the mean."""
+        if self.count < 2:
+            return float('inf')
+        from scipy.stats import t
+
+        return t.ppf(0.5 + confidence / 2.0, self.count - 1) * self.sample_std / math.sqrt(self.count)
+
+
+class StoppingRule:
+    """Decides after every episode whether an evaluation can stop.
+
+    Parameters
+    ----------
+    max_episodes: int
+      Episodes run at most, the fixed count without early stopping.
+    min_episodes: int
+      Episodes run at least before any early stop.
+    max_frames: int, optional
+      Env steps after which no new episode is started.
+    confidence: float
+      Confidence level of the interval of the mean reward over all
+      looks; every single look uses look_confidence.
+    precision: float, optional
+      Stop once the interval half width is at most this, in reward
+      units.
+    early_stop: bool
+      Without it only the budgets apply, i.e. the plain fixed-count
+      evaluation.
+    """
+
+    def __init__(self, max_episodes, min_episodes=5, max_frames=None, confidence=0.95, precision=None,
+                 early_stop=True):
+        self.max_episodes = max_episodes
+        self.min_episodes = min_episodes
+        self.max_frames = max_frames
+        self.confidence = confidence
+        self.precision = precision
+        self.early_stop = early_stop
+        # Bonferroni over the looks after episodes min_episodes..max_episodes
+        num_looks = max(max_episodes - max(min_episodes, 2) + 1, 1)
+        self.look_confidence = 1 - (1 - confidence) / num_looks
+
+    def reason(self, stats, num_frames, reference=None):
+        """Return why the evaluation should stop now, None to continue."""
+        if stats.count >= self.max_episodes:
+            return 'max_episodes'
+        if self.max_frames and num_frames >= self.max_frames:
+            return 'max_frames'
+        if not self.early_stop or stats.count < self.min_episodes:
+            return None
+
+        half_width = stats.half_width(self.look_confidence)
+        if self.precision is not None and half_width <= self.precision:
+            return 'precision'
+        if reference is not None and stats.mean - half_width > reference:
+            return 'better_than_reference'
+        if reference is not None and stats.mean + half_width < reference:
+            return 'worse_than_reference'
+
+        return None
+
+
+def evaluate_network(network, env, preprocessor, policy, log_file, repetition_times, stopping):
+    """The evaluation loop of DQNAgent.evaluate, for a network alone.
+
+    Parameters
+    ----------
+    network: object
+      Anything with calc_q_values(state), e.g. a NumpyQNetwork.
+    env: gym.Env
+      Wrapped in a gym Monitor writing to log_file.
+    preprocessor: deeprl_hw2.preprocessors.AtariPreprocessor
+    policy: deeprl_hw2.policy.Policy
+      Picks the actions from the q values, with is_training=False.
+    repetition_times: int
+      Steps every selected action is repeated for.
+    stopping: StoppingRule
+
+    Returns
+    -------
+    (RunningStats, int, str)
+      Statistics of the episode rewards, frames played and the stop
+      reason.
+    """
+    from gym import wrappers
+
+    from deeprl_hw2.utils import StateStack, get_init_state
+
+    state_stack = StateStack(get_init_state(env, preprocessor))
+    env = wrappers.Monitor(env, log_file)
+    stats = RunningStats()
+    num_frames = 0
+
+    while True:
+        stop_reason = stopping.reason(stats, num_frames)
+        if stop_reason is not None:
+            break
+
+        env.reset()
+        state = state_stack.reset()
+        action = 0
+        is_terminal = False
+        episode_reward = 0
+        i = 0
+        while not is_terminal:
+            if i % repetition_times == 0:
+                action = policy.select_action(network.calc_q_values(state), is_training=False)
+            next_frame, reward, is_terminal, _ = env.step(action)
+            episode_reward += reward
+            state = state_stack.push(preprocessor.process_state_for_memory(next_frame))
+            i += 1
+        num_frames += i
+        stats.add(episode_reward)
+        print "{}th Episode Finished".format(stats.count)
+
+    return stats, num_frames, stop_reason
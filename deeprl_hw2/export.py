@@ -0,0 +1,138 @@
+"""Inference-only export of trained Q-networks.
+
+The exported artifact is a single frozen GraphDef of the online
+network: the variables are folded into constants and there is no
+optimizer and no target network, so loading it is one protobuf parse
+and acting is a single session run in a small graph.
+"""
+
+import time
+
+import numpy as np
+import tensorflow as tf
+
+OUTPUT_NAME = 'q_values'
+
+
+def export_inference_graph(model, sess, path):
+    """Write the frozen inference graph of model to path.
+
+    Parameters
+    ----------
+    model: keras.models.Model
+      The online Q-network, its weights already loaded in sess.
+    sess: tf.Session
+      Session holding the model variables.
+    path: str
+      Output file, usually <model_num>.pb next to the checkpoint.
+    """
+    with sess.graph.as_default():
+        # a layer named like OUTPUT_NAME owns that name scope, so the
+        # identity may get a suffix; it is renamed back after freezing
+        output_name = tf.identity(model.output, name=OUTPUT_NAME).op.name
+
+    graph_def = tf.graph_util.convert_variables_to_constants(sess, sess.graph.as_graph_def(), [output_name])
+    graph_def = tf.graph_util.remove_training_nodes(graph_def)
+    for node in graph_def.node:
+        if node.name == output_name:
+            node.name = OUTPUT_NAME
+
+    with open(path, 'wb') as pb_file:
+        pb_file.write(graph_def.SerializeToString())
+
+
+class FrozenQNetwork:
+    """Q-network loaded from an export_inference_graph file.
+
+    Owns a private graph and session, so it can be used next to (or
+    instead of) the training graph.
+
+    Parameters
+    ----------
+    path: str
+      The exported .pb file.
+    num_threads: int
+      TensorFlow intra-op threads, 0 lets TensorFlow decide.
+    """
+
+    def __init__(self, path, num_threads=0):
+        graph_def = tf.GraphDef()
+        with open(path, 'rb') as pb_file:
+            graph_def.ParseFromString(pb_file.read())
+
+        # after freezing the network input is the only placeholder left
+        input_name = [node.name for node in graph_def.node if node.op == 'Placeholder'][0]
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.state, self.q_values = tf.import_graph_def(
+                graph_def, return_elements=[input_name + ':0', OUTPUT_NAME + ':0'], name='')
+
+        config = tf.ConfigProto(intra_op_parallelism_threads=num_threads, inter_op_parallelism_threads=1)
+        self.sess = tf.Session(graph=self.graph, config=config)
+
+    def calc_q_values(self, state):
+        """Return the q values of a single state or a batch of states."""
+        state = np.asarray(state, dtype=np.float32)
+        if state.ndim == len(self.state.get_shape()) - 1:
+            state = state[np.newaxis]
+
+        return self.sess.run(self.q_values, feed_dict={self.state: state})
+
+    def close(self):
+        self.sess.close()
+
+
+def measure_export(json_path, weights_path, pb_path, num_calls=500):
+    """Compare the JSON+H5 evaluation path with the frozen graph.
+
+    The JSON+H5 load mirrors dqn_atari.main: two models from JSON,
+    global_variables_initializer and the weights loaded into both.
+
+    Returns
+    -------
+    dict
+      Load time in seconds and mean per-action latency in
+      milliseconds for both paths, keys json_load_s, json_action_ms,
+      frozen_load_s and frozen_action_ms.
+    """
+    import keras.backend as K
+    from keras.models import model_from_json
+
+    report = {}
+
+    with tf.Graph().as_default():
+        start = time.time()
+        sess = tf.Session()
+        K.set_session(sess)
+        with open(json_path, 'r') as json_file:
+            loaded_model_json = json_file.read()
+        q_network_online = model_from_json(loaded_model_json)
+        q_network_target = model_from_json(loaded_model_json)
+        sess.run(tf.global_variables_initializer())
+        q_network_online.load_weights(weights_path)
+        q_network_target.load_weights(weights_path)
+        report['json_load_s'] = time.time() - start
+
+        state = np.random.rand(1, *K.int_shape(q_network_online.input)[1:]).astype(np.float32)
+        report['json_action_ms'] = _time_calls(
+            lambda: sess.run(q_network_online.output, feed_dict={q_network_online.input: state}), num_calls)
+        sess.close()
+
+    start = time.time()
+    frozen = FrozenQNetwork(pb_path)
+    report['frozen_load_s'] = time.time() - start
+    report['frozen_action_ms'] = _time_calls(lambda: frozen.calc_q_values(state), num_calls)
+    frozen.close()
+
+    return report
+
+
+def _time_calls(func, num_calls):
+    """Mean milliseconds per call, after one warm-up call."""
+    func()
+    start = time.time()
+    for _ in xrange(num_calls):
+        func()
+
+    return 1000 * (time.time() - start) / num_calls
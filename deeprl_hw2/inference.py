@@ -0,0 +1,296 @@
+"""Batched local inference server for action selection.
+
+One server process owns the Q-network. Clients write their state into
+their own slot of a shared memory array and queue their id; the server
+coalesces queued requests into one batch, bounded by max_batch and by
+how long the first request of the batch may wait, and sends every
+client its row of q values back through the client's pipe. Clients
+get q values rather than actions, so the epsilon-greedy policy stays
+with the actor, as for any DQNAgent inference_client.
+
+evaluate_parallel uses the server for checkpoint evaluation: several
+env processes play their share of the episodes and all act through
+the one server, which loads the checkpoint weights or serves its
+frozen or int8 graph.
+"""
+
+import multiprocessing
+import os
+import time
+from Queue import Empty
+
+import numpy as np
+
+_STOP = -1
+
+
+def _load_network(build_model, weights_path, graph_path, num_threads):
+    """Return the batched q values function of the served network and its session."""
+    # only the server process needs TensorFlow, not the clients
+    if graph_path:
+        from deeprl_hw2.export import FrozenQNetwork
+
+        network = FrozenQNetwork(graph_path, num_threads)
+        return network.calc_q_values, network.sess
+
+    import keras.backend as K
+    import tensorflow as tf
+
+    with tf.Graph().as_default():
+        config = tf.ConfigProto(intra_op_parallelism_threads=num_threads, inter_op_parallelism_threads=1)
+        sess = tf.Session(config=config)
+        K.set_session(sess)
+
+        model = build_model()
+        sess.run(tf.global_variables_initializer())
+        if weights_path:
+            model.load_weights(weights_path)
+
+    return lambda batch_states: sess.run(model.output, feed_dict={model.input: batch_states}), sess
+
+
+def _server_loop(build_model, weights_path, graph_path, requests, conns, states, max_batch, max_wait,
+                 num_threads):
+    """Serve batched q values until the stop request arrives."""
+    calc_q_values, sess = _load_network(build_model, weights_path, graph_path, num_threads)
+
+    running = True
+    while running:
+        batch = [requests.get()]
+        if batch[0] == _STOP:
+            break
+
+        deadline = time.time() + max_wait
+        while len(batch) < max_batch:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                client_id = requests.get(timeout=timeout)
+            except Empty:
+                break
+            if client_id == _STOP:
+                running = False
+                break
+            batch.append(client_id)
+
+        q_values_val = calc_q_values(states[batch])
+        for client_id, q_values in zip(batch, q_values_val):
+            conns[client_id].send(q_values)
+
+    sess.close()
+
+
+class InferenceClient:
+    """Handle through which one actor asks the server for q values.
+
+    Get clients from InferenceServer.client, they are meant to be
+    passed on to the actor processes.
+    """
+
+    def __init__(self, client_id, requests, conn, states):
+        self.client_id = client_id
+        self._requests = requests
+        self._conn = conn
+        self._states = states
+
+    def calc_q_values(self, state):
+        """Return the (1, num_actions) q values of a single state."""
+        self._states[self.client_id] = np.reshape(state, self._states.shape[1:])
+        self._requests.put(self.client_id)
+
+        return self._conn.recv()[np.newaxis]
+
+
+class InferenceServer:
+    """Process owning the Q-network that serves batched requests.
+
+    Parameters
+    ----------
+    build_model: callable
+      Returns the keras.models.Model to serve. Called in the server
+      process.
+    state_shape: tuple
+      Shape of a single network input, e.g. (84, 84, 4).
+    num_clients: int
+      Number of clients that can be handed out.
+    weights_path: str, optional
+      HDF5 weights to load into the model. Randomly initialized if
+      not given.
+    max_batch: int
+      Largest number of requests answered by one forward pass.
+    max_wait: float
+      Seconds the first request of a batch waits for more requests.
+    num_threads: int
+      TensorFlow intra-op threads of the server.
+    graph_path: str, optional
+      Serve this export_inference_graph (or int8 quantized) file with
+      a FrozenQNetwork instead, build_model and weights_path are not
+      used then.
+    """
+
+    def __init__(self, build_model, state_shape, num_clients, weights_path=None, max_batch=32, max_wait=0.002,
+                 num_threads=1, graph_path=None):
+        self.num_clients = num_clients
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+
+        raw_states = multiprocessing.RawArray('f', num_clients * int(np.prod(state_shape)))
+        self._states = np.frombuffer(raw_states, dtype=np.float32).reshape((num_clients, ) + tuple(state_shape))
+        self._requests = multiprocessing.Queue()
+
+        self._client_conns = []
+        server_conns = []
+        for _ in xrange(num_clients):
+            client_conn, server_conn = multiprocessing.Pipe(duplex=False)
+            self._client_conns.append(client_conn)
+            server_conns.append(server_conn)
+
+        self._process = multiprocessing.Process(target=_server_loop,
+                                                args=(build_model, weights_path, graph_path, self._requests,
+                                                      server_conns, self._states, max_batch, max_wait, num_threads))
+        self._process.daemon = True
+        self._process.start()
+
+    def client(self, client_id):
+        """Return the client using slot client_id."""
+        return InferenceClient(client_id, self._requests, self._client_conns[client_id], self._states)
+
+    def close(self):
+        """Stop the server process."""
+        self._requests.put(_STOP)
+        self._process.join()
+
+
+def _evaluate_loop(client, env_name, seed, preprocessor, policy, log_file, repetition_times, num_episodes, results):
+    """Play num_episodes episodes acting through client, send back the statistics."""
+    try:
+        import gym
+
+        from deeprl_hw2.evaluation import StoppingRule, evaluate_network
+
+        env = gym.make(env_name)
+        env.seed(seed)
+        # the forked policy would explore like every other worker
+        policy.rng = np.random.RandomState(seed)
+        stats, num_frames, _ = evaluate_network(client, env, preprocessor, policy, log_file, repetition_times,
+                                                StoppingRule(num_episodes, early_stop=False))
+        results.put((stats, num_frames))
+    except Exception as e:
+        # the parent waits for one result per worker
+        results.put(e)
+
+
+def evaluate_parallel(build_model, weights_path, state_shape, env_name, preprocessor, policy, log_file,
+                      repetition_times, num_episodes, num_workers, seed=0, max_batch=32, max_wait=0.002,
+                      graph_path=None):
+    """Evaluate a checkpoint with num_workers env processes and one server.
+
+    Parameters
+    ----------
+    build_model: callable
+      Returns the model to serve, see InferenceServer.
+    weights_path: str
+      HDF5 weights of the checkpoint.
+    num_episodes: int
+      Episodes in total, split evenly between the workers.
+    seed: int
+      Worker i seeds its env and its policy with seed + i.
+    graph_path: str, optional
+      Serve this frozen or int8 graph instead, see InferenceServer.
+
+    The other parameters are those of evaluate_network; worker i logs
+    to log_file/worker_<i>.
+
+    Returns
+    -------
+    (RunningStats, int)
+      Statistics of the episode rewards of all workers and the frames
+      played.
+    """
+    from deeprl_hw2.evaluation import RunningStats
+
+    num_workers = min(num_workers, num_episodes)
+    server = InferenceServer(build_model, state_shape, num_workers, weights_path, max_batch, max_wait,
+                             graph_path=graph_path)
+    results = multiprocessing.Queue()
+    workers = []
+    for i in xrange(num_workers):
+        share = num_episodes // num_workers + (1 if i < num_episodes % num_workers else 0)
+        workers.append(multiprocessing.Process(
+            target=_evaluate_loop, args=(server.client(i), env_name, seed + i, preprocessor, policy,
+                                         os.path.join(log_file, 'worker_{}'.format(i)), repetition_times, share,
+                                         results)))
+    for process in workers:
+        process.start()
+
+    stats = RunningStats()
+    num_frames = 0
+    errors = []
+    for _ in workers:
+        result = results.get()
+        if isinstance(result, Exception):
+            errors.append(result)
+        else:
+            stats.merge(result[0])
+            num_frames += result[1]
+
+    for process in workers:
+        process.join()
+    server.close()
+    if errors:
+        raise errors[0]
+
+    return stats, num_frames
+
+
+def _client_loop(client, num_requests, state_shape, results):
+    latencies = np.empty(num_requests)
+    state = np.random.rand(*state_shape).astype(np.float32)
+    for i in xrange(num_requests):
+        start = time.time()
+        client.calc_q_values(state)
+        latencies[i] = time.time() - start
+    results.put(latencies)
+
+
+def measure_serving(build_model, state_shape, client_counts, num_requests=200, max_batch=32, max_wait=0.002,
+                    num_threads=1):
+    """Measure server throughput and latency for different client counts.
+
+    Every client process sends num_requests requests back to back.
+
+    Returns
+    -------
+    list(dict)
+      One entry per client count with the keys num_clients,
+      requests_per_sec, p50_ms and p99_ms.
+    """
+    report = []
+    for num_clients in client_counts:
+        server = InferenceServer(build_model, state_shape, num_clients, max_batch=max_batch, max_wait=max_wait,
+                                 num_threads=num_threads)
+        # warm up the session before timing
+        server.client(0).calc_q_values(np.zeros(state_shape, dtype=np.float32))
+
+        results = multiprocessing.Queue()
+        clients = [multiprocessing.Process(target=_client_loop,
+                                           args=(server.client(i), num_requests, state_shape, results))
+                   for i in xrange(num_clients)]
+
+        start = time.time()
+        for process in clients:
+            process.start()
+        latencies = np.concatenate([results.get() for _ in clients])
+        elapsed = time.time() - start
+
+        for process in clients:
+            process.join()
+        server.close()
+
+        report.append({'num_clients': num_clients,
+                       'requests_per_sec': len(latencies) / elapsed,
+                       'p50_ms': 1000 * np.percentile(latencies, 50),
+                       'p99_ms': 1000 * np.percentile(latencies, 99)})
+
+    return report
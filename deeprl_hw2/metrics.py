@@ -0,0 +1,132 @@
+"""Per-phase timers and throughput metrics for the training loop.
+
+The agent brackets every phase of its hot path with
+
+    start = metrics.time()
+    ...
+    metrics.add('env_step', start)
+
+and counts steps and updates. Every log_freq iterations the phase
+times and the rolling steps/sec and updates/sec since the previous
+record are written as one JSON line, and optionally as TensorBoard
+scalars. NullMetrics has the same interface and does nothing, it is
+what the agent uses when instrumentation is disabled.
+"""
+
+import json
+import time
+from collections import defaultdict
+
+
+class NullMetrics:
+    """Disabled metrics, every call is a no-op."""
+
+    def time(self):
+        return 0.0
+
+    def add(self, phase, start):
+        return 0.0
+
+    def count(self, name, n=1):
+        pass
+
+    def scalar(self, name, value):
+        pass
+
+    def step(self, iteration):
+        pass
+
+    def close(self):
+        pass
+
+
+class Metrics:
+    """Accumulates phase times and counters and logs them periodically.
+
+    Parameters
+    ----------
+    log_path: str, optional
+      JSONL file a record is appended to every log_freq iterations.
+      Without it nothing is logged, only the run totals are kept.
+    log_freq: int
+      Iterations between two records.
+    tensorboard_dir: str, optional
+      If set, every record is also written there as scalar summaries.
+    """
+
+    def __init__(self, log_path=None, log_freq=1000, tensorboard_dir=None):
+        self.log_freq = log_freq
+        self._log_file = open(log_path, 'a') if log_path is not None else None
+        self._summary_writer = None
+        if tensorboard_dir is not None:
+            import tensorflow as tf
+            self._summary_writer = tf.summary.FileWriter(tensorboard_dir)
+
+        # totals over the whole run, never reset
+        self.total_phase_time = defaultdict(float)
+        self.total_counts = defaultdict(int)
+
+        self._reset(time.time())
+
+    def _reset(self, now):
+        self._phase_time = defaultdict(float)
+        self._phase_calls = defaultdict(int)
+        self._counts = defaultdict(int)
+        self._scalars = {}
+        self._window_start = now
+
+    def time(self):
+        """Return a start time for add."""
+        return time.time()
+
+    def add(self, phase, start):
+        """Add the time since start to phase and return the current time."""
+        now = time.time()
+        self._phase_time[phase] += now - start
+        self._phase_calls[phase] += 1
+        self.total_phase_time[phase] += now - start
+        return now
+
+    def count(self, name, n=1):
+        """Count n events, e.g. 'steps' or 'updates'."""
+        self._counts[name] += n
+        self.total_counts[name] += n
+
+    def scalar(self, name, value):
+        """Report the latest value of a gauge, e.g. the loss."""
+        self._scalars[name] = value
+
+    def step(self, iteration):
+        """Write a record if iteration is a multiple of log_freq."""
+        if self._log_file is not None and iteration % self.log_freq == 0:
+            self.flush(iteration)
+
+    def flush(self, iteration):
+        """Write the record of everything since the previous one."""
+        now = time.time()
+        elapsed = max(now - self._window_start, 1e-9)
+
+        record = {'iteration': iteration, 'time': now, 'elapsed': elapsed}
+        for name, n in self._counts.items():
+            record[name + '_per_sec'] = n / elapsed
+        for phase, total in self._phase_time.items():
+            record['phase_ms/' + phase] = 1000 * total / self._phase_calls[phase]
+            record['phase_frac/' + phase] = total / elapsed
+        record.update(self._scalars)
+
+        self._log_file.write(json.dumps(record, sort_keys=True) + '\n')
+        self._log_file.flush()
+
+        if self._summary_writer is not None:
+            import tensorflow as tf
+            values = [tf.Summary.Value(tag=tag, simple_value=float(value)) for tag, value in record.items()
+                      if tag not in ('iteration', 'time')]
+            self._summary_writer.add_summary(tf.Summary(value=values), iteration)
+
+        self._reset(now)
+
+    def close(self):
+        if self._log_file is not None:
+            self._log_file.close()
+        if self._summary_writer is not None:
+            self._summary_writer.close()
@@ -0,0 +1,239 @@
+"""Q-network inference in plain NumPy, without TensorFlow.
+
+For the small create_model networks a session run per action is mostly
+fixed overhead, and every actor process would carry a TensorFlow
+runtime just for an argmax. export_numpy_network writes the weights of
+a trained model to a .npz file, and NumpyQNetwork evaluates it with
+NumPy and BLAS only: the convolutions as one strided im2col view and
+one matrix multiply each.
+
+Everything after the convolutions is linear in create_model (the dense
+layers have no activation, the dueling combination is an affine map),
+so the export folds the dense layers and the dueling head into a
+single (features, num_actions) matrix. The ReLU after Flatten of the
+default layout is a no-op on ReLU outputs and is dropped. All LAYOUTS
+export to the same file, channels-first models get their flatten
+order converted.
+
+This module only imports NumPy. dqn_atari.py --numpy_model evaluates
+an .npz network with deeprl_hw2.evaluation.evaluate_network and never
+imports TensorFlow; benchmark.py --startup compares the RSS of that
+process with the frozen-graph evaluator. BLAS threads are set the
+usual way, e.g. OMP_NUM_THREADS=1.
+"""
+
+import os
+import time
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+
+def _layers(model, *class_names):
+    """Layers of the given classes, in the topological order of model.layers."""
+    return [layer for layer in model.layers if type(layer).__name__ in class_names]
+
+
+def _fold_head(model, num_actions):
+    """Fold the dense layers and the dueling head into one kernel and bias, in float64.
+
+    The layers are found by type and by how they are connected, not by
+    name, so models saved with the auto-generated Keras layer names
+    export too.
+    """
+    dense = _layers(model, 'Dense')
+    for layer in dense:
+        if layer.activation.__name__ != 'linear':
+            raise ValueError('Layer {} has a {} activation, only linear heads can be folded'.format(
+                layer.name, layer.activation.__name__))
+
+    def weights(layer):
+        return [w.astype(np.float64) for w in layer.get_weights()]
+
+    def fed_by(layer):
+        return [d for d in dense if d.input is layer.output]
+
+    # the hidden layers read the flattened features
+    num_features = int(np.prod(_layers(model, 'Flatten')[0].input_shape[1:]))
+    hidden = [d for d in dense if d.get_weights()[0].shape[0] == num_features]
+    outputs = [d for d in dense if d not in hidden]
+
+    if len(hidden) == 1 and len(outputs) == 1 and outputs[0].units == num_actions:
+        hidden_kernel, hidden_bias = weights(hidden[0])
+        kernel, bias = weights(outputs[0])
+        return [hidden_kernel.dot(kernel), hidden_bias.dot(kernel) + bias]
+
+    values = [d for d in dense if d.units == 1]
+    advantages = [d for d in dense if d.units == num_actions and d not in hidden]
+    if len(values) != 1 or len(advantages) != 1 or len(hidden) not in (1, 2):
+        raise ValueError('The dense layers of {} are not a create_model head'.format(model.name))
+    value, advantage = values[0], advantages[0]
+
+    if len(hidden) == 1:
+        # fused layout, value and advantage hidden layers side by side
+        duel_kernel, duel_bias = weights(hidden[0])
+        half = duel_kernel.shape[1] // 2
+        value_hidden = [duel_kernel[:, :half], duel_bias[:half]]
+        advantage_hidden = [duel_kernel[:, half:], duel_bias[half:]]
+    else:
+        value_hidden_layer = [h for h in hidden if value in fed_by(h)]
+        if len(value_hidden_layer) != 1:
+            raise ValueError('The dense layers of {} are not a create_model head'.format(model.name))
+        value_hidden = weights(value_hidden_layer[0])
+        advantage_hidden = weights([h for h in hidden if h is not value_hidden_layer[0]][0])
+    value_kernel, value_bias = weights(value)
+    advantage_kernel, advantage_bias = weights(advantage)
+
+    # q = value + advantage - mean(advantage), all affine in the features
+    advantage = advantage_hidden[0].dot(advantage_kernel)
+    advantage_const = advantage_hidden[1].dot(advantage_kernel) + advantage_bias
+    kernel = value_hidden[0].dot(value_kernel) + advantage - advantage.mean(axis=1, keepdims=True)
+    bias = value_hidden[1].dot(value_kernel) + value_bias + advantage_const - advantage_const.mean()
+
+    return [kernel.reshape(-1, num_actions), bias.reshape(num_actions)]
+
+
+def export_numpy_network(model, path, rtol=1e-3, atol=1e-3, num_checks=8):
+    """Write the weights of a create_model network for NumpyQNetwork.
+
+    Parameters
+    ----------
+    model: keras.models.Model
+      Any create_model variant and layout, its weights already loaded.
+      Layer names do not matter.
+    path: str
+      Output file, usually <model_num>.npz next to the checkpoint.
+    rtol, atol: float
+      The exported network is run on num_checks random states and
+      must match model.predict within these tolerances (np.allclose),
+      else the file is removed again and a ValueError is raised.
+    """
+    input_shape = tuple(model.input_shape[1:])
+    num_actions = model.output_shape[-1]
+    arrays = {'input_shape': np.array(input_shape)}
+
+    conv_layers = _layers(model, 'Conv2D', 'Convolution2D')
+    for i, layer in enumerate(conv_layers):
+        kernel, bias = layer.get_weights()
+        arrays['conv{}/kernel'.format(i)] = kernel
+        arrays['conv{}/bias'.format(i)] = bias
+        arrays['conv{}/stride'.format(i)] = np.array(layer.strides[0])
+
+    kernel, bias = _fold_head(model, num_actions)
+    flat_shape = tuple(_layers(model, 'Flatten')[0].input_shape[1:])
+    if conv_layers and conv_layers[0].data_format == 'channels_first':
+        # rows from the (C, H, W) flatten order to (H, W, C)
+        kernel = kernel.reshape(flat_shape + (-1, )).transpose(1, 2, 0, 3).reshape(-1, num_actions)
+    arrays['head/kernel'] = kernel.astype(np.float32)
+    arrays['head/bias'] = bias.astype(np.float32)
+
+    with open(path, 'wb') as npz_file:
+        np.savez(npz_file, **arrays)
+
+    states = np.random.RandomState(0).rand(num_checks, *input_shape).astype(np.float32)
+    expected = model.predict(states)
+    actual = NumpyQNetwork(path).calc_q_values(states)
+    if not np.allclose(actual, expected, rtol=rtol, atol=atol):
+        os.remove(path)
+        raise ValueError('The NumPy network differs from the model by up to {:.3g}'.format(
+            np.max(np.abs(actual - expected))))
+
+
+def _conv_relu(x, kernel, bias, stride, size):
+    """ReLU(valid convolution) of a (N, H, W, C) batch, kernel as (size * size * C, filters)."""
+    num, height, width, channels = x.shape
+    out_height = (height - size) // stride + 1
+    out_width = (width - size) // stride + 1
+
+    s_num, s_height, s_width, s_channels = x.strides
+    patches = as_strided(x, (num, out_height, out_width, size, size, channels),
+                         (s_num, s_height * stride, s_width * stride, s_height, s_width, s_channels))
+    out = np.dot(patches.reshape(-1, kernel.shape[0]), kernel)
+    out += bias
+    np.maximum(out, 0, out=out)
+
+    return out.reshape(num, out_height, out_width, -1)
+
+
+class NumpyQNetwork:
+    """Q-network loaded from an export_numpy_network file.
+
+    Has the calc_q_values of FrozenQNetwork, so it can stand in for it
+    as the inference_client of a DQNAgent.
+
+    Parameters
+    ----------
+    path: str
+      The exported .npz file.
+    """
+
+    def __init__(self, path):
+        with np.load(path) as data:
+            self.input_shape = tuple(data['input_shape'])
+            num_convs = len([k for k in data.keys() if k.endswith('/stride')])
+            self._convs = []
+            for i in xrange(num_convs):
+                kernel = data['conv{}/kernel'.format(i)]
+                self._convs.append((np.ascontiguousarray(kernel.reshape(-1, kernel.shape[-1])),
+                                    data['conv{}/bias'.format(i)], int(data['conv{}/stride'.format(i)]),
+                                    kernel.shape[0]))
+            self._head_kernel = data['head/kernel']
+            self._head_bias = data['head/bias']
+
+    def calc_q_values(self, state):
+        """Return the q values of a single state or a batch of states."""
+        x = np.ascontiguousarray(state, dtype=np.float32)
+        if x.ndim == len(self.input_shape):
+            x = x[np.newaxis]
+
+        for kernel, bias, stride, size in self._convs:
+            x = _conv_relu(x, kernel, bias, stride, size)
+
+        q_values = np.dot(x.reshape(len(x), -1), self._head_kernel)
+        q_values += self._head_bias
+
+        return q_values
+
+    def close(self):
+        pass
+
+
+def measure_numpy_inference(reference, network, states, num_calls=500):
+    """Compare a NumpyQNetwork with a TensorFlow network on states.
+
+    Parameters
+    ----------
+    reference: object
+      Anything with calc_q_values, e.g. a FrozenQNetwork or DQNAgent.
+    network: NumpyQNetwork
+    states: np.ndarray
+      (N, H, W, window) probe states.
+
+    Returns
+    -------
+    dict
+      max_abs_diff of the q values, agreement of the greedy actions,
+      mean per-action latency of both (tf_action_ms, numpy_action_ms)
+      and speedup.
+    """
+    expected = reference.calc_q_values(states)
+    actual = network.calc_q_values(states)
+
+    state = states[:1]
+    report = {'max_abs_diff': float(np.max(np.abs(actual - expected))),
+              'agreement': float(np.mean(np.argmax(actual, axis=1) == np.argmax(expected, axis=1))),
+              'tf_action_ms': _time_calls(lambda: reference.calc_q_values(state), num_calls),
+              'numpy_action_ms': _time_calls(lambda: network.calc_q_values(state), num_calls)}
+    report['speedup'] = report['tf_action_ms'] / report['numpy_action_ms']
+
+    return report
+
+
+def _time_calls(func, num_calls):
+    """Mean milliseconds per call, after one warm-up call."""
+    func()
+    start = time.time()
+    for _ in xrange(num_calls):
+        func()
+
+    return 1000 * (time.time() - start) / num_calls
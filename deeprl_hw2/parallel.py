@@ -0,0 +1,254 @@
+"""Synchronous data-parallel learner over local worker processes.
+
+The learner process keeps the only optimizer. Every update the
+minibatch is split into one shard per worker, the workers compute the
+gradients of their shard against the current weights, and the learner
+averages them and applies the result once. Shards, gradients and
+weights are exchanged through shared memory, the pipes only carry
+small control messages.
+"""
+
+import multiprocessing
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from deeprl_hw2.utils import initialize_updates_operations
+
+
+def _flat_size(shapes):
+    return sum(int(np.prod(shape)) for shape in shapes)
+
+
+def _split(flat, shapes):
+    """Cut a flat vector back into arrays of the given shapes."""
+    arrays = []
+    offset = 0
+    for shape in shapes:
+        size = int(np.prod(shape))
+        arrays.append(flat[offset:offset + size].reshape(shape))
+        offset += size
+
+    return arrays
+
+
+def _shared_array(typecode, dtype, shape):
+    """Allocate shared memory and return it with a numpy view on it."""
+    raw = multiprocessing.RawArray(typecode, int(np.prod(shape)))
+    return raw, np.frombuffer(raw, dtype=dtype).reshape(shape)
+
+
+def _worker_loop(rank, conn, build_model, num_actions, loss_func, max_grad, num_threads, buffers):
+    """Compute gradients of one shard per request until told to stop."""
+    import keras.backend as K
+    from deeprl_hw2.dqn import build_td_loss
+
+    states, actions, y_vals, grads, weights = buffers
+
+    with tf.Graph().as_default():
+        config = tf.ConfigProto(intra_op_parallelism_threads=num_threads, inter_op_parallelism_threads=1)
+        sess = tf.Session(config=config)
+        K.set_session(sess)
+
+        model = build_model()
+        y_true, action, loss = build_td_loss(model.output, num_actions, loss_func, max_grad)
+        variables = model.trainable_weights
+        shapes = [K.int_shape(v) for v in variables]
+        grad_ops = tf.gradients(loss, variables)
+        weight_phs, assign_ops = initialize_updates_operations(variables)
+
+        sess.run(tf.global_variables_initializer())
+
+        while True:
+            num_samples = conn.recv()
+            if num_samples is None:
+                break
+
+            # pick up the weights the learner published last
+            sess.run(assign_ops, feed_dict=dict(zip(weight_phs, _split(weights, shapes))))
+
+            grad_vals, loss_val = sess.run([grad_ops, loss],
+                                           feed_dict={model.input: states[rank, :num_samples],
+                                                      action: actions[rank, :num_samples],
+                                                      y_true: y_vals[rank, :num_samples]})
+
+            grads[rank] = np.concatenate([g.ravel() for g in grad_vals])
+            conn.send(loss_val)
+
+        sess.close()
+    conn.close()
+
+
+class DataParallelLearner:
+    """Averages Q-network gradients computed by local worker processes.
+
+    The workers are forked when the learner is created, so create it
+    before the training session is opened.
+
+    Parameters
+    ----------
+    build_model: callable
+      Returns a new online keras.models.Model. Called once in every
+      worker.
+    num_workers: int
+      Number of worker processes W.
+    shard_size: int
+      Largest number of samples a worker gets per update.
+    state_shape: tuple
+      Shape of a single network input, e.g. (84, 84, 4).
+    variable_shapes: list(tuple)
+      Shapes of the trainable weights of the model.
+    num_actions: int
+      Number of possible actions.
+    loss_func: callable
+      Loss of (y_true, y_pred, max_grad), e.g. mean_huber_loss.
+    max_grad: float
+      Parameter for the huber loss.
+    num_threads: int
+      TensorFlow intra-op threads of each worker.
+
+    Raises
+    ------
+    ValueError:
+      If num_workers < 1
+    """
+
+    def __init__(self, build_model, num_workers, shard_size, state_shape, variable_shapes, num_actions,
+                 loss_func, max_grad, num_threads=1):
+        if num_workers < 1:
+            raise ValueError('num_workers must be at least 1')
+
+        self.num_workers = num_workers
+        self.shard_size = shard_size
+        self.shapes = [tuple(shape) for shape in variable_shapes]
+        num_params = _flat_size(self.shapes)
+
+        raw_states, self._states = _shared_array('f', np.float32, (num_workers, shard_size) + tuple(state_shape))
+        raw_actions, self._actions = _shared_array('i', np.int32, (num_workers, shard_size))
+        raw_y_vals, self._y_vals = _shared_array('f', np.float32, (num_workers, shard_size))
+        raw_grads, self._grads = _shared_array('f', np.float32, (num_workers, num_params))
+        raw_weights, self._weights = _shared_array('f', np.float32, (num_params, ))
+        buffers = (self._states, self._actions, self._y_vals, self._grads, self._weights)
+
+        self._conns = []
+        self._workers = []
+        for rank in xrange(num_workers):
+            conn, worker_conn = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=_worker_loop,
+                                             args=(rank, worker_conn, build_model, num_actions, loss_func,
+                                                   max_grad, num_threads, buffers))
+            worker.daemon = True
+            worker.start()
+            self._conns.append(conn)
+            self._workers.append(worker)
+
+        self.sess = None
+
+    def compile(self, sess, optimizer, variables):
+        """Create the op applying the averaged gradients to variables."""
+        self.sess = sess
+        self._variables = list(variables)
+        self._grad_phs = [tf.placeholder(tf.float32, shape=shape) for shape in self.shapes]
+        self._apply_op = optimizer.apply_gradients(zip(self._grad_phs, self._variables))
+
+    def publish_weights(self):
+        """Copy the current weights into shared memory for the workers."""
+        values = self.sess.run(self._variables)
+        self._weights[:] = np.concatenate([v.ravel() for v in values])
+
+    def step(self, states, actions, y_vals):
+        """Run one synchronous update on a batch of W equal shards.
+
+        Returns
+        -------
+        float:
+          The mean loss over the shards.
+        """
+        num_samples = len(states) // self.num_workers
+        if num_samples * self.num_workers != len(states) or num_samples > self.shard_size:
+            raise ValueError('Batch of {} samples does not split into {} shards of at most {}'.format(
+                len(states), self.num_workers, self.shard_size))
+
+        for rank, conn in enumerate(self._conns):
+            shard = slice(rank * num_samples, (rank + 1) * num_samples)
+            self._states[rank, :num_samples] = states[shard]
+            self._actions[rank, :num_samples] = actions[shard]
+            self._y_vals[rank, :num_samples] = y_vals[shard]
+            conn.send(num_samples)
+
+        losses = [conn.recv() for conn in self._conns]
+
+        # all shards have the same size, so the mean of the shard
+        # gradients is the gradient of the whole batch
+        grads = self._grads.mean(axis=0)
+        self.sess.run(self._apply_op, feed_dict=dict(zip(self._grad_phs, _split(grads, self.shapes))))
+        self.publish_weights()
+
+        return np.mean(losses)
+
+    def close(self):
+        """Stop the worker processes."""
+        for conn in self._conns:
+            conn.send(None)
+        for worker in self._workers:
+            worker.join()
+        self._conns = []
+        self._workers = []
+
+
+def measure_scaling(build_model, state_shape, num_actions, worker_counts, shard_size, loss_func, max_grad,
+                    num_updates=50, num_warmup=5, num_threads=1):
+    """Measure learner throughput and scaling efficiency vs W.
+
+    Every worker gets a shard of shard_size random samples, so the
+    total batch grows with W. The efficiency of W workers is their
+    samples/sec divided by W times the samples/sec of one worker.
+
+    Returns
+    -------
+    list(dict)
+      One entry per worker count with the keys num_workers,
+      updates_per_sec, samples_per_sec and efficiency.
+    """
+    import keras.backend as K
+
+    results = []
+    for num_workers in worker_counts:
+        with tf.Graph().as_default():
+            model = build_model()
+            shapes = [K.int_shape(v) for v in model.trainable_weights]
+            learner = DataParallelLearner(build_model, num_workers, shard_size, state_shape, shapes, num_actions,
+                                          loss_func, max_grad, num_threads)
+
+            with tf.Session() as sess:
+                K.set_session(sess)
+                learner.compile(sess, tf.train.AdamOptimizer(), model.trainable_weights)
+                sess.run(tf.global_variables_initializer())
+                learner.publish_weights()
+
+                batch_size = num_workers * shard_size
+                states = np.random.rand(batch_size, *state_shape).astype(np.float32)
+                actions = np.random.randint(0, num_actions, batch_size)
+                y_vals = np.random.rand(batch_size).astype(np.float32)
+
+                for _ in xrange(num_warmup):
+                    learner.step(states, actions, y_vals)
+
+                start = time.time()
+                for _ in xrange(num_updates):
+                    learner.step(states, actions, y_vals)
+                elapsed = time.time() - start
+
+            learner.close()
+
+        updates_per_sec = num_updates / elapsed
+        results.append({'num_workers': num_workers,
+                        'updates_per_sec': updates_per_sec,
+                        'samples_per_sec': updates_per_sec * batch_size})
+
+    base = results[0]['samples_per_sec'] / results[0]['num_workers']
+    for result in results:
+        result['efficiency'] = result['samples_per_sec'] / (base * result['num_workers'])
+
+    return results
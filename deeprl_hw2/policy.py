@@ -3,10 +3,26 @@
 We have provided you with a base policy class, some example
 implementations and some unimplemented classes that should be useful
 in your code.
+
+All policies work on batches too: select_actions takes a
+(N, num_actions) Q matrix and returns N actions, and
+select_greedy_actions does the same starting from greedy actions that
+were already computed (e.g. by an argmax in the graph). The random
+choices come from a numpy RandomState, so a batch needs no Python loop.
 """
 import numpy as np
 import attr
-import random
+
+
+def _epsilon_greedy(greedy_actions, num_actions, epsilon, rng):
+    """Replace each greedy action by a random one with probability epsilon.
+
+    epsilon can be a float shared by all rows or one value per row.
+    """
+    num_rows = len(greedy_actions)
+    explore = rng.random_sample(num_rows) < epsilon
+
+    return np.where(explore, rng.randint(0, num_actions, num_rows), greedy_actions)
 
 
 class Policy:
@@ -22,14 +38,52 @@ class Policy:
     random action will be chosen.
     """
 
-    def select_action(self, **kwargs):
+    def select_action(self, q_values, is_training=True, **kwargs):
         """Used by agents to select actions.
 
+        Parameters
+        ----------
+        q_values: array-like
+          The Q-values of a single state, shape (num_actions, ) or
+          (1, num_actions).
+        is_training: bool, optional
+          Whether the agent is training.
+
+        Returns
+        -------
+        int:
+          The action index chosen.
+        """
+        q_values = np.reshape(q_values, (1, -1))
+        return int(self.select_actions(q_values, is_training)[0])
+
+    def select_actions(self, q_values, is_training=True):
+        """Select one action per row of a (N, num_actions) Q matrix.
+
         Returns
         -------
-        Any:
-          An object representing the chosen action. Type depends on
-          the hierarchy of policy instances.
+        np.ndarray:
+          N action indexes.
+        """
+        q_values = np.asarray(q_values)
+        return self.select_greedy_actions(np.argmax(q_values, axis=1), q_values.shape[1], is_training)
+
+    def select_greedy_actions(self, greedy_actions, num_actions, is_training=True):
+        """Select N actions given the N greedy actions.
+
+        Parameters
+        ----------
+        greedy_actions: np.ndarray
+          Index of the largest Q-value of each of the N states.
+        num_actions: int
+          Number of actions to choose from.
+        is_training: bool, optional
+          Whether the agent is training.
+
+        Returns
+        -------
+        np.ndarray:
+          N action indexes.
         """
         raise NotImplementedError('This method should be overriden.')
 
@@ -43,6 +97,8 @@ class UniformRandomPolicy(Policy):
     ----------
     num_actions: int
       Number of actions to choose from. Must be > 0.
+    seed: int, optional
+      Seed of the random number generator.
 
     Raises
     ------
@@ -50,11 +106,12 @@ class UniformRandomPolicy(Policy):
       If num_actions <= 0
     """
 
-    def __init__(self, num_actions):
+    def __init__(self, num_actions, seed=None):
         assert num_actions >= 1
         self.num_actions = num_actions
+        self.rng = np.random.RandomState(seed)
 
-    def select_action(self, **kwargs):
+    def select_action(self, q_values=None, is_training=True, **kwargs):
         """Return a random action index.
 
         This policy cannot contain others (as they would just be ignored).
@@ -64,7 +121,10 @@ class UniformRandomPolicy(Policy):
         int:
           Action index in range [0, num_actions)
         """
-        return np.random.randint(0, self.num_actions)
+        return self.rng.randint(0, self.num_actions)
+
+    def select_greedy_actions(self, greedy_actions, num_actions, is_training=True):  # noqa: D102
+        return self.rng.randint(0, self.num_actions, len(greedy_actions))
 
     def get_config(self):  # noqa: D102
         return {'num_actions': self.num_actions}
@@ -76,8 +136,8 @@ class GreedyPolicy(Policy):
     This is a pure exploitation policy.
     """
 
-    def select_action(self, q_values, **kwargs):  # noqa: D102
-        return np.argmax(q_values)
+    def select_greedy_actions(self, greedy_actions, num_actions, is_training=True):  # noqa: D102
+        return np.asarray(greedy_actions)
 
 
 class GreedyEpsilonPolicy(Policy):
@@ -88,40 +148,36 @@ class GreedyEpsilonPolicy(Policy):
 
     Parameters
     ----------
-    epsilon: float
+    epsilon: float, np.ndarray
      Initial probability of choosing a random action. Can be changed
-     over time.
+     over time. An array gives every environment of a batch its own
+     epsilon.
+    seed: int, optional
+      Seed of the random number generator.
     """
 
-    def __init__(self, epsilon):
+    def __init__(self, epsilon, seed=None):
         self.epsilon = epsilon
+        self.rng = np.random.RandomState(seed)
 
-    def select_action(self, q_values, **kwargs):
-        """Run Greedy-Epsilon for the given Q-values.
-
-        Parameters
-        ----------
-        q_values: array-like
-          Array-like structure of floats representing the Q-values for
-          each action.
+    def select_greedy_actions(self, greedy_actions, num_actions, is_training=True):
+        """Run Greedy-Epsilon for the given greedy actions.
 
         Returns
         -------
-        int:
-          The action index chosen.
+        np.ndarray:
+          The action indexes chosen.
         """
-        rand = random.random()
-        if rand < self.epsilon:
-            return random.randint(0, len(q_values) - 1)
-        else:
-            return np.argmax(q_values)
+        return _epsilon_greedy(greedy_actions, num_actions, self.epsilon, self.rng)
 
 
 class LinearDecayGreedyEpsilonPolicy(Policy):
     """Policy with a parameter that decays linearly.
 
     Like GreedyEpsilonPolicy but the epsilon decays from a start value
-    to an end value over k steps.
+    to an end value over k steps. The decay is precomputed as a
+    schedule array; every selected action is one step, so the N rows
+    of a batch get the next N epsilons of the schedule.
 
     Parameters
     ----------
@@ -131,49 +187,47 @@ class LinearDecayGreedyEpsilonPolicy(Policy):
       The value of the policy at the end of the decay.
     num_steps: int
       The number of steps over which to decay the value.
+    seed: int, optional
+      Seed of the random number generator.
 
     """
 
     def __init__(self, start_value, end_value,
-                 num_steps):  # noqa: D102
+                 num_steps, seed=None):  # noqa: D102
 
         self.start_value = start_value
         self.end_value = end_value
         self.epsilon = self.start_value
         self.num_steps = num_steps
-        self.decrement = float(end_value - start_value) / num_steps
+        self.schedule = np.linspace(start_value, end_value, num_steps + 1)
         self.curr_steps = 0
+        self.rng = np.random.RandomState(seed)
 
-    def select_action(self, q_values, is_training, **kwargs):
-        """Decay parameter and select action.
+    def select_greedy_actions(self, greedy_actions, num_actions, is_training=True):
+        """Decay parameter and select actions.
 
         Parameters
         ----------
-        q_values: np.array
-          The Q-values for each action.
+        greedy_actions: np.ndarray
+          The greedy action of each state.
+        num_actions: int
+          Number of actions to choose from.
         is_training: bool, optional
           If true then parameter will be decayed. Defaults to true.
 
         Returns
         -------
-        Any:
-          Selected action.
+        np.ndarray:
+          Selected actions.
         """
-        rand = random.random()
         if not is_training:
-            if rand < self.start_value:
-                return random.randint(0, len(q_values) - 1)
-            else:
-                return np.argmax(q_values)
-
-        if self.curr_steps < self.num_steps:
-            self.curr_steps += 1
-            self.epsilon += self.decrement
-
-        if rand < self.epsilon:
-            return random.randint(0, len(q_values) - 1)
-        else:
-            return np.argmax(q_values)
+            return _epsilon_greedy(greedy_actions, num_actions, self.start_value, self.rng)
+
+        steps = np.minimum(self.curr_steps + np.arange(1, len(greedy_actions) + 1), self.num_steps)
+        self.curr_steps = int(steps[-1])
+        self.epsilon = self.schedule[self.curr_steps]
+
+        return _epsilon_greedy(greedy_actions, num_actions, self.schedule[steps], self.rng)
 
     def reset(self):
         """Start the decay over at the start value."""
@@ -2,10 +2,8 @@
 
 import numpy as np
 from PIL import Image
-from sklearn.preprocessing import scale
-from deeprl_hw2 import utils
 from deeprl_hw2.core import Preprocessor
-import matplotlib.pyplot as plt
+
 
 class HistoryPreprocessor(Preprocessor):
     """Keeps the last k states.
@@ -106,7 +104,7 @@ class AtariPreprocessor(Preprocessor):
         outputs float32 images.
         """
         uint8_img = self.process_state_for_memory(state)
-        float_img = uint8_img / 255.0
+        float_img = np.divide(uint8_img, 255.0, dtype=np.float32)
         return float_img
 
     def process_batch(self, samples):
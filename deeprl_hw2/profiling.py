@@ -0,0 +1,122 @@
+"""On-demand profiling of the training loop.
+
+Two kinds of captures can be armed at any time, from the command line
+or by sending a signal to the running process:
+
+- SIGUSR1 traces the next trace_calls session runs of update_policy
+  and select_action with full TensorFlow run metadata and dumps each
+  as a Chrome trace (chrome://tracing) named
+  trace_<name>_<iteration>_<n>.json.
+- SIGUSR2 runs cProfile over the next profile_iterations iterations
+  of fit and dumps profile_<iteration>.prof plus a text summary.
+
+All files go to the output folder, next to the checkpoints.
+"""
+
+import cProfile
+import os
+import pstats
+import signal
+
+import tensorflow as tf
+from tensorflow.python.client import timeline
+
+TRACED_RUNS = ('update_policy', 'select_action')
+
+
+class Profiler:
+    """Captures TF step traces and Python profiles on request.
+
+    Parameters
+    ----------
+    output_folder: str
+      Folder the traces and profiles are written to.
+    trace_calls: int
+      Number of session runs of each traced kind per trace request.
+    profile_iterations: int
+      Number of fit iterations covered by a profile request.
+    trace_at: int, optional
+      Iteration at which a trace is requested.
+    profile_at: int, optional
+      Iteration at which a profile is requested.
+    """
+
+    def __init__(self, output_folder, trace_calls=10, profile_iterations=1000, trace_at=None, profile_at=None):
+        self.output_folder = output_folder
+        self.trace_calls = trace_calls
+        self.profile_iterations = profile_iterations
+        self.trace_at = trace_at
+        self.profile_at = profile_at
+
+        self.iteration = 0
+        self._trace_left = dict((name, 0) for name in TRACED_RUNS)
+        self._trace_requested = False
+        self._profile_requested = False
+        self._profile = None
+        self._profile_end = None
+
+    def install_signal_handlers(self):
+        """Request a trace on SIGUSR1 and a profile on SIGUSR2."""
+        signal.signal(signal.SIGUSR1, lambda signum, frame: self.request_trace())
+        signal.signal(signal.SIGUSR2, lambda signum, frame: self.request_profile())
+
+    def request_trace(self):
+        # only sets a flag, this runs inside a signal handler
+        self._trace_requested = True
+
+    def request_profile(self):
+        self._profile_requested = True
+
+    def step(self, iteration):
+        """Start and stop the requested captures, call once per iteration."""
+        self.iteration = iteration
+
+        if self._trace_requested or iteration == self.trace_at:
+            self._trace_requested = False
+            for name in TRACED_RUNS:
+                self._trace_left[name] = self.trace_calls
+            print "Tracing the next {} session runs".format(self.trace_calls)
+
+        if self._profile is not None and iteration >= self._profile_end:
+            self._dump_profile()
+
+        if self._profile is None and (self._profile_requested or iteration == self.profile_at):
+            self._profile_requested = False
+            self._profile_end = iteration + self.profile_iterations
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+            print "Profiling the next {} iterations".format(self.profile_iterations)
+
+    def run(self, sess, name, fetches, feed_dict):
+        """sess.run that records run metadata while a trace of name is armed."""
+        if not self._trace_left.get(name):
+            return sess.run(fetches, feed_dict=feed_dict)
+
+        run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+        run_metadata = tf.RunMetadata()
+        result = sess.run(fetches, feed_dict=feed_dict, options=run_options, run_metadata=run_metadata)
+
+        self._trace_left[name] -= 1
+        trace = timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format()
+        file_name = 'trace_{}_{}_{}.json'.format(name, self.iteration, self.trace_calls - self._trace_left[name])
+        with open(os.path.join(self.output_folder, file_name), 'w') as trace_file:
+            trace_file.write(trace)
+
+        return result
+
+    def close(self):
+        """Dump a profile that is still running."""
+        if self._profile is not None:
+            self._dump_profile()
+
+    def _dump_profile(self):
+        self._profile.disable()
+        path = os.path.join(self.output_folder, 'profile_{}.prof'.format(self.iteration))
+        self._profile.dump_stats(path)
+
+        with open(path[:-len('.prof')] + '.txt', 'w') as summary_file:
+            stats = pstats.Stats(path, stream=summary_file)
+            stats.sort_stats('cumulative').print_stats(50)
+
+        print "Saved profile to " + path
+        self._profile = None
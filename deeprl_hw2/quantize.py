@@ -0,0 +1,149 @@
+"""Post-training eight-bit quantization of exported Q-networks.
+
+Starts from the frozen float graph written by export_inference_graph
+and rewrites it with the TensorFlow graph transforms: the weights are
+stored as eight-bit constants and the convolutions and dense layers run
+as quantized ops. The requantization ranges of the activations are
+calibrated on a probe set of states and frozen into the graph, so no
+float ranges are computed while acting. The result has the same input
+and output names, so FrozenQNetwork loads it like the float graph.
+
+A quantized graph is only kept if its greedy actions agree with the
+float graph on the probe set.
+"""
+
+import os
+
+import numpy as np
+import tensorflow as tf
+
+from deeprl_hw2.export import OUTPUT_NAME, FrozenQNetwork, _time_calls
+
+
+def _load_graph_def(path):
+    graph_def = tf.GraphDef()
+    with open(path, 'rb') as pb_file:
+        graph_def.ParseFromString(pb_file.read())
+    return graph_def
+
+
+def _run_logging_stderr(graph_def, input_name, states, log_path):
+    """Run the graph on states with stderr, where the ranges get logged, sent to log_path."""
+    with tf.Graph().as_default() as graph:
+        state, q_values = tf.import_graph_def(graph_def, return_elements=[input_name + ':0', OUTPUT_NAME + ':0'],
+                                              name='')
+        with tf.Session(graph=graph) as sess:
+            stderr_fd = os.dup(2)
+            with open(log_path, 'w') as log_file:
+                os.dup2(log_file.fileno(), 2)
+                try:
+                    for start in xrange(0, len(states), 32):
+                        sess.run(q_values, feed_dict={state: states[start:start + 32]})
+                finally:
+                    os.dup2(stderr_fd, 2)
+                    os.close(stderr_fd)
+
+
+def action_agreement(reference, candidate, states):
+    """Fraction of states on which both networks pick the same greedy action."""
+    reference_actions = np.argmax(reference.calc_q_values(states), axis=1)
+    candidate_actions = np.argmax(candidate.calc_q_values(states), axis=1)
+    return float(np.mean(reference_actions == candidate_actions))
+
+
+def quantize_inference_graph(pb_path, quantized_path, probe_states, min_agreement=0.95):
+    """Write the eight-bit version of a frozen Q-network graph.
+
+    Parameters
+    ----------
+    pb_path: str
+      Frozen float graph from export_inference_graph.
+    quantized_path: str
+      Output file, usually <model_num>.int8.pb.
+    probe_states: np.ndarray
+      (N, H, W, window) states used to calibrate the activation ranges
+      and to check the greedy actions.
+    min_agreement: float
+      Smallest accepted fraction of probe states with the same greedy
+      action as the float graph. Below it the quantized graph is
+      removed again and a ValueError is raised.
+
+    Returns
+    -------
+    float
+      The action agreement on the probe set.
+    """
+    from tensorflow.tools.graph_transforms import TransformGraph
+
+    graph_def = _load_graph_def(pb_path)
+    input_name = [node.name for node in graph_def.node if node.op == 'Placeholder'][0]
+    inputs, outputs = [input_name], [OUTPUT_NAME]
+
+    quantized = TransformGraph(graph_def, inputs, outputs,
+                               ['fold_constants(ignore_errors=true)', 'quantize_weights', 'quantize_nodes',
+                                'strip_unused_nodes', 'sort_by_execution_order'])
+
+    # calibrate: log the activation ranges on the probe set, then freeze them
+    log_path = quantized_path + '.ranges.log'
+    logged = TransformGraph(quantized, inputs, outputs,
+                            ['insert_logging(op=RequantizationRange, show_name=true, '
+                             'message="__requant_min_max:")'])
+    _run_logging_stderr(logged, input_name, probe_states, log_path)
+    quantized = TransformGraph(quantized, inputs, outputs,
+                               ['freeze_requantization_ranges(min_max_log_file="{}")'.format(log_path)])
+    os.remove(log_path)
+
+    with open(quantized_path, 'wb') as pb_file:
+        pb_file.write(quantized.SerializeToString())
+
+    reference = FrozenQNetwork(pb_path)
+    candidate = FrozenQNetwork(quantized_path)
+    agreement = action_agreement(reference, candidate, probe_states)
+    reference.close()
+    candidate.close()
+
+    if agreement < min_agreement:
+        os.remove(quantized_path)
+        raise ValueError('The quantized network agrees with the float network on {:.1%} of the probe states, '
+                         'less than {:.1%}'.format(agreement, min_agreement))
+
+    return agreement
+
+
+def collect_probe_states(env_name, preprocessor, frame_shape, window, num_states, seed=0):
+    """Stack num_states random-policy states of env_name, like fit sees them."""
+    from deeprl_hw2.burn_in import collect_random
+    from deeprl_hw2.core import ReplayMemory
+
+    num_steps = 2 * num_states + window + 1
+    memory = ReplayMemory(num_steps, window, frame_shape)
+    memory.extend(*collect_random(env_name, preprocessor, frame_shape, num_steps, 1, seed))
+
+    return memory.sample(num_states)[0]
+
+
+def measure_quantization(pb_path, quantized_path, probe_states, num_calls=500):
+    """Compare the float and the eight-bit graph.
+
+    Returns
+    -------
+    dict
+      agreement on the probe states, mean per-action latency of both
+      graphs (float_action_ms, int8_action_ms), speedup, and the file
+      sizes float_mb / int8_mb, i.e. what a weight broadcast costs.
+    """
+    reference = FrozenQNetwork(pb_path)
+    candidate = FrozenQNetwork(quantized_path)
+
+    state = probe_states[:1]
+    report = {'agreement': action_agreement(reference, candidate, probe_states),
+              'float_action_ms': _time_calls(lambda: reference.calc_q_values(state), num_calls),
+              'int8_action_ms': _time_calls(lambda: candidate.calc_q_values(state), num_calls),
+              'float_mb': os.path.getsize(pb_path) / 2.0 ** 20,
+              'int8_mb': os.path.getsize(quantized_path) / 2.0 ** 20}
+    report['speedup'] = report['float_action_ms'] / report['int8_action_ms']
+
+    reference.close()
+    candidate.close()
+
+    return report
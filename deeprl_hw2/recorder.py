@@ -0,0 +1,200 @@
+"""Record the transitions of a run as a dataset on disk.
+
+The recorder writes the shard format read by deeprl_hw2.dataset:
+fixed-size, chunked and compressed HDF5 shards of the frames, actions,
+rewards and terminals given to the replay memory.
+"""
+
+import os
+import threading
+import time
+from Queue import Queue
+
+import numpy as np
+
+from deeprl_hw2.dataset import FIELDS, SHARD_PATTERN
+
+_STOP = None
+
+
+class TransitionRecorder:
+    """Streams transitions into compressed shards from a background thread.
+
+    record only copies the transition into the current in-memory
+    buffer. Full buffers are handed to the writer thread, which
+    appends them to the open shard. The buffers come from a fixed pool
+    of max_pending + 1, so the memory used is bounded; if the writer
+    falls behind, record blocks until a buffer is free and the wait is
+    reported as stall. An error of the writer thread is raised from
+    the next record or close.
+
+    Parameters
+    ----------
+    directory: str
+      Where the shards are written, created if missing.
+    num_actions: int
+      Stored in the shard attributes.
+    env_name: str
+      Stored in the shard attributes.
+    shard_size: int
+      Transitions per shard, the last shard may be shorter.
+    buffer_size: int
+      Transitions per buffer, also the HDF5 chunk length.
+    max_pending: int
+      Full buffers that may wait for the writer.
+    compression: str
+      HDF5 compression filter of the datasets, lzf is cheap enough
+      to keep up with the acting loop.
+    """
+
+    def __init__(self, directory, num_actions, env_name, shard_size=100000, buffer_size=4096, max_pending=4,
+                 compression='lzf'):
+        if shard_size % buffer_size != 0:
+            raise ValueError('shard_size must be a multiple of buffer_size')
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.directory = directory
+        self.num_actions = num_actions
+        self.env_name = env_name
+        self.shard_size = shard_size
+        self.buffer_size = buffer_size
+        self.max_pending = max_pending
+        self.compression = compression
+
+        self.num_recorded = 0
+        self.record_time = 0.0
+        self.stall_time = 0.0
+        self.bytes_written = 0
+        self.write_time = 0.0
+
+        # buffers are allocated on the first record, once the frame shape is known
+        self._free = None
+        self._buffer = None
+        self._fill = 0
+        self._pending = Queue()
+        self._thread = None
+        self._error = None
+
+    def _allocate(self, frame):
+        self._free = Queue()
+        for _ in xrange(self.max_pending + 1):
+            self._free.put((np.empty((self.buffer_size, ) + frame.shape, dtype=np.uint8),
+                            np.empty(self.buffer_size, dtype=np.int32),
+                            np.empty(self.buffer_size, dtype=np.float32),
+                            np.empty(self.buffer_size, dtype=np.bool_)))
+        self._buffer = self._free.get()
+
+        self._thread = threading.Thread(target=self._write_loop, args=(frame.shape, ))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def record(self, frame, action, reward, is_terminal):
+        """Record one transition, as given to memory.append."""
+        self._raise_error()
+
+        start = time.time()
+        if self._buffer is None:
+            self._allocate(frame)
+
+        frames, actions, rewards, terminals = self._buffer
+        i = self._fill
+        frames[i] = frame
+        actions[i] = action
+        rewards[i] = reward
+        terminals[i] = is_terminal
+        self._fill += 1
+        self.num_recorded += 1
+
+        if self._fill == self.buffer_size:
+            self._pending.put((self._buffer, self._fill))
+            wait_start = time.time()
+            self._buffer = self._free.get()
+            self.stall_time += time.time() - wait_start
+            self._fill = 0
+
+        self.record_time += time.time() - start
+
+    def _open_shard(self, index, frame_shape):
+        import h5py
+
+        f = h5py.File(os.path.join(self.directory, SHARD_PATTERN.format(index)), 'w')
+        f.attrs['num_actions'] = self.num_actions
+        f.attrs['env_name'] = self.env_name
+        shapes = ((frame_shape, np.uint8), ((), np.int32), ((), np.float32), ((), np.bool_))
+        for field, (shape, dtype) in zip(FIELDS, shapes):
+            f.create_dataset(field, shape=(self.shard_size, ) + shape, maxshape=(self.shard_size, ) + shape,
+                             dtype=dtype, chunks=(self.buffer_size, ) + shape, compression=self.compression)
+        return f
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def _write_loop(self, frame_shape):
+        shard, shard_index, shard_fill = None, 0, 0
+        while True:
+            item = self._pending.get()
+            if item is _STOP:
+                break
+            buf, size = item
+            if self._error is not None:
+                # keep handing buffers back, so record does not block
+                self._free.put(buf)
+                continue
+
+            start = time.time()
+            try:
+                if shard is None:
+                    shard = self._open_shard(shard_index, frame_shape)
+                for field, values in zip(FIELDS, buf):
+                    shard[field][shard_fill:shard_fill + size] = values[:size]
+                    self.bytes_written += values[:size].nbytes
+                shard_fill += size
+
+                if shard_fill == self.shard_size:
+                    shard.close()
+                    shard, shard_index, shard_fill = None, shard_index + 1, 0
+            except Exception as e:
+                self._error = e
+            self._free.put(buf)
+            self.write_time += time.time() - start
+
+        if shard is not None:
+            try:
+                # the last shard only holds what was recorded
+                if self._error is None:
+                    for field in FIELDS:
+                        shard[field].resize(shard_fill, axis=0)
+                shard.close()
+            except Exception as e:
+                self._error = self._error or e
+
+    def close(self):
+        """Write the partially filled buffer and wait for the writer."""
+        if self._thread is None:
+            return
+        if self._fill:
+            self._pending.put((self._buffer, self._fill))
+        self._pending.put(_STOP)
+        self._thread.join()
+        self._thread = None
+        self._raise_error()
+
+    def report(self):
+        """Return the recording statistics.
+
+        Returns
+        -------
+        dict
+          num_recorded, megabytes (uncompressed), write_mb_per_sec of
+          the writer thread, record_us_per_step spent in record and
+          stall_s spent waiting for a free buffer.
+        """
+        megabytes = self.bytes_written / float(1 << 20)
+        return {'num_recorded': self.num_recorded,
+                'megabytes': megabytes,
+                'write_mb_per_sec': megabytes / self.write_time if self.write_time else 0.0,
+                'record_us_per_step': 1e6 * self.record_time / max(self.num_recorded, 1),
+                'stall_s': self.stall_time}
@@ -0,0 +1,137 @@
+"""Online controller of the number of updates per env step.
+
+With a fixed train_freq the loop does one update every train_freq
+steps, whatever the cost of an env step and of an update on this
+machine and network. Acting and updating run one after the other in
+the same loop, so the updates per step only decide how the loop time
+is split between the two; they cannot put idle cores to work.
+
+The controller measures the seconds per env step and per update
+online and proposes the updates per step that give the learner the
+target share of the loop time. A feedback term adds the updates
+owed to (or run ahead of) the train_freq schedule, spread over the
+next adjust_every steps. The learner share therefore only moves
+updates earlier or later: the realized replay ratio (sampled
+transitions per env step) converges to the one train_freq gives, and
+the updates per step stay within max_deviation of it.
+"""
+
+import json
+
+
+class ReplayRatioController:
+    """Decides how many updates to run after every env step.
+
+    Parameters
+    ----------
+    batch_size: int
+      Samples per update, to express the ratio in transitions.
+    train_freq: int
+      The fixed schedule, one update every train_freq steps, which is
+      also the starting point and the centre of the bounds.
+    max_deviation: float
+      The updates per step stay within [1 / (train_freq *
+      max_deviation), max_deviation / train_freq].
+    learner_share: float
+      Fraction of the loop time the proposed updates per step give
+      the learner, before the feedback term.
+    adjust_every: int
+      Env steps between two adjustments.
+    smoothing: float
+      Weight of the old value in the moving averages of the step and
+      update times and of the updates per step.
+    log_path: str, optional
+      Every decision is appended to this JSONL file.
+    """
+
+    def __init__(self, batch_size, train_freq, max_deviation=2.0, learner_share=0.5, adjust_every=1000,
+                 smoothing=0.8, log_path=None):
+        self.batch_size = batch_size
+        self.target = 1.0 / train_freq
+        self.min_updates_per_step = self.target / max_deviation
+        self.max_updates_per_step = self.target * max_deviation
+        self.learner_share = learner_share
+        self.adjust_every = adjust_every
+        self.smoothing = smoothing
+        self._log_file = open(log_path, 'a') if log_path is not None else None
+
+        self.updates_per_step = self.target
+        self.proposed_updates_per_step = self.target
+        self.step_seconds = None
+        self.update_seconds = None
+        self.num_steps = 0
+        self.num_updates = 0
+        self._credit = 0.0
+        self._window_step_time = 0.0
+        self._window_steps = 0
+        self._window_update_time = 0.0
+        self._window_updates = 0
+
+    def step_done(self, seconds):
+        """Record the time of one env step, return the updates to run now."""
+        self.num_steps += 1
+        self._window_step_time += seconds
+        self._window_steps += 1
+
+        self._credit += self.updates_per_step
+        num_updates = int(self._credit)
+        self._credit -= num_updates
+
+        return num_updates
+
+    def update_done(self, seconds):
+        self.num_updates += 1
+        self._window_update_time += seconds
+        self._window_updates += 1
+
+    def _average(self, old, new):
+        return new if old is None else self.smoothing * old + (1 - self.smoothing) * new
+
+    def adjust(self, iteration):
+        """Retune updates_per_step every adjust_every steps.
+
+        Returns
+        -------
+        dict or None
+          The logged decision, None if it was not time to adjust yet.
+        """
+        if self._window_steps < self.adjust_every or not self._window_updates:
+            return None
+
+        self.step_seconds = self._average(self.step_seconds, self._window_step_time / self._window_steps)
+        self.update_seconds = self._average(self.update_seconds, self._window_update_time / self._window_updates)
+        self._window_step_time, self._window_steps = 0.0, 0
+        self._window_update_time, self._window_updates = 0.0, 0
+
+        # learner share u * t_u / (t_s + u * t_u) solved for u
+        share = self.learner_share / (1 - self.learner_share)
+        proposed = share * self.step_seconds / self.update_seconds
+        self.proposed_updates_per_step = self._average(self.proposed_updates_per_step, proposed)
+
+        # pay back what the schedule is owed over the next window, so
+        # the realized ratio does not drift with the proposal
+        owed_updates = self.target * self.num_steps - self.num_updates - self._credit
+        wanted = self.proposed_updates_per_step + owed_updates / self.adjust_every
+        self.updates_per_step = min(max(wanted, self.min_updates_per_step), self.max_updates_per_step)
+
+        decision = {'iteration': iteration,
+                    'steps_per_sec': 1.0 / self.step_seconds,
+                    'updates_per_sec': 1.0 / self.update_seconds,
+                    'updates_per_step': self.updates_per_step,
+                    'owed_updates': owed_updates,
+                    'replay_ratio': self.updates_per_step * self.batch_size,
+                    'target_replay_ratio': self.target * self.batch_size,
+                    'realized_replay_ratio': self.realized_replay_ratio()}
+        if self._log_file is not None:
+            self._log_file.write(json.dumps(decision, sort_keys=True) + '\n')
+            self._log_file.flush()
+
+        return decision
+
+    def realized_replay_ratio(self):
+        """Sampled transitions per env step over the whole run."""
+        return self.num_updates * self.batch_size / float(max(self.num_steps, 1))
+
+    def close(self):
+        if self._log_file is not None:
+            self._log_file.close()
@@ -0,0 +1,90 @@
+"""Deterministic synthetic Atari-like environment for benchmarks.
+
+Behaves like the gym Atari environments as far as DQNAgent is
+concerned: 210x160 RGB uint8 frames, a discrete action space and
+env.env.ale.lives(). Frames come from a small pool of seeded random
+images, so stepping costs almost nothing and every run sees exactly
+the same sequence. Importing this module registers it with gym as
+SyntheticAtari-v0, which makes gym.make (used by evaluate_no_render)
+work with it too.
+"""
+
+import gym
+import numpy as np
+from gym import spaces
+
+ENV_NAME = 'SyntheticAtari-v0'
+
+
+class _SyntheticALE:
+    """Stands in for env.ale, only lives() is used."""
+
+    def __init__(self, env):
+        self._env = env
+
+    def lives(self):
+        return self._env.lives
+
+
+class SyntheticAtariEnv(gym.Env):
+    """Seeded random frames, periodic rewards, lives and terminals.
+
+    Parameters
+    ----------
+    num_actions: int
+      Size of the discrete action space.
+    episode_length: int
+      Steps until the episode terminates.
+    num_lives: int
+      Lives at the start of an episode, one is lost every
+      episode_length // num_lives steps.
+    num_frames: int
+      Size of the pool of distinct frames.
+    seed: int
+      Seed of the frames, rewards and action sampling.
+    """
+
+    metadata = {'render.modes': []}
+
+    def __init__(self, num_actions=6, episode_length=500, num_lives=3, num_frames=64, seed=0):
+        self.action_space = spaces.Discrete(num_actions)
+        self.observation_space = spaces.Box(low=0, high=255, shape=(210, 160, 3))
+        self.episode_length = episode_length
+        self.num_lives = num_lives
+        self.ale = _SyntheticALE(self)
+
+        self._rng = np.random.RandomState(seed)
+        self._frames = self._rng.randint(0, 256, size=(num_frames, 210, 160, 3)).astype(np.uint8)
+        self.action_space.np_random = np.random.RandomState(seed)
+        self._t = 0
+        self.lives = num_lives
+
+    def reset(self):
+        self._t = 0
+        self.lives = self.num_lives
+        return self._frames[0].copy()
+
+    def step(self, action):
+        self._t += 1
+        frame = self._frames[(self._t * 7 + int(action)) % len(self._frames)].copy()
+
+        # a reward every few steps, more for the "right" action
+        reward = 1.0 if self._t % 5 == 0 and int(action) == self._t % self.action_space.n else 0.0
+        if self._t % (self.episode_length // self.num_lives) == 0:
+            self.lives -= 1
+
+        is_terminal = self._t >= self.episode_length
+        return frame, reward, is_terminal, {}
+
+    def seed(self, seed=None):
+        self._rng = np.random.RandomState(seed)
+        return [seed]
+
+    def render(self, mode='human', close=False):
+        pass
+
+
+# the time limit wrapper provides the env.env the agent expects
+if ENV_NAME not in [spec.id for spec in gym.envs.registry.all()]:
+    gym.envs.registration.register(id=ENV_NAME, entry_point='deeprl_hw2.synthetic:SyntheticAtariEnv',
+                                   max_episode_steps=10 ** 9)
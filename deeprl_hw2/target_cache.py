@@ -0,0 +1,67 @@
+"""Cache of target-network q values keyed by replay memory slot.
+
+Between two target syncs the target network does not change, so the
+target q values of a sampled transition only have to be computed the
+first time its slot is sampled. The agent invalidates the whole cache
+on every target sync and the slots whose next state covers a frame
+when the ring buffer overwrites it.
+"""
+
+import numpy as np
+
+
+class TargetQCache:
+    """Lazily filled (max_size, num_actions) table of target q values.
+
+    Parameters
+    ----------
+    max_size: int
+      Number of replay memory slots.
+    num_actions: int
+      Width of a row of q values.
+    """
+
+    def __init__(self, max_size, num_actions):
+        self.max_size = max_size
+        self.values = np.zeros((max_size, num_actions), dtype=np.float32)
+        self.valid = np.zeros(max_size, dtype=bool)
+
+        self.hits = 0
+        self.misses = 0
+        self.syncs = 0
+
+    def lookup(self, slots):
+        """Return the mask of slots that have cached q values."""
+        hit = self.valid[slots]
+        num_hits = int(np.count_nonzero(hit))
+        self.hits += num_hits
+        self.misses += len(slots) - num_hits
+        return hit
+
+    def fill(self, slots, q_values):
+        self.values[slots] = q_values
+        self.valid[slots] = True
+
+    def invalidate_all(self):
+        """Drop everything, the target network has changed."""
+        self.valid[:] = False
+        self.syncs += 1
+
+    def invalidate_write(self, index, window_length):
+        """Drop the slots whose next state contains the frame at index.
+
+        A sample at slot i uses the frames i .. i + window_length, so
+        overwriting frame index affects slots index - window_length to
+        index.
+        """
+        slots = np.arange(index - window_length, index + 1) % self.max_size
+        self.valid[slots] = False
+
+    def report(self):
+        """Return hits, misses and hit_rate; every hit is a row of the
+        target forward pass that was not computed."""
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / float(lookups) if lookups else 0.0,
+                'syncs': self.syncs}
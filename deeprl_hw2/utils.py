@@ -1,9 +1,12 @@
 """Common functions you may find useful in your implementation."""
 
-import semver
-import tensorflow as tf
+import contextlib
+
 import numpy as np
 
+# tensorflow and semver are imported where they are used, the NumPy
+# evaluation path needs get_init_state and StateStack without them
+
 
 def get_uninitialized_variables(variables=None):
     """Return a list of uninitialized tf variables.
@@ -20,6 +23,9 @@ def get_uninitialized_variables(variables=None):
     list(tf.Variable)
       List of uninitialized tf variables.
     """
+    import semver
+    import tensorflow as tf
+
     sess = tf.get_default_session()
     if variables is None:
         variables = tf.global_variables()
@@ -41,6 +47,8 @@ def get_uninitialized_variables(variables=None):
 
 # Tears of the debugging...
 def initialize_updates_operations(target_vars):
+    import tensorflow as tf
+
     # placeholders for updating the online network
     update_phs = [tf.placeholder(tf.float32, shape=var.get_shape()) for var in target_vars]
     # update operations
@@ -106,6 +114,24 @@ def get_hard_target_model_updates(target, source):
     target.set_weights(source.get_weights())
 
 
+@contextlib.contextmanager
+def jit_scope(enabled=True):
+    """Mark the ops created inside for XLA JIT compilation.
+
+    The marked ops are clustered and compiled on their first run,
+    once per input shape, on CPU too. With enabled=False this does
+    nothing, so callers can wrap graph construction unconditionally.
+    """
+    if not enabled:
+        yield
+        return
+
+    from tensorflow.contrib.compiler import jit
+
+    with jit.experimental_jit_scope():
+        yield
+
+
 def get_init_state(env, preprocessor):
     """ Return initial state of the network
     :param env: environment of the game
@@ -118,3 +144,42 @@ def get_init_state(env, preprocessor):
                               [env.step(0)[0] for _ in xrange(4)]), axis=2)
 
     return init_state
+
+
+class StateStack:
+    """The network input state, updated in place every step.
+
+    Two preallocated float32 (1, H, W, window) buffers take turns: push
+    writes the shifted previous state and the new frame into the other
+    buffer, so the previous state stays valid until the next push and
+    no array is allocated per step.
+
+    Parameters
+    ----------
+    init_state: np.ndarray
+      The (H, W, window) state every episode starts from, see
+      get_init_state.
+    """
+
+    def __init__(self, init_state):
+        self._init_state = init_state.astype(np.float32)
+        buffers = [np.empty((1, ) + init_state.shape, dtype=np.float32) for _ in xrange(2)]
+        # views are made once, indexing a buffer would create new ones
+        self._states = [b[0] for b in buffers]
+        self._heads = [s[..., :-1] for s in self._states]
+        self._tails = [s[..., 1:] for s in self._states]
+        self._lasts = [s[..., -1] for s in self._states]
+        self._current = 0
+
+    def reset(self):
+        """Start over from the initial state and return it."""
+        self._current = 0
+        np.copyto(self._states[0], self._init_state)
+        return self._states[0]
+
+    def push(self, frame):
+        """Shift in a uint8 frame from process_state_for_memory, return the new state."""
+        previous, self._current = self._current, 1 - self._current
+        np.copyto(self._heads[self._current], self._tails[previous])
+        np.divide(frame, 255.0, out=self._lasts[self._current], dtype=np.float32)
+        return self._states[self._current]
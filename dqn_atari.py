@@ -3,27 +3,32 @@
 import argparse
 import os
 import random
+import resource
+import sys
+import time
 
 import numpy as np
-import tensorflow as tf
-from keras.layers import (Activation, Conv2D, Dense, Flatten, Input, Lambda)
-from keras.models import model_from_json
 
-from keras.models import Model
-
-import deeprl_hw2 as tfrl
-from deeprl_hw2.dqn import DQNAgent
-from deeprl_hw2.objectives import mean_huber_loss
-from deeprl_hw2.preprocessors import AtariPreprocessor
 from deeprl_hw2.core import *
 from deeprl_hw2.policy import *
 
-import gym
+# TensorFlow, Keras and gym are imported where they are needed, so
+# --help and processes that never build a model start quickly
+
 
-import keras.backend as K
+# Network layouts create_model can build, see create_model
+LAYOUTS = ('default', 'fused', 'fused_nchw')
 
+# (filters, kernel size, stride) of the convolutional layers
+CONV_LAYERS = {
+    'deep_q_network': [(16, 8, 4), (32, 4, 2)],
+    'deep_q_network_double': [(32, 8, 4), (64, 4, 2), (64, 3, 1)],
+    'deep_q_network_duel': [(32, 8, 4), (64, 4, 2), (64, 3, 1)],
+}
 
-def create_model(window, input_shape, num_actions, model_name='deep_q_network', trainable=True):  # noqa: D103
+
+def create_model(window, input_shape, num_actions, model_name='deep_q_network', trainable=True,
+                 layout='default'):  # noqa: D103
     """Create the Deep-Q-network model.
 
     Use Keras to construct a keras.models.Model instance (you can also
@@ -45,94 +50,108 @@ def create_model(window, input_shape, num_actions, model_name='deep_q_network',
       Number of possible actions. Defined by the gym environment.
     model_name: str
       Useful when debugging. Makes the model show up nicer in tensorboard.
+    layout: str
+      One of LAYOUTS. 'default' is the original network. 'fused' fuses
+      the ReLUs into the conv layers, drops the ReLU after Flatten
+      (its input is already non-negative) and computes the two hidden
+      layers of the dueling head as one Dense layer and the dueling
+      combination in one Lambda. 'fused_nchw' additionally stores the
+      conv activations channels-first, which needs a TensorFlow build
+      with NCHW CPU kernels (e.g. MKL). All layouts compute the same
+      function, convert_weights copies weights between them.
 
     Returns
     -------
     keras.models.Model
       The Q-model.
     """
+    import keras.backend as K
+    from keras.layers import (Activation, Conv2D, Dense, Flatten, Input, Lambda, Permute)
+    from keras.models import Model
+
+    if layout not in LAYOUTS:
+        print "Layout not supported"
+        exit(1)
 
     input_shape = (input_shape[0], input_shape[1], window)
     state = Input(shape=input_shape)
     model = None
 
-    if model_name == "deep_q_network":
-        print "Building " + model_name + " ..."
+    def conv_features(x):
+        data_format = 'channels_last'
+        if layout == 'fused_nchw':
+            # the input stays (84, 84, window), transpose once in-graph
+            x = Permute((3, 1, 2))(x)
+            data_format = 'channels_first'
+
+        for i, (filters, kernel, stride) in enumerate(CONV_LAYERS[model_name]):
+            name = 'conv{}'.format(i + 1)
+            if layout == 'default':
+                x = Conv2D(filters=filters, kernel_size=(kernel, kernel), strides=(stride, stride),
+                           padding='valid', trainable=trainable, name=name)(x)
+                x = Activation('relu')(x)
+            else:
+                x = Conv2D(filters=filters, kernel_size=(kernel, kernel), strides=(stride, stride),
+                           padding='valid', activation='relu', data_format=data_format, trainable=trainable,
+                           name=name)(x)
 
-        # First convolutional layer
-        x = Conv2D(filters=16, kernel_size=(8, 8), strides=(4, 4), padding='valid', trainable=trainable)(state)
-        x = Activation('relu')(x)
-        # Second convolutional layer
-        x = Conv2D(filters=32, kernel_size=(4, 4), strides=(2, 2), padding='valid', trainable=trainable)(x)
-        x = Activation('relu')(x)
         # flatten the tensor
-        x = Flatten()(x)
-        x = Activation('relu')(x)
-        x = Dense(256, trainable=trainable)(x)
-        # x = Activation('relu')(x)
-        # output layer
-        y_pred = Dense(num_actions, trainable=trainable)(x)
+        x = Flatten(name='flatten')(x)
+        if layout == 'default':
+            x = Activation('relu')(x)
 
-        model = Model(input=state, output=y_pred)
+        return x
 
-    elif model_name == "deep_q_network_double":
+    if model_name == "deep_q_network" or model_name == "deep_q_network_double":
         print "Building " + model_name + " ..."
 
-        # First convolutional layer
-        x = Conv2D(filters=32, kernel_size=(8, 8), strides=(4, 4), padding='valid', trainable=trainable)(state)
-        x = Activation('relu')(x)
-        # Second convolutional layer
-        x = Conv2D(filters=64, kernel_size=(4, 4), strides=(2, 2), padding='valid', trainable=trainable)(x)
-        x = Activation('relu')(x)
-        # Third convolutional layer
-        x = Conv2D(filters=64, kernel_size=(3, 3), strides=(1, 1), padding='valid', trainable=trainable)(x)
-        x = Activation('relu')(x)
-        # flatten the tensor
-        x = Flatten()(x)
-        x = Activation('relu')(x)
-        x = Dense(512, trainable=trainable)(x)
+        x = conv_features(state)
+        hidden_size = 256 if model_name == "deep_q_network" else 512
+        x = Dense(hidden_size, trainable=trainable, name='hidden')(x)
         # x = Activation('relu')(x)
         # output layer
-        y_pred = Dense(num_actions, trainable=trainable)(x)
+        y_pred = Dense(num_actions, trainable=trainable, name='q_values')(x)
 
         model = Model(input=state, output=y_pred)
 
     elif model_name == "deep_q_network_duel":
         print "Building " + model_name + " ..."
 
-        # First convolutional layer
-        x = Conv2D(filters=32, kernel_size=(8, 8), strides=(4, 4), padding='valid', trainable=trainable)(state)
-        x = Activation('relu')(x)
-        # Second convolutional layer
-        x = Conv2D(filters=64, kernel_size=(4, 4), strides=(2, 2), padding='valid', trainable=trainable)(x)
-        x = Activation('relu')(x)
-        # Third convolutional layer
-        x = Conv2D(filters=64, kernel_size=(3, 3), strides=(1, 1), padding='valid', trainable=trainable)(x)
-        x = Activation('relu')(x)
-
-        x = Flatten()(x)
-        x = Activation('relu')(x)
-        # value output
-        x_val = Dense(512, trainable=trainable)(x)
-        # x_val = Activation('relu')(x_val)
-        y_val = Dense(1, trainable=trainable)(x_val)
-
-        # advantage output
-        x_advantage = Dense(512, trainable=trainable)(x)
-        # x_advantage = Activation('relu')(x_advantage)
-        y_advantage = Dense(num_actions, trainable=trainable)(x_advantage)
-        # mean advantage
-        y_advantage_mean = Lambda(lambda x: K.mean(x, axis=1, keepdims=True))(y_advantage)
-
-        y_q = Lambda(lambda x: x[0] + x[1] - x[2])([y_val, y_advantage, y_advantage_mean])
+        x = conv_features(state)
+
+        if layout == 'default':
+            # value output
+            x_val = Dense(512, trainable=trainable, name='value_hidden')(x)
+            # x_val = Activation('relu')(x_val)
+            y_val = Dense(1, trainable=trainable, name='value')(x_val)
+
+            # advantage output
+            x_advantage = Dense(512, trainable=trainable, name='advantage_hidden')(x)
+            # x_advantage = Activation('relu')(x_advantage)
+            y_advantage = Dense(num_actions, trainable=trainable, name='advantage')(x_advantage)
+            # mean advantage
+            y_advantage_mean = Lambda(lambda x: K.mean(x, axis=1, keepdims=True))(y_advantage)
+
+            y_q = Lambda(lambda x: x[0] + x[1] - x[2])([y_val, y_advantage, y_advantage_mean])
+        else:
+            # value and advantage hidden layers as one matrix multiply
+            x_duel = Dense(1024, trainable=trainable, name='duel_hidden')(x)
+            x_val = Lambda(lambda x: x[:, :512], output_shape=(512, ))(x_duel)
+            x_advantage = Lambda(lambda x: x[:, 512:], output_shape=(512, ))(x_duel)
+
+            y_val = Dense(1, trainable=trainable, name='value')(x_val)
+            y_advantage = Dense(num_actions, trainable=trainable, name='advantage')(x_advantage)
+
+            y_q = Lambda(lambda x: x[0] + x[1] - K.mean(x[1], axis=1, keepdims=True),
+                         output_shape=(num_actions, ))([y_val, y_advantage])
 
         model = Model(input=state, output=y_q)
 
     elif model_name == "linear_q_network" or model_name == "linear_q_network_double":
 
-        x = Flatten()(state)
-        x = Dense(256, trainable=trainable)(x)
-        y_pred = Dense(num_actions, trainable=trainable)(x)
+        x = Flatten(name='flatten')(state)
+        x = Dense(256, trainable=trainable, name='hidden')(x)
+        y_pred = Dense(num_actions, trainable=trainable, name='q_values')(x)
         model = Model(output=y_pred, input=state)
     else:
         print "Model not supported"
@@ -141,6 +160,70 @@ def create_model(window, input_shape, num_actions, model_name='deep_q_network',
     return model
 
 
+def _data_format(model):
+    for layer in model.layers:
+        if hasattr(layer, 'data_format'):
+            return layer.data_format
+    return 'channels_last'
+
+
+def convert_weights(source, target):
+    """Copy the weights of a create_model network into another layout.
+
+    source and target must be the same variant, built with any two
+    LAYOUTS. The rows of the first Dense layer are reordered when the
+    flatten order differs, and the dueling hidden layers are joined or
+    split as needed.
+    """
+    flat_shape = source.get_layer('flatten').input_shape[1:]
+    permute = _data_format(source) != _data_format(target)
+
+    def source_weights(name):
+        if name in ('value_hidden', 'advantage_hidden') and name not in [l.name for l in source.layers]:
+            kernel, bias = source.get_layer('duel_hidden').get_weights()
+            half = slice(0, 512) if name == 'value_hidden' else slice(512, 1024)
+            return [kernel[:, half], bias[half]]
+
+        if name == 'duel_hidden' and name not in [l.name for l in source.layers]:
+            value_kernel, value_bias = source.get_layer('value_hidden').get_weights()
+            advantage_kernel, advantage_bias = source.get_layer('advantage_hidden').get_weights()
+            return [np.concatenate([value_kernel, advantage_kernel], axis=1),
+                    np.concatenate([value_bias, advantage_bias])]
+
+        return source.get_layer(name).get_weights()
+
+    for layer in target.layers:
+        if not layer.weights:
+            continue
+
+        weights = source_weights(layer.name)
+        if permute and layer.name in ('hidden', 'value_hidden', 'advantage_hidden', 'duel_hidden') \
+                and len(flat_shape) == 3:
+            # reorder the rows from the source flatten order to the target one
+            kernel = weights[0].reshape(flat_shape + (-1, ))
+            axes = (2, 0, 1, 3) if _data_format(source) == 'channels_last' else (1, 2, 0, 3)
+            weights[0] = kernel.transpose(axes).reshape(-1, kernel.shape[-1])
+
+        layer.set_weights(weights)
+
+
+LR_SCALING = ('sqrt', 'linear', 'none')
+
+
+def scale_large_batch(batch_size, train_freq, alpha, factor, lr_scaling='sqrt'):
+    """Return the batch_size, train_freq and alpha of a factor times larger batch.
+
+    train_freq grows with the batch, so the replay ratio (sampled
+    transitions per env step, batch_size / train_freq) stays the same
+    and there are factor times fewer, larger updates. The learning
+    rate follows lr_scaling: 'linear' multiplies it by factor,
+    'sqrt' by sqrt(factor), which is the usual choice for Adam, and
+    'none' keeps it.
+    """
+    scale = {'linear': factor, 'sqrt': factor ** 0.5, 'none': 1}[lr_scaling]
+    return batch_size * factor, train_freq * factor, alpha * scale
+
+
 def get_output_folder(parent_dir, env_name):
     """Return save folder.
 
@@ -183,9 +266,15 @@ def main():  # noqa: D103
     parser.add_argument('--env', default='SpaceInvaders-v0', help='Atari env name')
     parser.add_argument('--network_name', default='linear_q_network', type=str, help='Type of model to use')
     parser.add_argument('--window', default=4, type=int, help='how many frames are used each time')
+    parser.add_argument('--layout', default='default', choices=LAYOUTS,
+                        help='Network layout, see create_model')
     parser.add_argument('--new_size', default=(84, 84), type=tuple, help='new size')
     parser.add_argument('--batch_size', default=32, type=int, help='Batch size')
     parser.add_argument('--replay_buffer_size', default=750000, type=int, help='Replay buffer size')
+    parser.add_argument('--replay_budget_mb', default=0, type=float,
+                        help='Memory budget of the replay buffer, it is shrunk to fit if it is larger')
+    parser.add_argument('--replay_budget_strict', action='store_true',
+                        help='Fail instead of shrinking the replay buffer when it exceeds the budget')
     parser.add_argument('--gamma', default=0.99, type=float, help='Discount factor')
     parser.add_argument('--alpha', default=0.0001, type=float, help='Learning rate')
     parser.add_argument('--epsilon', default=0.05, type=float, help='Exploration probability for epsilon-greedy')
@@ -209,19 +298,204 @@ def main():  # noqa: D103
     parser.add_argument('--model_num', default=5000000, type=int, help='specify saved model number during train')
     parser.add_argument('--log_dir', default='log', type=str, help='specify log folder to save evaluate result')
     parser.add_argument('--eval_num', default=100, type=int, help='number of evaluation to run')
+    parser.add_argument('--eval_early_stop', action='store_true',
+                        help='Stop evaluations early once the confidence interval of the mean reward allows it')
+    parser.add_argument('--eval_confidence', default=0.95, type=float,
+                        help='Confidence level of --eval_early_stop over all looks, Bonferroni corrected')
+    parser.add_argument('--eval_precision', default=0, type=float,
+                        help='Stop once the confidence interval half width is at most this many reward points')
+    parser.add_argument('--eval_min_episodes', default=5, type=int, help='Episodes before an early stop')
+    parser.add_argument('--eval_max_frames', default=0, type=int,
+                        help='Start no new evaluation episode after this many frames, 0 for no limit')
     parser.add_argument('--save_freq', default=100000, type=int, help='model save frequency')
+    parser.add_argument('--keep_last', default=None, type=int,
+                        help='Keep only the most recent checkpoints, all are kept if not set')
+    parser.add_argument('--keep_best', default=0, type=int,
+                        help='Also keep the checkpoints with the best evaluation reward, '
+                             'alone it keeps only those')
+    parser.add_argument('--metrics', action='store_true',
+                        help='Log per-phase times and throughput to metrics.jsonl in the output folder')
+    parser.add_argument('--metrics_freq', default=1000, type=int, help='Iterations between two metrics records')
+    parser.add_argument('--tensorboard', action='store_true', help='Also write the metrics as TensorBoard scalars')
+    parser.add_argument('--trace_at', default=None, type=int,
+                        help='Iteration at which to capture TensorFlow step traces (or send SIGUSR1)')
+    parser.add_argument('--trace_calls', default=10, type=int, help='Session runs captured per trace')
+    parser.add_argument('--profile_at', default=None, type=int,
+                        help='Iteration at which to start a Python profile (or send SIGUSR2)')
+    parser.add_argument('--profile_iterations', default=1000, type=int, help='Iterations covered by a profile')
+    parser.add_argument('--intra_op_threads', default=0, type=int,
+                        help='TensorFlow threads per op, 0 lets TensorFlow decide')
+    parser.add_argument('--inter_op_threads', default=0, type=int,
+                        help='TensorFlow ops run in parallel, 0 lets TensorFlow decide')
+    parser.add_argument('--xla', action='store_true',
+                        help='JIT compile the networks, loss and optimizer with XLA, after a warm-up')
+    parser.add_argument('--offline_data', default='', type=str,
+                        help='Train from the recorded shards in this directory instead of the environment')
+    parser.add_argument('--offline_chunk_size', default=4096, type=int,
+                        help='Transitions read from the recorded shards at a time')
+    parser.add_argument('--offline_loop', action='store_true',
+                        help='Start over at the first shard when the recorded data is used up, instead of stopping')
+    parser.add_argument('--record_data', default='', type=str,
+                        help='Record every transition of the run as shards in this directory')
+    parser.add_argument('--record_shard_size', default=102400, type=int,
+                        help='Transitions per recorded shard, a multiple of 4096')
+    parser.add_argument('--burn_in_workers', default=1, type=int,
+                        help='Processes collecting the burn-in transitions')
+    parser.add_argument('--target_cache', action='store_true',
+                        help='Cache target q values per replay slot until the next target sync')
+    parser.add_argument('--large_batch', default=1, type=int,
+                        help='Train on batches this many times larger, train_freq and alpha are scaled to match')
+    parser.add_argument('--accumulate', action='store_true',
+                        help='With --large_batch, accumulate gradients over batch_size micro-batches instead')
+    parser.add_argument('--lr_scaling', default='sqrt', choices=LR_SCALING,
+                        help='How --large_batch scales the learning rate')
+    parser.add_argument('--adaptive_replay_ratio', action='store_true',
+                        help='Adapt the updates per env step to the measured step and update times')
+    parser.add_argument('--replay_ratio_deviation', default=2.0, type=float,
+                        help='Largest factor the adaptive replay ratio may deviate from batch_size / train_freq')
+    parser.add_argument('--learner_share', default=0.5, type=float,
+                        help='Share of the loop time the adaptive replay ratio aims updates at, feedback keeps the '
+                             'long-run ratio at train_freq')
+    parser.add_argument('--delta_checkpoints', action='store_true',
+                        help='Save (and evaluate) checkpoints as keyframes and compressed deltas, see delta_checkpoint')
+    parser.add_argument('--keyframe_every', default=10, type=int,
+                        help='With --delta_checkpoints, every this many checkpoints is a full keyframe')
+    parser.add_argument('--checkpoint_report', action='store_true',
+                        help='With --delta_checkpoints, report disk usage and load time of all checkpoints and exit')
+    parser.add_argument('--compact_batch', action='store_true',
+                        help='Feed replay batches as one shared (B, 84, 84, window + 1) frame block')
+    parser.add_argument('--learner_workers', default=0, type=int,
+                        help='Number of data-parallel gradient worker processes, 0 to train in one session')
+    parser.add_argument('--learner_threads', default=1, type=int, help='TensorFlow threads per learner worker')
+    parser.add_argument('--scaling_report', default='', type=str,
+                        help='Comma separated worker counts, report learner scaling efficiency and exit')
+    parser.add_argument('--serving_report', default='', type=str,
+                        help='Comma separated client counts, report inference server latency and exit')
+    parser.add_argument('--inference_max_batch', default=32, type=int,
+                        help='Largest batch of requests answered by the inference server')
+    parser.add_argument('--inference_max_wait', default=2.0, type=float,
+                        help='Milliseconds the inference server waits to fill a batch')
+    parser.add_argument('--eval_workers', default=1, type=int,
+                        help='Evaluate a checkpoint with this many env processes acting through one inference '
+                             'server, which serves the exported graph with --frozen_model or --quantized_model')
+    parser.add_argument('--export_model', action='store_true',
+                        help='Export <model_num>.pb, the frozen inference graph of the online network, and exit')
+    parser.add_argument('--export_report', action='store_true',
+                        help='With --export_model, benchmark the .pb against the JSON+H5 evaluation path')
+    parser.add_argument('--frozen_model', action='store_true',
+                        help='Evaluate from the exported <model_num>.pb instead of JSON+H5')
+    parser.add_argument('--quantize_model', action='store_true',
+                        help='With --export_model, also export the int8 graph <model_num>.int8.pb')
+    parser.add_argument('--probe_states', default=1000, type=int,
+                        help='Random-policy states used to calibrate and check the int8 graph')
+    parser.add_argument('--min_agreement', default=0.95, type=float,
+                        help='Smallest fraction of probe states where the int8 graph picks the float action')
+    parser.add_argument('--quantized_model', action='store_true',
+                        help='Evaluate from the exported <model_num>.int8.pb')
+    parser.add_argument('--export_numpy', action='store_true',
+                        help='With --export_model, also export <model_num>.npz for the NumPy inference engine')
+    parser.add_argument('--numpy_model', action='store_true',
+                        help='Evaluate from the exported <model_num>.npz with NumPy instead of TensorFlow')
 
     args = parser.parse_args()
+
+    from deeprl_hw2.evaluation import StoppingRule
+
+    def eval_stopping(max_episodes):
+        return StoppingRule(max_episodes, args.eval_min_episodes, args.eval_max_frames or None, args.eval_confidence,
+                            args.eval_precision or None, args.eval_early_stop)
+
+    if args.numpy_model and not args.train:
+        '''Evaluate the exported .npz without importing TensorFlow'''
+        import gym
+        from deeprl_hw2.evaluation import evaluate_network
+        from deeprl_hw2.numpy_inference import NumpyQNetwork
+        from deeprl_hw2.preprocessors import AtariPreprocessor
+
+        if not args.model_path:
+            print "Model path must be set when evaluate"
+            exit(1)
+
+        log_file = os.path.join(args.log_dir, args.network_name, str(args.model_num))
+        model_dir = os.path.join(args.model_path, args.network_name, str(args.model_num))
+        policy = LinearDecayGreedyEpsilonPolicy(args.epsilon, 0, 1000000)
+        stats, num_frames, stop_reason = evaluate_network(NumpyQNetwork(model_dir + ".npz"), gym.make(args.env),
+                                                          AtariPreprocessor(args.new_size), policy, log_file,
+                                                          args.repetition_times, eval_stopping(args.eval_num))
+
+        print "\nEvaluated {} episodes ({} frames), stopped on {}".format(stats.count, num_frames, stop_reason)
+        print "Mean: {}".format(stats.mean)
+        print "Standard deviation: {}".format(stats.std)
+        print "Peak RSS {:.0f} MB, TensorFlow imported: {}".format(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 'tensorflow' in sys.modules)
+        exit(0)
+
+    import gym
+    import keras.backend as K
+    import tensorflow as tf
+    from keras.models import model_from_json
+
+    from deeprl_hw2.checkpoint import CheckpointWriter
+    from deeprl_hw2.dataset import ShardReader
+    from deeprl_hw2.delta_checkpoint import CheckpointStore, DeltaCheckpointWriter, measure_store
+    from deeprl_hw2.recorder import TransitionRecorder
+    from deeprl_hw2.replay_ratio import ReplayRatioController
+    from deeprl_hw2.target_cache import TargetQCache
+    from deeprl_hw2.dqn import DQNAgent
+    from deeprl_hw2.export import FrozenQNetwork, export_inference_graph, measure_export
+    from deeprl_hw2.quantize import collect_probe_states, measure_quantization, quantize_inference_graph
+    from deeprl_hw2.inference import evaluate_parallel, measure_serving
+    from deeprl_hw2.numpy_inference import NumpyQNetwork, export_numpy_network, measure_numpy_inference
+    from deeprl_hw2.metrics import Metrics
+    from deeprl_hw2.objectives import mean_huber_loss
+    from deeprl_hw2.parallel import DataParallelLearner, measure_scaling
+    from deeprl_hw2.preprocessors import AtariPreprocessor
+    from deeprl_hw2.profiling import Profiler
+    from deeprl_hw2.utils import jit_scope
+
+    session_config = tf.ConfigProto(intra_op_parallelism_threads=args.intra_op_threads,
+                                    inter_op_parallelism_threads=args.inter_op_threads)
+
+    accumulate_steps = 1
+    if args.large_batch > 1:
+        batch_size, args.train_freq, args.alpha = scale_large_batch(args.batch_size, args.train_freq, args.alpha,
+                                                                    args.large_batch, args.lr_scaling)
+        if args.accumulate:
+            # DQNAgent only accumulates its own updates from replay, it
+            # would fall back to one micro-batch per scaled update
+            if args.learner_workers > 0 or not args.experience_replay:
+                print "--accumulate needs experience replay and no --learner_workers"
+                exit(1)
+            # keep batch_size as the micro-batch
+            accumulate_steps = args.large_batch
+        else:
+            args.batch_size = batch_size
+
     print("\nParameters:")
     for arg in vars(args):
         print arg, getattr(args, arg)
     print("")
 
-    env = gym.make(args.env)
-    num_actions = env.action_space.n
+    reader = None
+    if args.offline_data:
+        if not args.experience_replay:
+            print "Offline training requires experience replay"
+            exit(1)
+
+        # no emulator needed, the dataset knows the action space
+        reader = ShardReader(args.offline_data, args.offline_chunk_size, loop=args.offline_loop)
+        env = None
+        num_actions = reader.num_actions
+    else:
+        env = gym.make(args.env)
+        num_actions = env.action_space.n
     # define model object
     preprocessor = AtariPreprocessor(args.new_size)
-    memory = ReplayMemory(args.replay_buffer_size, args.window)
+    max_bytes = int(args.replay_budget_mb * 2 ** 20) if args.replay_budget_mb else None
+    memory = ReplayMemory(args.replay_buffer_size, args.window, args.new_size, max_bytes,
+                          not args.replay_budget_strict)
+    print "Replay memory: {} transitions, {:.1f} MB".format(memory.max_size,
+                                                            memory.memory_usage()['reserved'] / 2.0 ** 20)
 
     # Initiating policy for both tasks (training and evaluating)
     policy = LinearDecayGreedyEpsilonPolicy(args.epsilon, 0, 1000000)
@@ -237,45 +511,220 @@ def main():  # noqa: D103
         log_file = os.path.join(args.log_dir, args.network_name, str(args.model_num))
         model_dir = os.path.join(args.model_path, args.network_name, str(args.model_num))
 
-        with tf.Session() as sess:
-            # load model
-            with open(model_dir + ".json", 'r') as json_file:
-                loaded_model_json = json_file.read()
+        if args.eval_workers > 1:
+            graph_path, build_model = None, None
+            if args.frozen_model or args.quantized_model:
+                # the int8 or float graph is served, the actors are unchanged
+                graph_path = model_dir + (".int8.pb" if args.quantized_model else ".pb")
+            elif args.delta_checkpoints:
+                print "--eval_workers needs the json and h5 files or the exported graph of a checkpoint"
+                exit(1)
+            else:
+                with open(model_dir + ".json", 'r') as json_file:
+                    loaded_model_json = json_file.read()
+
+                def build_model():
+                    return model_from_json(loaded_model_json)
+
+            # a fixed number of episodes, the workers cannot stop early together
+            stats, num_frames = evaluate_parallel(
+                build_model, model_dir + ".h5", (args.new_size[0], args.new_size[1], args.window), args.env,
+                preprocessor, policy, log_file, args.repetition_times, args.eval_num, args.eval_workers, args.seed,
+                args.inference_max_batch, args.inference_max_wait / 1000.0, graph_path=graph_path)
+
+            print "\nEvaluated {} episodes ({} frames) with {} workers".format(stats.count, num_frames,
+                                                                              args.eval_workers)
+            print "Mean: {}".format(stats.mean)
+            print "Standard deviation: {}".format(stats.std)
+            exit(0)
+
+        if args.frozen_model or args.quantized_model:
+            inference_network = FrozenQNetwork(model_dir + (".int8.pb" if args.quantized_model else ".pb"))
+            dqn_agent = DQNAgent(None, preprocessor, memory, policy, num_actions,
+                                 args.gamma, args.target_update_freq, args.num_burn_in, args.train_freq,
+                                 args.batch_size, args.experience_replay, args.repetition_times, args.network_name,
+                                 args.max_grad, args.env, None, inference_client=inference_network)
+
+            dqn_agent.evaluate(env, log_file, args.eval_num, stopping=eval_stopping(args.eval_num))
+            # to compare with the peak RSS of --numpy_model
+            print "Peak RSS {:.0f} MB".format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0)
+            exit(0)
+
+        with tf.Session(config=session_config) as sess:
+            if args.delta_checkpoints:
+                # architecture once per folder, weights assigned in place
+                store = CheckpointStore(os.path.join(args.model_path, args.network_name))
+                loaded_model_json = store.model_json()
                 q_network_online = model_from_json(loaded_model_json)
                 q_network_target = model_from_json(loaded_model_json)
+                sess.run(tf.global_variables_initializer())
+                start = time.time()
+                store.load(str(args.model_num), q_network_online, q_network_target)
+                print "Loaded checkpoint {} in {:.1f} ms".format(args.model_num, 1000 * (time.time() - start))
+
+                if args.checkpoint_report:
+                    report = measure_store(store.folder, q_network_online)
+                    print "{checkpoints} checkpoints, {store_mb:.1f} MB on disk ({raw_mb:.1f} MB of raw weights), " \
+                          "load {load_ms:.1f} ms mean, {max_load_ms:.1f} ms max".format(**report)
+                    exit(0)
+            else:
+                # load model
+                with open(model_dir + ".json", 'r') as json_file:
+                    loaded_model_json = json_file.read()
+                    q_network_online = model_from_json(loaded_model_json)
+                    q_network_target = model_from_json(loaded_model_json)
+
+                sess.run(tf.global_variables_initializer())
+
+                # load weights into model
+                q_network_online.load_weights(model_dir + ".h5")
+                q_network_target.load_weights(model_dir + ".h5")
+
+            if args.export_model:
+                export_inference_graph(q_network_online, sess, model_dir + ".pb")
+                print "Exported inference graph to " + model_dir + ".pb"
+                if args.export_numpy:
+                    export_numpy_network(q_network_online, model_dir + ".npz")
+                    print "Exported NumPy network to " + model_dir + ".npz"
+            else:
+                dqn_agent = DQNAgent((q_network_online, q_network_target), preprocessor, memory, policy,
+                                     num_actions, args.gamma, args.target_update_freq, args.num_burn_in,
+                                     args.train_freq, args.batch_size, \
+                                     args.experience_replay, args.repetition_times, args.network_name,
+                                     args.max_grad, args.env, sess)
+
+                dqn_agent.evaluate(env, log_file, args.eval_num, stopping=eval_stopping(args.eval_num))
+
+        if args.export_model and args.export_report:
+            report = measure_export(model_dir + ".json", model_dir + ".h5", model_dir + ".pb")
+            print "JSON+H5: load {json_load_s:.3f} s, {json_action_ms:.3f} ms/action".format(**report)
+            print "Frozen:  load {frozen_load_s:.3f} s, {frozen_action_ms:.3f} ms/action".format(**report)
+        if args.export_model and (args.quantize_model or args.export_numpy and args.export_report):
+            probe_states = collect_probe_states(args.env, preprocessor, args.new_size, args.window,
+                                                args.probe_states, args.seed)
+        if args.export_model and args.export_numpy and args.export_report:
+            report = measure_numpy_inference(FrozenQNetwork(model_dir + ".pb"), NumpyQNetwork(model_dir + ".npz"),
+                                             probe_states)
+            print "TensorFlow: {tf_action_ms:.3f} ms/action; NumPy: {numpy_action_ms:.3f} ms/action; " \
+                  "speedup {speedup:.2f}x, max q difference {max_abs_diff:.2g}, " \
+                  "agreement {agreement:.1%}".format(**report)
+        if args.export_model and args.quantize_model:
+            agreement = quantize_inference_graph(model_dir + ".pb", model_dir + ".int8.pb", probe_states,
+                                                 args.min_agreement)
+            print "Exported int8 inference graph to {}.int8.pb, {:.1%} action agreement".format(model_dir,
+                                                                                            agreement)
+            if args.export_report:
+                report = measure_quantization(model_dir + ".pb", model_dir + ".int8.pb", probe_states)
+                print "float: {float_action_ms:.3f} ms/action, {float_mb:.2f} MB; " \
+                      "int8: {int8_action_ms:.3f} ms/action, {int8_mb:.2f} MB; " \
+                      "speedup {speedup:.2f}x, agreement {agreement:.1%}".format(**report)
+        exit(0)
 
-            sess.run(tf.global_variables_initializer())
+    def build_online_model():
+        with jit_scope(args.xla):
+            return create_model(args.window, args.new_size, num_actions, args.network_name, True, args.layout)
 
-            # load weights into model
-            q_network_online.load_weights(model_dir + ".h5")
-            q_network_target.load_weights(model_dir + ".h5")
+    state_shape = (args.new_size[0], args.new_size[1], args.window)
 
-            dqn_agent = DQNAgent((q_network_online, q_network_target), preprocessor, memory, policy, num_actions,
-                                 args.gamma, args.target_update_freq, args.num_burn_in, args.train_freq,
-                                 args.batch_size, \
-                                 args.experience_replay, args.repetition_times, args.network_name, args.max_grad,
-                                 args.env, sess)
+    if args.scaling_report:
+        '''Report data-parallel learner scaling'''
+        worker_counts = [int(w) for w in args.scaling_report.split(',')]
+        results = measure_scaling(build_online_model, state_shape, num_actions, worker_counts, args.batch_size,
+                                  mean_huber_loss, args.max_grad, num_threads=args.learner_threads)
 
-            dqn_agent.evaluate(env, log_file, args.eval_num)
+        print "\nLearner scaling for " + args.network_name
+        for result in results:
+            print "W={num_workers}: {updates_per_sec:.2f} updates/s, {samples_per_sec:.1f} samples/s, " \
+                  "efficiency {efficiency:.2f}".format(**result)
+        exit(0)
+
+    if args.serving_report:
+        '''Report batched inference server latency'''
+        client_counts = [int(c) for c in args.serving_report.split(',')]
+        results = measure_serving(build_online_model, state_shape, client_counts,
+                                  max_batch=args.inference_max_batch, max_wait=args.inference_max_wait / 1000.0)
+
+        print "\nInference server for " + args.network_name
+        for result in results:
+            print "{num_clients} clients: {requests_per_sec:.1f} requests/s, p50 {p50_ms:.2f} ms, " \
+                  "p99 {p99_ms:.2f} ms".format(**result)
         exit(0)
 
     '''Train the model'''
-    q_network_online = create_model(args.window, args.new_size, num_actions, args.network_name, True)
-    q_network_target = create_model(args.window, args.new_size, num_actions, args.network_name, False)
+    q_network_online = build_online_model()
+    with jit_scope(args.xla):
+        q_network_target = create_model(args.window, args.new_size, num_actions, args.network_name, False,
+                                        args.layout)
+
+    parallel_learner = None
+    if args.learner_workers > 0:
+        if not args.experience_replay:
+            print "Data-parallel learner requires experience replay"
+            exit(1)
+
+        # fork the workers before the training session exists
+        variable_shapes = [K.int_shape(w) for w in q_network_online.trainable_weights]
+        parallel_learner = DataParallelLearner(build_online_model, args.learner_workers, args.batch_size,
+                                               state_shape, variable_shapes, num_actions, mean_huber_loss,
+                                               args.max_grad, args.learner_threads)
 
     # create output dir, meant to pop up error when dir exist to avoid over written
     os.mkdir(os.path.join(args.output, args.network_name))
-
-    with tf.Session() as sess:
+    if args.delta_checkpoints:
+        checkpoint_writer = DeltaCheckpointWriter(os.path.join(args.output, args.network_name), args.keyframe_every,
+                                                  args.keep_last, args.keep_best)
+    else:
+        checkpoint_writer = CheckpointWriter(os.path.join(args.output, args.network_name), args.keep_last,
+                                             args.keep_best)
+
+    profiler = Profiler(os.path.join(args.output, args.network_name), args.trace_calls, args.profile_iterations,
+                        args.trace_at, args.profile_at)
+    profiler.install_signal_handlers()
+
+    metrics = None
+    if args.metrics:
+        output_folder = os.path.join(args.output, args.network_name)
+        metrics = Metrics(os.path.join(output_folder, 'metrics.jsonl'), args.metrics_freq,
+                          output_folder if args.tensorboard else None)
+
+    target_cache = None
+    if args.target_cache:
+        target_cache = TargetQCache(memory.max_size, num_actions)
+
+    replay_ratio_controller = None
+    if args.adaptive_replay_ratio:
+        replay_ratio_controller = ReplayRatioController(
+            args.batch_size * accumulate_steps, args.train_freq, args.replay_ratio_deviation, args.learner_share,
+            log_path=os.path.join(args.output, args.network_name, 'replay_ratio.jsonl'))
+
+    recorder = None
+    if args.record_data:
+        recorder = TransitionRecorder(args.record_data, num_actions, args.env, args.record_shard_size)
+
+    with tf.Session(config=session_config) as sess:
         dqn_agent = DQNAgent((q_network_online, q_network_target), preprocessor, memory, policy, num_actions,
                              args.gamma, args.target_update_freq, args.num_burn_in, args.train_freq, args.batch_size, \
                              args.experience_replay, args.repetition_times, args.network_name, args.max_grad, args.env,
-                             sess)
+                             sess, compact_batch=args.compact_batch, parallel_learner=parallel_learner,
+                             checkpoint_writer=checkpoint_writer, metrics=metrics, profiler=profiler,
+                             recorder=recorder, burn_in_workers=args.burn_in_workers,
+                             target_cache=target_cache, accumulate_steps=accumulate_steps,
+                             eval_stopping=eval_stopping(20), replay_ratio_controller=replay_ratio_controller,
+                             xla=args.xla, seed=args.seed)
 
         optimizer = tf.train.AdamOptimizer(learning_rate=args.alpha)
         dqn_agent.compile(optimizer, mean_huber_loss)
-        dqn_agent.fit(env, args.num_iterations, os.path.join(args.output, args.network_name), args.save_freq,
-                      args.max_episode_length)
+        if reader is not None:
+            dqn_agent.fit_offline(reader, args.num_iterations, os.path.join(args.output, args.network_name),
+                                  args.save_freq)
+        else:
+            dqn_agent.fit(env, args.num_iterations, os.path.join(args.output, args.network_name), args.save_freq,
+                          args.max_episode_length)
+
+    if parallel_learner is not None:
+        parallel_learner.close()
+    if metrics is not None:
+        metrics.close()
 
 
 if __name__ == '__main__':
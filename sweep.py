@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+"""Run a grid of dqn_atari.py configurations concurrently on one machine.
+
+Every run gets its own set of CPU cores (pinned with taskset) and a
+matching TensorFlow / OpenMP thread budget, so concurrent runs do not
+oversubscribe the machine. Runs wait in a queue until enough cores are
+free. When all runs are done, the throughput (from metrics.jsonl) and
+the final evaluation reward (from the run log) of every run are
+collected into a summary.
+
+Example:
+
+    python sweep.py --grid network_name=deep_q_network,deep_q_network_duel \
+        --grid alpha=0.0001,0.00025 --cores_per_run 4 -o sweeps/lr \
+        -- --experience_replay True --num_iterations 1000000
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+from distutils.spawn import find_executable
+
+
+def parse_grid(grid_args):
+    """Turn ['name=a,b', ...] into a list of {name: value} configurations."""
+    names, values = [], []
+    for entry in grid_args:
+        name, _, choices = entry.partition('=')
+        names.append(name)
+        values.append(choices.split(','))
+
+    return [dict(zip(names, combination)) for combination in itertools.product(*values)]
+
+
+def read_summary(run_dir):
+    """Collect the throughput and final evaluation reward of a run."""
+    summary = {}
+
+    # dqn_atari.py writes into <run_dir>/<network_name>/
+    for folder in os.listdir(run_dir):
+        metrics_path = os.path.join(run_dir, folder, 'metrics.jsonl')
+        if not os.path.exists(metrics_path):
+            continue
+        with open(metrics_path) as metrics_file:
+            records = [json.loads(line) for line in metrics_file if line.strip()]
+        for key in ('steps_per_sec', 'updates_per_sec'):
+            values = [r[key] for r in records if key in r]
+            if values:
+                summary[key] = sum(values) / len(values)
+
+    rewards = []
+    with open(os.path.join(run_dir, 'log.txt')) as log_file:
+        for line in log_file:
+            if line.startswith('Average reward: '):
+                rewards.append(float(line.split(': ')[1]))
+    if rewards:
+        summary['final_eval_reward'] = rewards[-1]
+
+    return summary
+
+
+class CorePool:
+    """Hands out disjoint sets of CPU cores."""
+
+    def __init__(self, cores):
+        self.free = list(cores)
+
+    def take(self, n):
+        if len(self.free) < n:
+            return None
+        taken, self.free = self.free[:n], self.free[n:]
+        return taken
+
+    def give_back(self, cores):
+        self.free = sorted(self.free + cores)
+
+
+def main():  # noqa: D103
+    parser = argparse.ArgumentParser(description='Run a grid of dqn_atari.py configurations on one machine')
+    parser.add_argument('--grid', action='append', default=[],
+                        help='name=v1,v2,... sweeps the dqn_atari.py argument --name, repeat for more arguments')
+    parser.add_argument('--cores_per_run', default=2, type=int, help='CPU cores pinned to each run')
+    parser.add_argument('--cores', default=None, type=str,
+                        help='Comma separated cores to use, all cores if not set')
+    parser.add_argument('-o', '--output', default='sweep', type=str, help='Directory of the run folders')
+    parser.add_argument('extra', nargs=argparse.REMAINDER, help='Arguments passed to every run, after --')
+
+    args = parser.parse_args()
+    extra = [a for a in args.extra if a != '--']
+
+    cores = [int(c) for c in args.cores.split(',')] if args.cores else range(multiprocessing.cpu_count())
+    if args.cores_per_run > len(cores):
+        print "Not enough cores for a single run"
+        exit(1)
+
+    taskset = find_executable('taskset')
+    if taskset is None:
+        print "taskset not found, runs will not be pinned to their cores"
+
+    configs = parse_grid(args.grid)
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dqn_atari.py')
+    pool = CorePool(cores)
+    queue = list(enumerate(configs))
+    running = []
+    runs = []
+
+    while queue or running:
+        # start as many queued runs as there are free cores for
+        while queue:
+            run_cores = pool.take(args.cores_per_run)
+            if run_cores is None:
+                break
+            run_id, config = queue.pop(0)
+            run_dir = os.path.join(args.output, 'run{}'.format(run_id))
+            os.makedirs(run_dir)
+
+            threads = str(len(run_cores))
+            command = [sys.executable, script, '-o', run_dir, '--metrics',
+                       '--intra_op_threads', threads, '--inter_op_threads', '1'] + extra
+            for name, value in sorted(config.items()):
+                command += ['--' + name, value]
+            if taskset is not None:
+                command = [taskset, '-c', ','.join(str(c) for c in run_cores)] + command
+
+            env = dict(os.environ, OMP_NUM_THREADS=threads, MKL_NUM_THREADS=threads)
+            log_file = open(os.path.join(run_dir, 'log.txt'), 'w')
+            process = subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT, env=env)
+            print "Started run{} on cores {}: {}".format(run_id, run_cores, config)
+
+            run = {'run_id': run_id, 'config': config, 'cores': run_cores, 'run_dir': run_dir,
+                   'process': process, 'log_file': log_file, 'start': time.time()}
+            running.append(run)
+            runs.append(run)
+
+        time.sleep(1)
+        for run in list(running):
+            if run['process'].poll() is not None:
+                run['log_file'].close()
+                run['wall_s'] = time.time() - run['start']
+                pool.give_back(run['cores'])
+                running.remove(run)
+                print "Finished run{} with exit code {}".format(run['run_id'], run['process'].returncode)
+
+    summary = []
+    for run in runs:
+        result = {'run_id': run['run_id'], 'config': run['config'], 'cores': run['cores'],
+                  'exit_code': run['process'].returncode, 'wall_s': run['wall_s']}
+        result.update(read_summary(run['run_dir']))
+        summary.append(result)
+
+    with open(os.path.join(args.output, 'summary.json'), 'w') as json_file:
+        json.dump(summary, json_file, indent=2, sort_keys=True)
+
+    print "\nSummary:"
+    for result in summary:
+        print "run{run_id} {config}: {steps:.1f} steps/s, final eval reward {reward}".format(
+            steps=result.get('steps_per_sec', float('nan')), reward=result.get('final_eval_reward'), **result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""Allocations of the DQNAgent acting loop.
+
+Runs select_action and _append_to_memory the way fit does, on the
+synthetic env, and counts the bytes of every numpy buffer that shows
+up fresh at one of the real calls: the frame the preprocessor returns,
+the frame memory.append stores, the state fed to the network and the
+next state _append_to_memory returns. A buffer is fresh when its
+memory owner was not seen before; a state copied per step, an
+np.append stack or a float frame all show up as fresh buffers.
+
+Run with python -m unittest discover tests (Python 2.7, TensorFlow,
+Keras and gym installed, else the test is skipped).
+"""
+
+import os
+import sys
+import unittest
+import weakref
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import gym
+    import tensorflow as tf
+except ImportError:
+    tf = None
+
+# the uint8 84x84 frame of the preprocessor is the one allocation a step
+# needs, a float32 84x84x4 state is 110 KB
+MAX_ALLOC_KB_PER_STEP = 16.0
+
+
+def _owner(array):
+    while array.base is not None:
+        array = array.base
+    return array
+
+
+class FreshBuffers:
+    """Sum of the bytes of buffers whose owner was not seen before."""
+
+    def __init__(self):
+        self.bytes = 0
+        self._seen = []
+
+    def see(self, array):
+        if isinstance(array, np.ndarray):
+            owner = _owner(array)
+            # weak references, so owners that die are not kept alive
+            self._seen = [ref for ref in self._seen if ref() is not None]
+            if not any(ref() is owner for ref in self._seen):
+                self.bytes += owner.nbytes
+                self._seen.append(weakref.ref(owner))
+        return array
+
+
+@unittest.skipIf(tf is None, 'needs TensorFlow and gym')
+class ActingAllocationTest(unittest.TestCase):
+
+    def test_bounded_allocations_per_step(self):
+        from deeprl_hw2 import synthetic
+        from deeprl_hw2.core import ReplayMemory
+        from deeprl_hw2.dqn import DQNAgent
+        from deeprl_hw2.policy import LinearDecayGreedyEpsilonPolicy
+        from deeprl_hw2.preprocessors import AtariPreprocessor
+        from deeprl_hw2.utils import StateStack, get_init_state
+        from dqn_atari import create_model
+
+        num_steps = 300
+        env = gym.make(synthetic.ENV_NAME)
+        env.seed(0)
+        num_actions = env.action_space.n
+        preprocessor = AtariPreprocessor((84, 84))
+        memory = ReplayMemory(num_steps + 100, 4)
+        policy = LinearDecayGreedyEpsilonPolicy(0.05, 0, 1000000)
+        fresh = FreshBuffers()
+
+        with tf.Graph().as_default(), tf.Session() as sess:
+            q_networks = (create_model(4, (84, 84), num_actions, 'deep_q_network', True),
+                          create_model(4, (84, 84), num_actions, 'deep_q_network', False))
+            agent = DQNAgent(q_networks, preprocessor, memory, policy, num_actions, 0.99, 1000, 0, 4, 32, True, 1,
+                             'deep_q_network', 1.0, synthetic.ENV_NAME, sess)
+            sess.run(tf.global_variables_initializer())
+
+            # the state handling fit sets up
+            agent.init_state = get_init_state(env, preprocessor)
+            agent.state_stack = StateStack(agent.init_state)
+
+            # count at the real calls, the agent calls them as before
+            process_state_for_memory = preprocessor.process_state_for_memory
+            preprocessor.process_state_for_memory = lambda frame: fresh.see(process_state_for_memory(frame))
+            append = memory.append
+            memory.append = lambda frame, *rest: append(fresh.see(frame), *rest)
+            run = agent._run
+            agent._run = lambda name, fetches, feed_dict: run(
+                name, fetches, dict((k, fresh.see(v)) for k, v in feed_dict.items()))
+
+            env.reset()
+            state = agent._initial_state()
+            fresh.see(state)
+            for _ in xrange(num_steps):
+                action = agent.select_action(state, is_training=True)
+                next_frame, reward, is_terminal, _ = env.step(action)
+                state = fresh.see(agent._append_to_memory(state, action, next_frame, reward, is_terminal))
+                if is_terminal:
+                    env.reset()
+                    state = agent._initial_state()
+
+        alloc_kb = fresh.bytes / 1024.0 / num_steps
+        self.assertLessEqual(alloc_kb, MAX_ALLOC_KB_PER_STEP,
+                             'The acting loop allocates {:.1f} KB per step'.format(alloc_kb))
+
+
+if __name__ == '__main__':
+    unittest.main()